@@ -0,0 +1,232 @@
+"""
+Persistent cache of the cleaned text of articles, to skip cleaning on repeated runs.
+"""
+
+import hashlib
+import sqlite3
+import zlib
+
+# Number of inserts between two commits of the cache
+COMMIT_EVERY = 1000
+
+# Fraction of max_bytes inserted between two counts of the size of the whole
+# cache, which other connections (e.g. of worker processes) write to as well
+RECOUNT_FRACTION = 0.01
+
+
+class CleanCache:
+    """
+    Cleaned text of articles stored in SQLite, keyed by content
+
+    The key of an article is the SHA-1 of the cleaner version and of its wiki
+    markup, so a changed article or cleaner simply misses the cache. Texts are
+    stored zlib compressed. When the cache grows over `max_bytes`, the least
+    recently used texts are evicted until it is back to 90% of its size. The
+    size of the cache is counted again from the database every RECOUNT_FRACTION
+    of `max_bytes` inserted and before evicting, so that the texts stored by
+    the other connections to the cache are accounted for.
+
+    Args:
+        path (str): path of the SQLite database
+        max_bytes (int, optional): maximum size of the stored texts. Defaults to 10 GiB.
+        commit_every (int, optional): number of writes between two commits.
+            Defaults to COMMIT_EVERY.
+
+    A pickled cache reconnects to the database and commits every write, so
+    that processes sharing it do not lock each other out for long.
+
+    Examples:
+        >>> cache = CleanCache("data/clean-cache.sqlite")
+        >>> text = cache.clean(cleaner, article["source_text"])
+        >>> cache.stats
+        {'hits': 1, 'misses': 0, 'evictions': 0, 'bytes': 5370}
+        >>> cache.close()
+    """
+
+    def __init__(
+        self, path: str, max_bytes: int = 10 << 30, commit_every: int = COMMIT_EVERY
+    ):
+        """
+        Initialize CleanCache
+
+        Args:
+            path (str): path of the SQLite database
+            max_bytes (int, optional): maximum size of the stored texts. Defaults to 10 GiB.
+            commit_every (int, optional): number of writes between two commits.
+                Defaults to COMMIT_EVERY.
+        """
+
+        self.path = path
+        self.max_bytes = max_bytes
+        self.commit_every = commit_every
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS texts (
+                key BLOB PRIMARY KEY,
+                text BLOB,
+                size INTEGER,
+                used INTEGER
+            )
+            """
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS texts_used ON texts (used)")
+        self.conn.commit()
+        size, used = self.conn.execute(
+            "SELECT COALESCE(SUM(size), 0), COALESCE(MAX(used), 0) FROM texts"
+        ).fetchone()
+        self.clock = used
+        self.pending = 0
+        self.inserted = 0
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "bytes": size}
+
+    def __reduce__(self):
+        return CleanCache, (self.path, self.max_bytes, 1)
+
+    @staticmethod
+    def key(version: str, source_text: str):
+        """
+        Key of an article cleaned by a given cleaner version
+        """
+
+        digest = hashlib.sha1(version.encode("utf-8"))
+        digest.update(b"\0")
+        digest.update(source_text.encode("utf-8"))
+        return digest.digest()
+
+    def get(self, key: bytes):
+        """
+        Get a cleaned text, marking it as recently used
+
+        Args:
+            key (bytes): key of the article, see `CleanCache.key`
+
+        Returns:
+            str: the cleaned text, or None when missing from the cache
+        """
+
+        row = self.conn.execute(
+            "SELECT text FROM texts WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            self.stats["misses"] += 1
+            return None
+
+        self.stats["hits"] += 1
+        self.clock += 1
+        self.conn.execute("UPDATE texts SET used = ? WHERE key = ?", (self.clock, key))
+        self._written()
+        return zlib.decompress(row[0]).decode("utf-8")
+
+    def put(self, key: bytes, text: str):
+        """
+        Store a cleaned text, evicting the least recently used ones when full
+
+        Args:
+            key (bytes): key of the article, see `CleanCache.key`
+            text (str): the cleaned text
+        """
+
+        data = zlib.compress(text.encode("utf-8"))
+        replaced = self.conn.execute(
+            "SELECT size FROM texts WHERE key = ?", (key,)
+        ).fetchone()
+        self.clock += 1
+        self.conn.execute(
+            "INSERT OR REPLACE INTO texts VALUES (?, ?, ?, ?)",
+            (key, data, len(data), self.clock),
+        )
+        self.stats["bytes"] += len(data) - (replaced[0] if replaced else 0)
+        self.inserted += len(data)
+        if (
+            self.stats["bytes"] > self.max_bytes
+            or self.inserted > self.max_bytes * RECOUNT_FRACTION
+        ):
+            self.inserted = 0
+            self.stats["bytes"] = self._size()
+            if self.stats["bytes"] > self.max_bytes:
+                self._evict(self.stats["bytes"] - int(self.max_bytes * 0.9))
+        self._written()
+
+    def clean(self, cleaner, source_text: str, doc_id=None):
+        """
+        Clean an article, through the cache
+
+        Texts produced by the fallback of the cleaner, for articles over its
+        budget, are not stored.
+
+        Args:
+            cleaner (WikiCleaner): cleaner of the article wiki markup
+            source_text (str): wiki markup of the article
+            doc_id (str, optional): id of the article, passed to the cleaner.
+                Defaults to None.
+
+        Returns:
+            str: the cleaned text
+        """
+
+        key = self.key(cleaner.version, source_text)
+        text = self.get(key)
+        if text is None:
+            fallbacks = cleaner.fallbacks
+            text = cleaner.clean(source_text, doc_id)
+            if cleaner.fallbacks == fallbacks:
+                self.put(key, text)
+        return text
+
+    def _evict(self, size: int):
+        """
+        Delete the least recently used texts, for at least size bytes
+        """
+
+        keys = []
+        freed = 0
+        for key, text_size in self.conn.execute(
+            "SELECT key, size FROM texts ORDER BY used"
+        ):
+            keys.append((key,))
+            freed += text_size
+            if freed >= size:
+                break
+        self.conn.executemany("DELETE FROM texts WHERE key = ?", keys)
+        self.stats["evictions"] += len(keys)
+        self.stats["bytes"] -= freed
+
+    def _written(self):
+        self.pending += 1
+        if self.pending >= self.commit_every:
+            self.commit()
+
+    def add_stats(self, stats: dict):
+        """
+        Add the hits, misses and evictions of another connection to the cache
+
+        Args:
+            stats (dict): statistics of the other connection, for its writes only
+        """
+
+        for name in ("hits", "misses", "evictions"):
+            self.stats[name] += stats[name]
+        self.stats["bytes"] = self._size()
+
+    def _size(self):
+        """
+        Size of the texts stored in the cache, by all its connections
+        """
+
+        (size,) = self.conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM texts"
+        ).fetchone()
+        return size
+
+    def commit(self):
+        """
+        Persist the texts stored so far
+        """
+
+        self.conn.commit()
+        self.pending = 0
+
+    def close(self):
+        self.commit()
+        self.conn.close()
@@ -0,0 +1,177 @@
+"""
+Strategies to split the tokens of an article into the chunks that are indexed.
+"""
+
+import bisect
+import re
+from typing import Optional
+
+from cirrus_clean import HEADING_MARK
+
+# Ways to split an article: fixed windows, whole sentences, or whole sentences within sections
+CHUNK_STRATEGIES = ("fixed", "sentence", "section")
+
+# Tokens per chunk, and tokens shared by consecutive fixed windows of an article
+MAX_LENGTH = 256
+STRIDE = 64
+
+# End of a sentence, not followed by a lowercase word (e.g. "e.g. the"), or of a line
+SENTENCE_END = re.compile(r"[.!?…][\"')\]»]*\s+(?![a-z])|\n")
+
+
+class Chunker:
+    """
+    Splitter of the tokens of an article into chunks of at most max_length tokens
+
+    "fixed" cuts windows of max_length tokens, each starting stride tokens
+    before the end of the previous one, wherever they fall in the text.
+    "sentence" packs whole sentences into each chunk, cutting a sentence only
+    when it does not fit in a chunk of its own, and repeats up to stride tokens
+    of whole sentences at the start of the next chunk. "section" packs
+    sentences the same way, but starts a new chunk at every section heading
+    kept by `WikiCleaner(headings=True)`; without headings, an article is a
+    single section.
+
+    The number of chunks, their tokens and the tokens they repeat from the
+    previous chunk are counted in `stats`.
+
+    Args:
+        strategy (str, optional): one of CHUNK_STRATEGIES. Defaults to "fixed".
+        max_length (int, optional): tokens per chunk. Defaults to MAX_LENGTH.
+        stride (int, optional): tokens shared by consecutive chunks. Defaults to
+            STRIDE for "fixed", and to 0 for the other strategies.
+
+    Raises:
+        ValueError: if the strategy is unknown, or the stride is not smaller
+            than max_length
+
+    Examples:
+        >>> chunker = Chunker("section", max_length=128)
+        >>> text, sections = chunker.sections(WikiCleaner(headings=True).clean(wikitext))
+        >>> encoding = tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)
+        >>> chunker.ranges(text, encoding["offset_mapping"], sections)
+        [(0, 97), (97, 211), (211, 240)]
+    """
+
+    def __init__(
+        self,
+        strategy: str = "fixed",
+        max_length: int = MAX_LENGTH,
+        stride: Optional[int] = None,
+    ):
+        """
+        Initialize Chunker
+        """
+
+        if strategy not in CHUNK_STRATEGIES:
+            raise ValueError(f"Unknown chunking strategy: {strategy}")
+        if stride is None:
+            stride = STRIDE if strategy == "fixed" else 0
+        if not 0 <= stride < max_length:
+            raise ValueError(f"The stride must be smaller than {max_length} tokens")
+
+        self.strategy = strategy
+        self.max_length = max_length
+        self.stride = stride
+        self.reset_stats()
+
+    def reset_stats(self):
+        """
+        Reset the counts of articles, chunks and tokens
+        """
+
+        self.stats = {"articles": 0, "chunks": 0, "tokens": 0, "overlap": 0}
+
+    def sections(self, text: str):
+        """
+        Remove the heading marks of a text, keeping the start of its sections
+
+        Returns:
+            tuple: the text without heading marks, and the offsets of the
+                headings in it, or an empty list unless chunking by section
+        """
+
+        if HEADING_MARK not in text:
+            return text, []
+        parts = text.split(HEADING_MARK)
+        if self.strategy != "section":
+            return "".join(parts), []
+
+        starts, position = [], len(parts[0])
+        for index, part in enumerate(parts[1:], 1):
+            # a heading without text stays with the next section
+            if index == 1 or "\n" in parts[index - 1].strip():
+                starts.append(position)
+            position += len(part)
+        return "".join(parts), starts
+
+    def ranges(self, text: str, offsets: list, sections: list = ()):
+        """
+        Split the tokens of a text into chunks along its sentences
+
+        Args:
+            text (str): text of the article, without heading marks
+            offsets (list): (start, end) characters of each token of the text
+            sections (list, optional): offsets of the sections of the text,
+                as given by `sections`. Defaults to ().
+
+        Returns:
+            list: the (start, end) tokens of each chunk
+        """
+
+        size = len(offsets)
+        if not size:
+            return [(0, 0)]
+
+        starts = [start for start, _ in offsets]
+        headings = sorted(
+            {bisect.bisect_left(starts, offset) for offset in sections} - {0, size}
+        )
+        sentences = {
+            bisect.bisect_left(starts, match.end())
+            for match in SENTENCE_END.finditer(text)
+        }
+        # a heading stays with the first sentences of its section
+        titles = {
+            bisect.bisect_left(starts, text.find("\n", offset) + 1)
+            for offset in sections
+        }
+        sentences = (sentences - titles - {0, size}).union(headings)
+        breaks = sorted(sentences)
+
+        chunks, begin = [], 0
+        while begin < size:
+            heading = bisect.bisect_right(headings, begin)
+            stop = headings[heading] if heading < len(headings) else size
+            if stop - begin <= self.max_length:
+                end = stop
+            else:
+                fit = bisect.bisect_right(breaks, begin + self.max_length) - 1
+                end = breaks[fit] if fit >= 0 and breaks[fit] > begin else None
+                end = end or begin + self.max_length
+            chunks.append((begin, end))
+
+            if not self.stride or end == stop:
+                begin = end
+            elif end not in sentences:
+                # a sentence longer than a chunk, cut like a fixed window
+                begin = end - self.stride
+            else:
+                overlap = bisect.bisect_left(breaks, end - self.stride)
+                begin = breaks[overlap] if breaks[overlap] > begin else end
+        return chunks
+
+    def count(self, articles: int, tokens: int, lengths: list):
+        """
+        Count the chunks of articles
+
+        Args:
+            articles (int): number of articles
+            tokens (int): number of tokens of the articles
+            lengths (list): number of tokens of each of their chunks
+        """
+
+        self.stats["articles"] += articles
+        self.stats["chunks"] += len(lengths)
+        self.stats["tokens"] += sum(lengths)
+        self.stats["overlap"] += sum(lengths) - tokens
@@ -1,7 +1,22 @@
+import collections
+import concurrent.futures
+import functools
+import hashlib
 import html
+import itertools
+import json
+import os
 import re
+import signal
+import threading
+import time
 from html.entities import name2codepoint
 
+try:
+    import re2
+except ImportError:
+    re2 = None
+
 # fmt: off
 discardElements = [
     'gallery', 'timeline', 'noinclude', 'pre',
@@ -31,6 +46,9 @@ LATIN_MAPPING = {
 
 acceptedNamespaces = ["w", "wiktionary", "wikt"]
 
+# Version of the cleaning rules, to bump whenever they change the cleaned text
+CLEANER_VERSION = 1
+
 EXT_LINK_URL_CLASS = r'[^][<>"\x00-\x20\x7F\s]'
 ExtLinkBracketedRegex = re.compile(
     "(?i)\[(("
@@ -97,6 +115,69 @@ selfClosing_tag_patterns = [
 # Match ignored tags
 ignored_tag_patterns = []
 
+# Match category links
+category = re.compile(r"\[\[Category:(.*?)\]\]")
+
+# Match HTML entities and character references
+entity = re.compile(r"&#?(\w+);")
+
+# Match section headings
+heading = re.compile(r"\s*=+\s*([^=]*)\s*=+\s*")
+
+# Start of the heading lines kept by the cleaner, a character of the private use area
+HEADING_MARK = "\ue000"
+
+# Match punctuation to glue to the preceding or following word
+space_before_punctuation = re.compile(r" (,:\.\)\]»)")
+space_after_punctuation = re.compile(r"(\[\(«) ")
+
+# Match parentheses left empty or holding only punctuation
+empty_parentheses = re.compile(r"\(\s*[^\w\s]*\s*\)")
+
+# Match lines with only punctuations
+punctuation_line = re.compile(r"\n\W+?\n", re.U)
+
+# Match list items starting with punctuation, or empty
+punctuation_item = re.compile(r"\*\s*[^\w\s].*\n|\*\s*\n")
+
+# Match opening and closing tags of each discarded element
+discard_element_patterns = [
+    (
+        tag,
+        re.compile(r"<\s*%s\b[^>/]*>" % tag, re.IGNORECASE),
+        re.compile(r"<\s*/\s*%s>" % tag, re.IGNORECASE),
+    )
+    for tag in discardElements
+]
+
+# Match the start of an opening tag of any discarded element, without consuming
+# it so that tags nested in another tag's attributes are found as well
+discard_element_opening = re.compile(
+    r"<(?=\s*(%s)\b[^>/]*>)" % "|".join(discardElements), re.IGNORECASE
+)
+
+# Match the characters latinize replaces
+latin_characters = re.compile("[%s]" % "".join(LATIN_MAPPING))
+
+# Match any tag, for the fallback cleaning
+any_tag = re.compile(r"<[^<>]*>")
+
+# Match internal links without nested links, for the fallback cleaning
+simple_internal_link = re.compile(r"\[\[([^\[\]]*)\]\]")
+
+# Match the url of external links, for the fallback cleaning
+simple_external_url = re.compile(r"\[\w+:[^\s\[\]]*")
+
+# Match runs of quotes and brackets left by the fallback cleaning
+simple_markup = re.compile(r"'{2,}|[\[\]]")
+
+# Python's \w and \s are Unicode aware, while RE2's only match ASCII characters
+RE2_CLASSES = {
+    r"\w": r"\p{L}\p{N}_",
+    r"\s": r"\s\x{0b}\x{1c}-\x{1f}\x{85}\x{a0}\x{1680}\x{2000}-\x{200a}"
+    r"\x{2028}\x{2029}\x{202f}\x{205f}\x{3000}",
+}
+
 
 class MagicWords:
 
@@ -140,28 +221,52 @@ def makeExternalImage(url, alt=""):
     return alt
 
 
-def dropSpans(spans, text):
+def applyEdits(text, edits):
     """
-    Drop from text the blocks identified in :param spans:, possibly nested.
+    Build text with the :param edits: applied, joining the pieces only once.
+    :param edits: list of (start, end, replacement) of the blocks of text to
+    replace, possibly nested: a block starting inside a previous one is
+    dropped together with it.
     """
-    spans.sort()
-    res = ""
+    edits.sort(key=lambda edit: edit[:2])
+    res = []
     offset = 0
-    for s, e in spans:
+    for s, e, replacement in edits:
         if offset <= s:  # handle nesting
             if offset < s:
-                res += text[offset:s]
+                res.append(text[offset:s])
+            if replacement:
+                res.append(replacement)
             offset = e
-    res += text[offset:]
-    return res
+    res.append(text[offset:])
+    return "".join(res)
+
+
+def dropSpans(spans, text):
+    """
+    Drop from text the blocks identified in :param spans:, possibly nested.
+    """
+    return applyEdits(text, [(s, e, "") for s, e in spans])
+
+
+@functools.lru_cache(maxsize=None)
+def compileNested(delim):
+    """
+    Compile a delimiter of dropNested once.
+    """
+    return re.compile(delim, re.IGNORECASE)
 
 
 def dropNested(text, openDelim, closeDelim):
     """
     A matching function for nested expressions, e.g. namespaces and tables.
+    :param openDelim: pattern (or compiled pattern) of the opening delimiter.
+    :param closeDelim: pattern (or compiled pattern) of the closing delimiter.
     """
-    openRE = re.compile(openDelim, re.IGNORECASE)
-    closeRE = re.compile(closeDelim, re.IGNORECASE)
+    openRE = openDelim if isinstance(openDelim, re.Pattern) else compileNested(openDelim)
+    closeRE = (
+        closeDelim if isinstance(closeDelim, re.Pattern) else compileNested(closeDelim)
+    )
     # partition text in separate blocks { } { }
     spans = []  # pairs (s, e) for each partition
     nest = 0  # nesting level
@@ -209,12 +314,34 @@ def dropNested(text, openDelim, closeDelim):
     return dropSpans(spans, text)
 
 
-def replaceExternalLinks(text):
-    s = ""
-    cur = 0
-    for m in ExtLinkBracketedRegex.finditer(text):
-        s += text[cur : m.start()]
-        cur = m.end()
+def dropDiscardElements(
+    text, patterns=discard_element_patterns, opening=discard_element_opening
+):
+    """
+    Drop the (possibly nested) discarded elements from text.
+    A single scan finds which of the discarded elements occur, and only those
+    go through dropNested, in the order of :data discardElements:. The scan is
+    repeated after a drop, since joining the text around a dropped element can
+    form a new tag. This gives the same result as calling dropNested for every
+    element.
+    :param patterns: (tag, openRE, closeRE) of each discarded element.
+    :param opening: pattern matching the start of any opening tag, capturing its name.
+    """
+    present = {m.group(1).lower() for m in opening.finditer(text)}
+    for tag, openRE, closeRE in patterns:
+        if tag not in present:
+            continue
+        dropped = dropNested(text, openRE, closeRE)
+        if len(dropped) != len(text):
+            text = dropped
+            present = {m.group(1).lower() for m in opening.finditer(text)}
+    return text
+
+
+def replaceExternalLinks(text, pattern=ExtLinkBracketedRegex):
+    edits = []
+    for m in pattern.finditer(text):
+        start, end = m.span()
 
         url = m.group(1)
         label = m.group(3)
@@ -237,9 +364,9 @@ def replaceExternalLinks(text):
         # This means that users can paste URLs directly into the text
         # Funny characters like ö aren't valid in URLs anyway
         # This was changed in August 2004
-        s += makeExternalLink(url, label)  # + trail
+        edits.append((start, end, makeExternalLink(url, label)))  # + trail
 
-    return s + text[cur:]
+    return applyEdits(text, edits)
 
 
 def replaceInternalLinks(text):
@@ -251,8 +378,7 @@ def replaceInternalLinks(text):
     """
     # call this after removal of external links, so we need not worry about
     # triple closing ]]].
-    cur = 0
-    res = ""
+    edits = []
     for s, e in findBalanced(text, ["[["], ["]]"]):
         m = tailRE.match(text, e)
         if m:
@@ -277,9 +403,8 @@ def replaceInternalLinks(text):
                     pipe = last  # advance
                 curp = e1
             label = inner[pipe + 1 :].strip()
-        res += text[cur:s] + makeInternalLink(title, label) + trail
-        cur = end
-    return res + text[cur:]
+        edits.append((s, end, makeInternalLink(title, label) + trail))
+    return applyEdits(text, edits)
 
 
 def findBalanced(text, openDelim, closeDelim):
@@ -290,18 +415,12 @@ def findBalanced(text, openDelim, closeDelim):
     :return: an iterator producing pairs (start, end) of start and end
     positions in text containing a balanced expression.
     """
-    openPat = "|".join([re.escape(x) for x in openDelim])
-    # patter for delimiters expected after each opening delimiter
-    afterPat = {
-        o: re.compile(openPat + "|" + c, re.DOTALL)
-        for o, c in zip(openDelim, closeDelim)
-    }
+    startPat, afterPat = compileBalanced(tuple(openDelim), tuple(closeDelim))
     stack = []
     start = 0
     cur = 0
     # end = len(text)
     startSet = False
-    startPat = re.compile(openPat)
     nextPat = startPat
     while True:
         next = nextPat.search(text, cur)
@@ -327,6 +446,22 @@ def findBalanced(text, openDelim, closeDelim):
         cur = next.end()
 
 
+@functools.lru_cache(maxsize=None)
+def compileBalanced(openDelim, closeDelim):
+    """
+    Compile the patterns of findBalanced once per set of delimiters.
+    :return: the pattern of opening delimiters, and for each opening delimiter
+    the pattern of the delimiters expected after it.
+    """
+    openPat = "|".join([re.escape(x) for x in openDelim])
+    # patter for delimiters expected after each opening delimiter
+    afterPat = {
+        o: re.compile(openPat + "|" + c, re.DOTALL)
+        for o, c in zip(openDelim, closeDelim)
+    }
+    return re.compile(openPat), afterPat
+
+
 def makeInternalLink(title, label):
     colon = title.find(":")
     if colon > 0 and title[:colon] not in acceptedNamespaces:
@@ -362,7 +497,68 @@ def unescape(text):
         except:
             return text  # leave as is
 
-    return re.sub("&#?(\w+);", fixup, text)
+    return entity.sub(fixup, text)
+
+
+def re2Compile(pattern):
+    """
+    Compile with RE2 a Python pattern, to match it in linear time.
+    Character classes are spelled out to keep their Unicode meaning, so the
+    pattern matches the same text as with re.
+    :param pattern: the compiled Python pattern.
+    """
+    if re2 is None:
+        raise ImportError("The re2 regex backend requires the google-re2 package")
+    flags = "".join(
+        flag
+        for bit, flag in ((re.IGNORECASE, "i"), (re.MULTILINE, "m"), (re.DOTALL, "s"))
+        if pattern.flags & bit
+    )
+    res = ["(?%s)" % flags] if flags else []
+    inClass = first = False
+    for token in re.findall(r"\\.|.", pattern.pattern, re.DOTALL):
+        if inClass:
+            if token == "]" and not first:
+                inClass = False
+            # a ] right after [ or [^ is a literal
+            first = token == "^" and res[-1] == "["
+        elif token == "[":
+            inClass = first = True
+        if token in RE2_CLASSES:
+            token = RE2_CLASSES[token] if inClass else "[%s]" % RE2_CLASSES[token]
+        elif token.lower() in RE2_CLASSES:
+            if inClass:
+                raise ValueError("Negated class %s inside a set: %s" % (token, pattern))
+            token = "[^%s]" % RE2_CLASSES[token.lower()]
+        res.append(token)
+    return re2.compile("".join(res))
+
+
+def stripMarkup(text):
+    """
+    Cheap cleaning of wiki markup, in linear time, for the documents the full
+    cleaning would take too long on: templates, tags, link targets and quotes
+    are dropped, without any of the finer rules.
+    :param text: the wiki markup.
+    :return: the plain text.
+    """
+    text = dropNested(text, compileNested(r"{{"), compileNested(r"}}"))
+    text = any_tag.sub("", text)
+    text = simple_internal_link.sub(lambda m: m.group(1).rsplit("|", 1)[-1], text)
+    text = simple_external_url.sub("", text)
+    text = simple_markup.sub("", unescape(text))
+    text = spaces.sub(" ", text.replace("\t", " ")).split("\n")
+    return "\n".join([line.strip() for line in text if line.strip()])
+
+
+class CleanBudgetExceeded(Exception):
+    """
+    Raised when cleaning a document takes longer than its time budget.
+    """
+
+
+def _budgetExceeded(signum, frame):
+    raise CleanBudgetExceeded()
 
 
 def latinize(input_str):
@@ -371,7 +567,354 @@ def latinize(input_str):
     :param input_str: the string to convert.
     :return: the converted string.
     """
-    return "".join([LATIN_MAPPING.get(c, c) for c in input_str])
+    if input_str.isascii():
+        return input_str
+    return latin_characters.sub(lambda m: LATIN_MAPPING[m.group()], input_str)
+
+
+class WikiCleaner:
+    """
+    Transforms wiki markup into plain text through a pipeline of stages.
+
+    Every pattern is compiled once, when the cleaner is built, and stages that
+    are not needed can be disabled so that they cost nothing per document,
+    e.g. latinize for wikis not written in the Latin script.
+
+    Args:
+        disable (tuple, optional): names of the stages to skip. Defaults to ().
+        html_safe (bool, optional): whether the text is left with reserved HTML
+            characters unescaped. Defaults to True.
+        discard_elements (list, optional): HTML elements dropped with their
+            content. Defaults to discardElements.
+        placeholder_tags (dict, optional): tags replaced by numbered
+            placeholders. Defaults to placeholder_tags.
+        time_budget (float, optional): seconds a document may take to clean.
+            Defaults to None, for no limit.
+        max_chars (int, optional): length over which a document is not fully
+            cleaned. Defaults to None, for no limit.
+        fallback (callable, optional): cleaning of the documents over budget.
+            Defaults to stripMarkup.
+        quarantine (str, optional): path of a JSONL file logging the documents
+            over budget, with their id and the slow stage. Defaults to None.
+        regex_backend (str, optional): "re", or "re2" to match the patterns
+            prone to backtracking in linear time, with the google-re2 package.
+            Defaults to "re".
+        headings (bool, optional): whether section headings are kept as lines
+            starting with HEADING_MARK, e.g. for chunking by section, instead
+            of being dropped. Defaults to False.
+
+    Documents over budget go through the fallback instead. In the main thread,
+    a stage running over the time budget is interrupted by SIGALRM; elsewhere,
+    the budget is only checked between stages.
+
+    Raises:
+        ValueError: if an unknown stage is disabled, or an unknown regex backend
+            is given
+
+    Examples:
+        >>> cleaner = WikiCleaner(disable=("latinize", "placeholders"))
+        >>> cleaner.clean("'''Zürich''' is the largest city in [[Switzerland]].")
+        'Zürich is the largest city in Switzerland.'
+    """
+
+    STAGES = (
+        "categories",
+        "templates",
+        "tables",
+        "external_links",
+        "internal_links",
+        "magic_words",
+        "html",
+        "bold_italic",
+        "tags",
+        "discard_elements",
+        "unescape",
+        "placeholders",
+        "cleanup",
+        "latinize",
+    )
+
+    def __init__(
+        self,
+        disable=(),
+        html_safe=True,
+        discard_elements=discardElements,
+        placeholder_tags=placeholder_tags,
+        time_budget=None,
+        max_chars=None,
+        fallback=stripMarkup,
+        quarantine=None,
+        regex_backend="re",
+        headings=False,
+    ):
+        unknown = set(disable) - set(self.STAGES)
+        if unknown:
+            raise ValueError(f"Unknown cleaning stages: {', '.join(sorted(unknown))}")
+        if regex_backend not in ("re", "re2"):
+            raise ValueError(f"Unknown regex backend: {regex_backend}")
+
+        self.html_safe = html_safe
+        self.time_budget = time_budget
+        self.max_chars = max_chars
+        self.fallback = fallback
+        self.quarantine = quarantine
+        self.fallbacks = 0
+        self.latinize = "latinize" not in disable
+        self.headings = headings
+        options = (
+            sorted(disable),
+            html_safe,
+            list(discard_elements),
+            sorted(placeholder_tags.items()),
+            regex_backend,
+        )
+        if headings:
+            options += ("headings",)
+        # identifies the cleaned text produced, e.g. to key a cache of it
+        self.version = "%d-%s" % (
+            CLEANER_VERSION,
+            hashlib.sha1(repr(options).encode("utf-8")).hexdigest()[:12],
+        )
+        # patterns prone to backtracking on malformed markup
+        compile = re2Compile if regex_backend == "re2" else lambda pattern: pattern
+        self.ext_link = compile(ExtLinkBracketedRegex)
+        self.category = compile(category)
+        self.quotes = [
+            (compile(bold_italic), r"\1"),
+            (compile(bold), r"\1"),
+            (compile(italic_quote), r'"\1"'),
+            (compile(italic), r'"\1"'),
+            (compile(quote_quote), r'"\1"'),
+        ]
+        self.heading = compile(heading)
+        self.empty_parentheses = compile(empty_parentheses)
+        self.punctuation_line = compile(punctuation_line)
+        self.punctuation_item = compile(punctuation_item)
+        self.templates = (compileNested(r"{{"), compileNested(r"}}"))
+        self.tables = (compileNested(r"{\|"), compileNested(r"\|}"))
+        self.discard_element_patterns = [
+            (
+                tag,
+                re.compile(r"<\s*%s\b[^>/]*>" % tag, re.IGNORECASE),
+                re.compile(r"<\s*/\s*%s>" % tag, re.IGNORECASE),
+            )
+            for tag in discard_elements
+        ]
+        self.discard_element_opening = re.compile(
+            r"<(?=\s*(%s)\b[^>/]*>)" % "|".join(discard_elements), re.IGNORECASE
+        )
+        self.placeholder_tag_patterns = [
+            (
+                re.compile(
+                    r"<\s*%s(\s*| [^>]+?)>.*?<\s*/\s*%s\s*>" % (tag, tag),
+                    re.DOTALL | re.IGNORECASE,
+                ),
+                repl,
+            )
+            for tag, repl in placeholder_tags.items()
+        ]
+        self.stages = [
+            (name, getattr(self, "_" + name))
+            for name in self.STAGES
+            if name not in disable
+        ]
+
+    def clean(self, text, doc_id=None):
+        """
+        Run text through the enabled stages, or the fallback when over budget.
+        :param text: the wiki markup to clean.
+        :param doc_id: the id of the document, logged in the quarantine file.
+        :return: the cleaned text.
+        """
+        if self.max_chars is not None and len(text) > self.max_chars:
+            return self._quarantine(text, doc_id, None, "size", 0.0)
+        if self.time_budget is None:
+            for _, stage in self.stages:
+                text = stage(text)
+            return text
+
+        alarm = (
+            hasattr(signal, "setitimer")
+            and threading.current_thread() is threading.main_thread()
+        )
+        if alarm:
+            previous = signal.signal(signal.SIGALRM, _budgetExceeded)
+            signal.setitimer(signal.ITIMER_REAL, self.time_budget)
+        start = time.perf_counter()
+        source = text
+        name = None
+        try:
+            for name, stage in self.stages:
+                text = stage(text)
+                if time.perf_counter() - start > self.time_budget:
+                    raise CleanBudgetExceeded()
+            if alarm:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+        except CleanBudgetExceeded:
+            return self._quarantine(
+                source, doc_id, name, "time", time.perf_counter() - start
+            )
+        finally:
+            if alarm:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+                signal.signal(
+                    signal.SIGALRM, signal.SIG_DFL if previous is None else previous
+                )
+        return text
+
+    def normalize(self, text):
+        """
+        Light normalization of text that is already plain, e.g. rendered by
+        MediaWiki: spaces and blank lines are collapsed, and the text is
+        escaped and latinized as by clean.
+        :param text: the plain text.
+        :return: the normalized text.
+        """
+        text = spaces.sub(" ", text.replace("\t", " "))
+        if not self.html_safe:
+            text = html.escape(text, quote=False)
+        text = "\n".join([line.strip() for line in text.split("\n") if line.strip()])
+        return latinize(text) if self.latinize else text
+
+    def _quarantine(self, text, doc_id, stage, reason, seconds):
+        """
+        Log a document over budget and clean it with the fallback.
+        """
+        self.fallbacks += 1
+        if self.quarantine is not None:
+            with open(self.quarantine, "a", encoding="utf-8") as quarantine_f:
+                record = {
+                    "id": doc_id,
+                    "reason": reason,
+                    "stage": stage,
+                    "seconds": round(seconds, 3),
+                    "chars": len(text),
+                }
+                quarantine_f.write(json.dumps(record) + "\n")
+        return self.fallback(text)
+
+    def _categories(self, text):
+        return self.category.sub(r"\1", text)
+
+    def _templates(self, text):
+        return dropNested(text, *self.templates)
+
+    def _tables(self, text):
+        return dropNested(text, *self.tables)
+
+    def _external_links(self, text):
+        return replaceExternalLinks(text, self.ext_link)
+
+    def _internal_links(self, text):
+        return replaceInternalLinks(text)
+
+    def _magic_words(self, text):
+        # drop MagicWords behavioral switches
+        return magicWordsRE.sub("", text)
+
+    def _html(self, text):
+        # turn into HTML, except for the content of <syntaxhighlight>
+        res = []
+        cur = 0
+        for m in syntaxhighlight.finditer(text):
+            res.append(unescape(text[cur : m.start()]))
+            res.append(m.group(1))
+            cur = m.end()
+        res.append(unescape(text[cur:]))
+        return "".join(res)
+
+    def _bold_italic(self, text):
+        # Handle bold/italic/quote
+        for pattern, repl in self.quotes:
+            text = pattern.sub(repl, text)
+        # residuals of unbalanced quotes
+        return text.replace("'''", "").replace("''", '"')
+
+    def _tags(self, text):
+        spans = []
+        # Drop HTML comments
+        for m in comment.finditer(text):
+            spans.append((m.start(), m.end()))
+
+        # Drop self-closing tags
+        for pattern in selfClosing_tag_patterns:
+            for m in pattern.finditer(text):
+                spans.append((m.start(), m.end()))
+
+        # Drop ignored tags
+        for left, right in ignored_tag_patterns:
+            for m in left.finditer(text):
+                spans.append((m.start(), m.end()))
+            for m in right.finditer(text):
+                spans.append((m.start(), m.end()))
+
+        # Bulk remove all spans
+        return dropSpans(spans, text)
+
+    def _discard_elements(self, text):
+        return dropDiscardElements(
+            text, self.discard_element_patterns, self.discard_element_opening
+        )
+
+    def _unescape(self, text):
+        return unescape(text)
+
+    def _placeholders(self, text):
+        # Expand placeholders. A repeated block takes the number of its first
+        # match, and a block ending with an earlier one (after an unclosed tag)
+        # only has that ending replaced, with the number of the earlier block.
+        for pattern, placeholder in self.placeholder_tag_patterns:
+            edits = []
+            numbers = {}
+            for index, match in enumerate(pattern.finditer(text), 1):
+                block = match.group()
+                cut, number = 0, numbers.setdefault(block, index)
+                tag = block.find("<", 1)
+                while tag > 0:
+                    earlier = numbers.get(block[tag:], number)
+                    if earlier < number:
+                        cut, number = tag, earlier
+                    tag = block.find("<", tag + 1)
+                edits.append(
+                    (match.start() + cut, match.end(), "%s_%d" % (placeholder, number))
+                )
+            if edits:
+                text = applyEdits(text, edits)
+        return text
+
+    def _cleanup(self, text):
+        text = text.replace("<<", "«").replace(">>", "»")
+        text = text.replace("\t", " ")
+        if self.headings:
+            # a function, as re2 mangles non-ASCII replacement strings
+            text = self.heading.sub(
+                lambda match: "\n" + HEADING_MARK + match.group(1) + "\n", text
+            )
+        else:
+            text = self.heading.sub("\n", text)
+        text = spaces.sub(" ", text)
+        text = dots.sub("...", text)
+        text = space_before_punctuation.sub(r"\1", text)
+        text = space_after_punctuation.sub(r"\1", text)
+        text = self.empty_parentheses.sub("", text)
+        text = self.punctuation_line.sub("\n", text)
+        text = text.replace(",,", ",").replace(",.", ".")
+        text = self.punctuation_item.sub("", text)
+        if not self.html_safe:
+            text = html.escape(text, quote=False)
+        text = text.split("\n")
+        return "\n".join([line.strip() for line in text if line.strip()])
+
+    def _latinize(self, text):
+        return latinize(text)
+
+
+@functools.lru_cache(maxsize=None)
+def defaultCleaner(html_safe=True):
+    """
+    The cleaner with all stages enabled, shared by calls to clean.
+    """
+    return WikiCleaner(html_safe=html_safe)
 
 
 def clean(text, expand_templates=False, html_safe=True):
@@ -384,98 +927,107 @@ def clean(text, expand_templates=False, html_safe=True):
     :param html_safe: whether to convert reserved HTML characters to entities.
     @return: the cleaned text.
     """
-    text = re.sub(r"\[\[Category:(.*?)\]\]", r"\1", text)
+    return defaultCleaner(html_safe).clean(text)
 
-    text = dropNested(text, r"{{", r"}}")
 
-    # Drop tables
-    text = dropNested(text, r"{\|", r"\|}")
+class CleanError(Exception):
+    """
+    Error raised while cleaning a document of a batch.
+    :param doc_id: the id of the document.
+    :param message: the error, as raised by the worker.
+    """
 
-    # replace external links
-    text = replaceExternalLinks(text)
+    def __init__(self, doc_id, message):
+        super().__init__(doc_id, message)
+        self.doc_id = doc_id
+        self.message = message
 
-    # replace internal links
-    text = replaceInternalLinks(text)
+    def __str__(self):
+        return f"Error while cleaning document {self.doc_id}: {self.message}"
 
-    # drop MagicWords behavioral switches
-    text = magicWordsRE.sub("", text)
 
-    # ############### Process HTML ###############
+_workerCleaner = None
 
-    # turn into HTML, except for the content of <syntaxhighlight>
-    res = ""
-    cur = 0
-    for m in syntaxhighlight.finditer(text):
-        end = m.end()
-        res += unescape(text[cur : m.start()]) + m.group(1)
-        cur = end
-    text = res + unescape(text[cur:])
-
-    # Handle bold/italic/quote
-    text = bold_italic.sub(r"\1", text)
-    text = bold.sub(r"\1", text)
-    text = italic_quote.sub(r'"\1"', text)
-    text = italic.sub(r'"\1"', text)
-    text = quote_quote.sub(r'"\1"', text)
-    # residuals of unbalanced quotes
-    text = text.replace("'''", "").replace("''", '"')
-
-    # Collect spans
-
-    spans = []
-    # Drop HTML comments
-    for m in comment.finditer(text):
-        spans.append((m.start(), m.end()))
-
-    # Drop self-closing tags
-    for pattern in selfClosing_tag_patterns:
-        for m in pattern.finditer(text):
-            spans.append((m.start(), m.end()))
 
-    # Drop ignored tags
-    for left, right in ignored_tag_patterns:
-        for m in left.finditer(text):
-            spans.append((m.start(), m.end()))
-        for m in right.finditer(text):
-            spans.append((m.start(), m.end()))
+def _initCleanWorker(cleaner):
+    global _workerCleaner
+    _workerCleaner = cleaner
 
-    # Bulk remove all spans
-    text = dropSpans(spans, text)
-
-    # Drop discarded elements
-    for tag in discardElements:
-        text = dropNested(text, r"<\s*%s\b[^>/]*>" % tag, r"<\s*/\s*%s>" % tag)
-
-    text = unescape(text)
-
-    # Expand placeholders
-    for pattern, placeholder in placeholder_tag_patterns:
-        index = 1
-        for match in pattern.finditer(text):
-            text = text.replace(match.group(), "%s_%d" % (placeholder, index))
-            index += 1
-
-    text = text.replace("<<", "«").replace(">>", "»")
-
-    #############################################
-
-    # Cleanup text
-    text = text.replace("\t", " ")
-    text = re.sub(r"\s*=+\s*([^=]*)\s*=+\s*", "\n", text)
-    text = spaces.sub(" ", text)
-    text = dots.sub("...", text)
-    text = re.sub(" (,:\.\)\]»)", r"\1", text)
-    text = re.sub("(\[\(«) ", r"\1", text)
-    text = re.sub(r"\(\s*[^\w\s]*\s*\)", "", text)
-    text = re.sub(r"\n\W+?\n", "\n", text, flags=re.U)  # lines with only punctuations
-    text = text.replace(",,", ",").replace(",.", ".")
-    text = re.sub(r"\*\s*[^\w\s].*\n|\*\s*\n", "", text)
-    if not html_safe:
-        text = html.escape(text, quote=False)
-    text = text.split("\n")
-    text = "\n".join([line.strip() for line in text if line.strip()])
-    text = latinize(text)
-    return text
+
+def _cleanChunk(chunk, cleaner=None):
+    """
+    Clean a chunk of (doc_id, text) documents, in a worker of iter_clean.
+    """
+    cleaner = cleaner or _workerCleaner or defaultCleaner()
+    res = []
+    for doc_id, text in chunk:
+        try:
+            res.append(cleaner.clean(text, doc_id))
+        except Exception as e:
+            raise CleanError(doc_id, repr(e)) from e
+    return res
+
+
+def _cleanChunks(texts, ids, chunk_chars):
+    """
+    Group documents into chunks of about :param chunk_chars: characters, so
+    that a long article fills a chunk on its own instead of delaying many
+    short ones.
+    """
+    ids = itertools.count() if ids is None else ids
+    chunk = []
+    size = 0
+    for doc_id, text in zip(ids, texts):
+        chunk.append((doc_id, text))
+        size += len(text or "")
+        if size >= chunk_chars:
+            yield chunk
+            chunk = []
+            size = 0
+    if chunk:
+        yield chunk
+
+
+def iter_clean(texts, workers=None, cleaner=None, ids=None, chunk_chars=1 << 20):
+    """
+    Clean documents over a pool of processes, yielding the cleaned texts in the
+    order of :param texts:. Documents are sent to the workers in chunks, and at
+    most two chunks per worker are pending, so texts can be a stream.
+    :param texts: iterable of the wiki markups to clean.
+    :param workers: number of processes. Defaults to the number of CPUs; with
+    a single worker, documents are cleaned in this process.
+    :param cleaner: the WikiCleaner to use. Defaults to defaultCleaner().
+    :param ids: iterable of the ids of the documents, reported by CleanError.
+    Defaults to their position in texts.
+    :param chunk_chars: number of characters of the documents of a chunk.
+    :raise CleanError: when a document cannot be cleaned.
+    """
+    workers = workers or os.cpu_count() or 1
+    chunks = _cleanChunks(texts, ids, chunk_chars)
+    if workers == 1:
+        for chunk in chunks:
+            yield from _cleanChunk(chunk, cleaner or defaultCleaner())
+        return
+
+    with concurrent.futures.ProcessPoolExecutor(
+        workers, initializer=_initCleanWorker, initargs=(cleaner,)
+    ) as executor:
+        pending = collections.deque()
+        for chunk in chunks:
+            pending.append(executor.submit(_cleanChunk, chunk))
+            if len(pending) >= 2 * workers:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+def clean_batch(texts, workers=None, cleaner=None, ids=None, chunk_chars=1 << 20):
+    """
+    Clean a batch of documents over a pool of processes.
+    @see iter_clean
+    :return: the list of the cleaned texts, in the order of :param texts:.
+    """
+    return list(iter_clean(texts, workers, cleaner, ids, chunk_chars))
 
 
 def ucfirst(string):
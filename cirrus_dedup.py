@@ -0,0 +1,267 @@
+"""
+Detection of near-duplicate chunks by MinHash signatures and LSH banding, to keep
+boilerplate (stubs, lists, chunks differing only by their title) out of the index.
+"""
+
+import re
+import zlib
+from typing import Optional
+
+from cirrus_imports import LazyModule
+
+numpy = LazyModule("numpy", optional=True)
+
+# Ways to handle near-duplicate chunks: leave them out, or mark them with "duplicate_of"
+DEDUP_MODES = ("drop", "mark")
+
+# Words of the content of a chunk, lowercased
+WORD = re.compile(r"\w+")
+
+# Odd multiplier of the rolling hash of the shingles
+SHINGLE_MULTIPLIER = 0x9E3779B97F4A7C15
+
+
+def lsh_bands(threshold: float, num_perm: int):
+    """
+    Split the signatures into bands, so that chunks as similar as the threshold
+    share a band about as likely as not
+
+    Two chunks of similarity s share a band of r rows out of b with probability
+    1 - (1 - s^r)^b, whose steepest point is at about (1 / b)^(1 / r).
+
+    Returns:
+        tuple: number of bands and of rows per band, with bands * rows <= num_perm
+    """
+
+    return min(
+        ((bands, num_perm // bands) for bands in range(1, num_perm + 1)),
+        key=lambda param: abs((1 / param[0]) ** (1 / param[1]) - threshold),
+    )
+
+
+class ChunkDeduplicator:
+    """
+    Detector of the chunks that are near-duplicates of an earlier chunk
+
+    The content of a chunk (or its token ids) is split into shingles of
+    `shingle_size` consecutive words, and summarized by a MinHash signature of
+    `num_perm` hashes, whose share of equal hashes between two chunks estimates
+    the Jaccard similarity of their shingles. Signatures are split into bands,
+    indexed in a hash table: chunks sharing a band are candidates, and a chunk
+    is a duplicate of the first candidate whose signature is at least
+    `threshold` similar. Chunks without words are never duplicates.
+
+    Each bucket of the hash table keeps the last `bucket_size` chunks of its
+    band only, so a chunk sharing a band with many earlier chunks (boilerplate
+    that is similar, but not enough to be duplicates) may miss the older ones
+    in that band: it is then a duplicate only if another band finds them.
+
+    Signatures are kept in a ring of `max_signatures` slots allocated on first
+    use, so that memory stays bounded (about 2 KB per slot with the defaults):
+    past it, the oldest chunks are forgotten, and later duplicates of them are
+    kept. The numbers of chunks, duplicates and forgotten chunks are counted in
+    `stats`.
+
+    Args:
+        threshold (float, optional): similarity over which a chunk is a
+            near-duplicate. Defaults to 0.9.
+        num_perm (int, optional): hashes per signature. Defaults to 128.
+        shingle_size (int, optional): words (or token ids) per shingle.
+            Defaults to 5.
+        max_signatures (int, optional): signatures kept. Defaults to 1_000_000.
+        bucket_size (int, optional): chunks kept per bucket of the hash table.
+            Defaults to 8.
+        mode (str, optional): "drop" to leave duplicates out, or "mark" to keep
+            them with the name of the chunk they duplicate as "duplicate_of".
+            Defaults to "drop".
+        seed (int, optional): seed of the hash functions. Defaults to 1.
+
+    Raises:
+        ValueError: if the mode is unknown, or the threshold is not in (0, 1]
+        ImportError: if the numpy package is missing
+
+    Examples:
+        >>> deduplicator = ChunkDeduplicator(threshold=0.8)
+        >>> chunks = list(deduplicator.filter(preprocess.tokenize_content(article)))
+        >>> deduplicator.stats
+        {'chunks': 3, 'duplicates': 1, 'forgotten': 0}
+    """
+
+    def __init__(
+        self,
+        threshold: float = 0.9,
+        num_perm: int = 128,
+        shingle_size: int = 5,
+        max_signatures: int = 1_000_000,
+        bucket_size: int = 8,
+        mode: str = "drop",
+        seed: int = 1,
+    ):
+        """
+        Initialize ChunkDeduplicator
+        """
+
+        if mode not in DEDUP_MODES:
+            raise ValueError(f"Unknown dedup mode: {mode}")
+        if not 0 < threshold <= 1:
+            raise ValueError("The dedup threshold must be in (0, 1]")
+        if not numpy:
+            raise ImportError("Near-duplicate detection requires the numpy package")
+
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        self.max_signatures = max_signatures
+        self.bucket_size = bucket_size
+        self.mode = mode
+        self.bands, self.rows = lsh_bands(threshold, num_perm)
+
+        state = numpy.random.RandomState(seed)
+        self.multipliers = state.randint(1, 1 << 63, num_perm, dtype="u8") | 1
+        self.increments = state.randint(0, 1 << 63, num_perm, dtype="u8")
+        self.band_multipliers = state.randint(1, 1 << 63, self.rows, dtype="u8") | 1
+        self.reset()
+
+    def reset(self):
+        """
+        Forget every chunk, and reset the counts
+        """
+
+        self.signatures = None
+        self.band_keys = None
+        self.names = None
+        self.buckets = {}
+        self.size = 0
+        self.stats = {"chunks": 0, "duplicates": 0, "forgotten": 0}
+
+    def __getstate__(self):
+        # workers get an empty deduplicator rather than a copy of the signatures
+        state = dict(self.__dict__)
+        state.update(signatures=None, band_keys=None, names=None, buckets={}, size=0)
+        return state
+
+    def signature(self, chunk: dict):
+        """
+        MinHash signature of the shingles of a chunk
+
+        Returns:
+            numpy.ndarray: num_perm hashes, or None for a chunk without words
+        """
+
+        if chunk.get("content") is not None:
+            words = " ".join(WORD.findall(chunk["content"].lower()))
+            tokens = numpy.fromiter(
+                map(zlib.crc32, words.encode("utf-8").split()), dtype="u8"
+            )
+        else:
+            tokens = numpy.asarray(chunk.get("input_ids", ()), dtype="u8")
+        if not len(tokens):
+            return None
+
+        size = min(self.shingle_size, len(tokens))
+        shingles = numpy.zeros(len(tokens) - size + 1, dtype="u8")
+        with numpy.errstate(over="ignore"):
+            for offset in range(size):
+                shingles = (
+                    shingles * numpy.uint64(SHINGLE_MULTIPLIER)
+                    + tokens[offset : len(tokens) - size + 1 + offset]
+                )
+            hashes = (
+                shingles[None, :] * self.multipliers[:, None] + self.increments[:, None]
+            ) >> numpy.uint64(32)
+        return hashes.min(axis=1).astype("u4")
+
+    def _band_keys(self, signature):
+        """
+        Keys of the bands of a signature in the hash table, told apart by the
+        number of their band
+        """
+
+        with numpy.errstate(over="ignore"):
+            keys = (
+                signature[: self.bands * self.rows]
+                .reshape(self.bands, self.rows)
+                .astype("u8")
+                * self.band_multipliers
+            ).sum(axis=1) + numpy.arange(self.bands, dtype="u8")
+        return keys.tolist()
+
+    def check(self, chunk: dict):
+        """
+        Look for an earlier chunk the chunk is a near-duplicate of, and add the
+        chunk to the signatures when there is none
+
+        Returns:
+            str: name of the earlier chunk, or None if the chunk is no duplicate
+        """
+
+        self.stats["chunks"] += 1
+        signature = self.signature(chunk)
+        if signature is None:
+            return None
+
+        keys = self._band_keys(signature)
+        candidates = set()
+        for key in keys:
+            for slot in self.buckets.get(key, ()):
+                if slot in candidates:
+                    continue
+                candidates.add(slot)
+                if (self.signatures[slot] == signature).mean() >= self.threshold:
+                    self.stats["duplicates"] += 1
+                    return self.names[slot]
+
+        self._add(chunk.get("name"), signature, keys)
+        return None
+
+    def _add(self, name: Optional[str], signature, keys: list):
+        """
+        Keep the signature of a chunk, forgetting the oldest one when full
+        """
+
+        if self.signatures is None:
+            self.signatures = numpy.zeros(
+                (self.max_signatures, self.num_perm), dtype="u4"
+            )
+            self.band_keys = [None] * self.max_signatures
+            self.names = [None] * self.max_signatures
+
+        slot = self.size % self.max_signatures
+        if self.size >= self.max_signatures:
+            for key in self.band_keys[slot]:
+                bucket = self.buckets.get(key)
+                if bucket and slot in bucket:
+                    bucket.remove(slot)
+                    if not bucket:
+                        del self.buckets[key]
+            self.stats["forgotten"] += 1
+
+        self.signatures[slot] = signature
+        self.band_keys[slot] = keys
+        self.names[slot] = name
+        for key in keys:
+            bucket = self.buckets.setdefault(key, [])
+            bucket.append(slot)
+            if len(bucket) > self.bucket_size:
+                del bucket[0]
+        self.size += 1
+
+    def filter(self, chunks):
+        """
+        Leave out or mark the chunks that are near-duplicates of earlier ones
+
+        Args:
+            chunks (iterable): chunks, in order
+
+        Yields:
+            dict: the chunks that are no duplicates, and in "mark" mode the
+                duplicates too, with the name of the chunk they duplicate as
+                "duplicate_of"
+        """
+
+        for chunk in chunks:
+            original = self.check(chunk)
+            if original is None:
+                yield chunk
+            elif self.mode == "mark":
+                yield dict(chunk, duplicate_of=original)
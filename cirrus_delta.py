@@ -0,0 +1,176 @@
+"""
+State of the pages of the last processed Cirrus dump, to process the next one as a delta.
+"""
+
+import os
+import shutil
+import sqlite3
+from typing import Optional
+
+
+def chunk_names(title_id: str, chunks: int):
+    """
+    Names of the tokenized chunks of a page
+
+    Args:
+        title_id (str): title of the page as used in chunk names
+        chunks (int): number of chunks of the page
+
+    Returns:
+        list: chunk names, as produced by `CirrusPreprocess.tokenize_content`
+    """
+
+    return [f"{title_id}-part-{split_id}" for split_id in range(chunks)]
+
+
+class PageState:
+    """
+    Version and chunks of every page of the last processed dump, stored in SQLite
+
+    Pages are keyed by their page id. While a new dump is processed, every page
+    met is marked as seen; the pages left unseen at the end were removed. Changes
+    are only persisted by `commit`, so an interrupted run leaves the state of the
+    previous dump untouched.
+
+    With pending, the state is opened on a fresh copy of the database,
+    `<path>.pending`, which only replaces it once `promote` is called, e.g.
+    after the delta is indexed: until then, the next dump is compared against
+    the state of the previous one, and its delta includes the changes of the
+    dump that was never promoted.
+
+    Args:
+        path (str): path of the SQLite database
+        pending (bool, optional): whether to commit to a copy of the database
+            until it is promoted. Defaults to False.
+
+    Examples:
+        >>> state = PageState("data/enwiki-pages.sqlite")
+        >>> state.get("12")
+        (1150, 'Anarchism', 9)
+        >>> state.put("12", 1151, "Anarchism", 10)
+        >>> removed = list(state.removed())
+        >>> state.commit()
+
+        >>> state = PageState("data/enwiki-pages.sqlite", pending=True)
+        >>> state.commit()
+        >>> PageState.promote("data/enwiki-pages.sqlite")
+    """
+
+    def __init__(self, path: str, pending: bool = False):
+        """
+        Initialize PageState
+
+        Args:
+            path (str): path of the SQLite database
+            pending (bool, optional): whether to commit to a copy of the
+                database until it is promoted. Defaults to False.
+        """
+
+        self.path = path
+        if pending:
+            # start over from the promoted state, dropping an older pending one
+            if os.path.exists(path):
+                shutil.copyfile(path, path + ".pending")
+            elif os.path.exists(path + ".pending"):
+                os.remove(path + ".pending")
+            path += ".pending"
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS pages (
+                page_id TEXT PRIMARY KEY,
+                version INTEGER,
+                title_id TEXT,
+                chunks INTEGER,
+                seen INTEGER DEFAULT 0
+            )
+            """
+        )
+        self.conn.execute("UPDATE pages SET seen = 0")
+        self.conn.commit()
+        self.stats = {"new": 0, "changed": 0, "unchanged": 0, "removed": 0}
+
+    def get(self, page_id: str):
+        """
+        Get the version, title id and number of chunks of a page
+
+        Args:
+            page_id (str): page id
+
+        Returns:
+            tuple: (version, title_id, chunks), or None for a new page
+        """
+
+        return self.conn.execute(
+            "SELECT version, title_id, chunks FROM pages WHERE page_id = ?",
+            (page_id,),
+        ).fetchone()
+
+    def touch(self, page_id: str):
+        """
+        Mark an unchanged page as seen
+        """
+
+        self.conn.execute("UPDATE pages SET seen = 1 WHERE page_id = ?", (page_id,))
+        self.stats["unchanged"] += 1
+
+    def put(
+        self,
+        page_id: str,
+        version: Optional[int],
+        title_id: str,
+        chunks: int,
+        new: bool = True,
+    ):
+        """
+        Record the new version and chunks of a page, and mark it as seen
+        """
+
+        self.conn.execute(
+            "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, 1)",
+            (page_id, version, title_id, chunks),
+        )
+        self.stats["new" if new else "changed"] += 1
+
+    def removed(self):
+        """
+        Iterate over the pages that were not seen since the state was opened
+
+        Yields:
+            tuple: (page_id, title_id, chunks)
+        """
+
+        cursor = self.conn.execute(
+            "SELECT page_id, title_id, chunks FROM pages WHERE seen = 0"
+        )
+        for row in cursor:
+            self.stats["removed"] += 1
+            yield row
+
+    def commit(self):
+        """
+        Forget the removed pages and persist the state of the new dump
+        """
+
+        self.conn.execute("DELETE FROM pages WHERE seen = 0")
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    @staticmethod
+    def promote(path: str):
+        """
+        Replace the state by its pending copy, if there is one
+
+        Args:
+            path (str): path of the SQLite database
+
+        Returns:
+            bool: whether a pending state was promoted
+        """
+
+        if not os.path.exists(path + ".pending"):
+            return False
+        os.replace(path + ".pending", path)
+        return True
@@ -2,16 +2,161 @@
 Python script to download, extract, segment and index Wikipedia dump using Elasticsearch.
 """
 
+import bz2
+import hashlib
+import json
 import logging
 import os
+import queue
+import re
 import subprocess
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
 
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from tqdm.auto import tqdm
+from urllib3.util.retry import Retry
+
+from cirrus_gzindex import GzipIndex
+from cirrus_imports import LazyModule
+
+bs4 = LazyModule("bs4")
 
 BASE_URL = "https://dumps.wikimedia.org/other/cirrussearch/current/"
 
+CHUNK_SIZE = 1024 * 1024
+# persist segment progress every STATE_FLUSH_BYTES written by a segment
+STATE_FLUSH_BYTES = 64 * CHUNK_SIZE
+# Wikimedia publishes md5sums and sha1sums listings, tell them apart by digest length
+CHECKSUM_ALGORITHMS = {32: "md5", 40: "sha1"}
+# decompressed blocks buffered between the download thread and the consumer
+STREAM_QUEUE_SIZE = 64
+MANIFEST_FILENAME = "manifest.json"
+DUMP_DATE_REGEX = re.compile(r"-(\d{8})-")
+
+
+def file_digest(filename: str, algorithm: str = "sha1") -> str:
+    """
+    Compute the hex digest of a file without loading it in memory
+
+    Args:
+        filename (str): file to hash
+        algorithm (str, optional): hashlib algorithm name. Defaults to "sha1".
+
+    Returns:
+        str: hex digest of the file
+    """
+
+    digest = hashlib.new(algorithm)
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _new_decompressor(file_extension: str):
+    """
+    Create an incremental decompressor for a dump file extension
+    """
+
+    if file_extension == "gz":
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if file_extension == "bz2":
+        return bz2.BZ2Decompressor()
+    raise ValueError(f"Unknown file extension: {file_extension}")
+
+
+def decompress_blocks(blocks, file_extension: str):
+    """
+    Incrementally decompress an iterable of compressed blocks
+
+    Concatenated gzip members and bz2 streams are decompressed one after the
+    other, like gunzip and bzip2 do. Blocks of uncompressed files (.json) are
+    passed through unchanged.
+
+    Args:
+        blocks (iterable): compressed blocks
+        file_extension (str): "gz", "bz2" or "json"
+
+    Yields:
+        bytes: decompressed blocks
+    """
+
+    if file_extension == "json":
+        yield from blocks
+        return
+
+    decompressor = _new_decompressor(file_extension)
+    for block in blocks:
+        while block:
+            yield decompressor.decompress(block)
+            if not decompressor.eof:
+                break
+            block = decompressor.unused_data
+            decompressor = _new_decompressor(file_extension)
+
+
+class DumpManifest:
+    """
+    Record of the dumps downloaded into an output directory
+
+    Each dump is recorded under its filename with its url, dump date, size,
+    ETag/Last-Modified headers and checksum, along with the outputs of the
+    stages that already ran on it.
+
+    Args:
+        output (str): output directory holding the manifest
+    """
+
+    def __init__(self, output: str):
+        """
+        Initialize DumpManifest
+
+        Args:
+            output (str): output directory holding the manifest
+        """
+
+        self.path = os.path.join(output, MANIFEST_FILENAME)
+        self.dumps = {}
+        if os.path.exists(self.path):
+            with open(self.path, "r", encoding="utf-8") as f:
+                self.dumps = json.load(f)
+
+    def get(self, name: str):
+        """
+        Get the record of a dump, or None if it was never downloaded
+        """
+
+        return self.dumps.get(name)
+
+    def set(self, name: str, record: dict):
+        """
+        Replace the record of a dump
+        """
+
+        self.dumps[name] = record
+        self.save()
+
+    def update(self, name: str, **fields):
+        """
+        Update some fields of the record of a dump
+        """
+
+        self.dumps.setdefault(name, {}).update(fields)
+        self.save()
+
+    def save(self):
+        """
+        Atomically write the manifest
+        """
+
+        with open(self.path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(self.dumps, f, indent=2)
+        os.replace(self.path + ".tmp", self.path)
+
 
 class CirrusDownloader:
     """
@@ -22,13 +167,15 @@ class CirrusDownloader:
         subset (str, optional): subset of the dump. Defaults to "content".
         filename (str, optional): filename to save to. Defaults to None.
         output (str, optional): output directory. Defaults to "data".
-        decompress (bool, optional): whether to decompress the dump. Defaults to True.
+        segments (int, optional): number of concurrent range requests. Defaults to 8.
+        session (requests.Session, optional): session to download with. Defaults to None.
 
     Raises:
         ValueError: if no dump link is found for the given language and subset
         ValueError: if filename is not provided
         ValueError: if file extension is not supported
         RuntimeError: if download fails for any reason
+        RuntimeError: if the downloaded file does not match its published checksum
 
     Examples:
         >>> downloader = CirrusDownloader(lang="en", subset="content")
@@ -40,8 +187,15 @@ class CirrusDownloader:
         >>> downloader.decompress_wikidump()
 
         >>> downloader = CirrusDownloader(lang="en", subset="content")
-        >>> downloader.download_latest_dump()
-        >>> downloader.decompress_wikidump()
+        >>> downloader.download_latest_dump()  # skipped if unchanged since the last run
+        >>> downloader.unchanged
+        True
+
+        >>> downloader = CirrusDownloader(lang="en", subset="content", segments=16)
+        >>> downloader.download_file(
+        ...     "https://dumps.wikimedia.org/other/cirrussearch/current/enwiki-20210501-cirrussearch-content.json.gz",
+        ...     checksum="enwiki-20210501-sha1sums.txt",
+        ... )
     """
 
     def __init__(
@@ -50,6 +204,8 @@ class CirrusDownloader:
         subset: str = "content",
         filename: Optional[str] = None,
         output: str = "wikicirrus",
+        segments: int = 8,
+        session: Optional[requests.Session] = None,
     ):
         """
         Initialize CirrusDownloader
@@ -58,23 +214,67 @@ class CirrusDownloader:
             lang (str, optional): language code. Defaults to "en".
             subset (str, optional): subset of the dump. Defaults to "content".
             output (str, optional): output directory. Defaults to "data".
+            segments (int, optional): number of concurrent range requests. Defaults to 8.
+            session (requests.Session, optional): session to download with. Defaults to None.
         """
 
         self.lang = lang
         self.subset = subset
         self.filename = filename
         self.output = output
+        self.segments = max(segments, 1)
+        self.session = session or self._init_session()
+        self.manifest = None
+        # whether the dump was already downloaded and did not change since
+        self.unchanged = False
 
-    def download_file(self, link: str, output: Optional[str] = None):
+    def _init_session(self):
+        """
+        Initialize a pooled requests session with one connection per segment
+        """
+
+        retries = Retry(
+            total=5,
+            backoff_factor=1,
+            status_forcelist=(429, 500, 502, 503, 504),
+        )
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=self.segments, max_retries=retries
+        )
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def download_file(
+        self, link: str, output: Optional[str] = None, checksum: Optional[str] = None
+    ):
         """
         Download file from link and save it to filename
 
+        The file is fetched in `segments` concurrent HTTP range requests into a
+        preallocated `<filename>.part` file. Progress is kept in a `<filename>.state`
+        sidecar, so calling this again after an interruption only fetches the
+        missing bytes. Servers that do not support ranges are downloaded in one stream.
+
+        Downloads are recorded in the manifest of the output directory. If the
+        file is already on disk (compressed or decompressed) and a conditional
+        request shows the remote file did not change, the download is skipped
+        and `unchanged` is set.
+
         Args:
             link (str): url to download from
-            filename (str): filename to save to
+            output (str, optional): output directory. Defaults to None.
+            checksum (str, optional): url or path of a md5sums/sha1sums listing
+                to verify the download against. Defaults to None.
+
+        Returns:
+            str: filename of the downloaded file
 
         Raises:
             RuntimeError: if download fails for any reason
+            RuntimeError: if the downloaded file does not match its checksum,
+                which is then removed
         """
 
         if self.lang is None:
@@ -88,16 +288,417 @@ class CirrusDownloader:
         if self.filename is None:
             self.filename = os.path.join(self.output, link.split("/")[-1])
 
+        name = os.path.basename(self.filename)
+        part_filename = self.filename + ".part"
+        state_filename = self.filename + ".state"
+        self.manifest = DumpManifest(self.output)
+        record = self.manifest.get(name)
+        if record is not None and record.get("url") != link:
+            record = None
+
         try:
-            logging.info(
-                "Downloading %s",
-            )
-            subprocess.check_call(["wget", "-O", self.filename, link])
-            return self.filename
-        except subprocess.CalledProcessError as exc:
+            logging.info("Downloading %s", link)
+            remote = self._probe(link, record if self._on_disk(record) else None)
+            if remote is None:
+                logging.info("%s did not change since last download, skipping", link)
+                self.unchanged = True
+                return self.filename
+
+            # a file smaller than the segments (e.g. empty) is not worth splitting
+            if (
+                remote["size"] is None
+                or not remote["ranges"]
+                or remote["size"] < self.segments
+                or self.segments == 1
+            ):
+                self._download_stream(link, part_filename)
+            else:
+                self._download_segments(
+                    link, part_filename, state_filename, remote["size"], remote["etag"]
+                )
+        except requests.RequestException as exc:
             logging.error("Failed to download %s", link)
             raise RuntimeError(f"Failed to download {link}") from exc
 
+        if checksum is not None:
+            try:
+                digest = self.verify_checksum(part_filename, checksum, name=name)
+            except RuntimeError:
+                # the bytes on disk are wrong, so a rerun must download them again
+                for filename in (part_filename, state_filename):
+                    if os.path.exists(filename):
+                        os.remove(filename)
+                raise
+        else:
+            digest = file_digest(part_filename, "sha1")
+        algorithm = CHECKSUM_ALGORITHMS[len(digest)]
+
+        os.replace(part_filename, self.filename)
+        if os.path.exists(state_filename):
+            os.remove(state_filename)
+
+        dump_date = DUMP_DATE_REGEX.search(name)
+        self.manifest.set(
+            name,
+            {
+                "url": link,
+                "dump_date": dump_date.group(1) if dump_date else None,
+                "size": os.path.getsize(self.filename),
+                "etag": remote["etag"],
+                "last_modified": remote["last_modified"],
+                "checksum": f"{algorithm}:{digest}",
+            },
+        )
+        return self.filename
+
+    def _on_disk(self, record: Optional[dict]):
+        """
+        Whether the dump of a manifest record is still on disk, compressed or not
+        """
+
+        if record is None:
+            return False
+        if os.path.exists(self.filename):
+            return os.path.getsize(self.filename) == record["size"]
+        decompressed = record.get("decompressed")
+        return decompressed is not None and os.path.exists(decompressed)
+
+    def _probe(self, link: str, record: Optional[dict] = None):
+        """
+        Find the size of the remote file and whether it can be fetched by ranges
+
+        Args:
+            link (str): url to probe
+            record (dict, optional): manifest record of the local copy, to send
+                a conditional request. Defaults to None.
+
+        Returns:
+            dict: size, range support, ETag and Last-Modified of the remote file,
+                or None if it did not change since record
+        """
+
+        headers = {}
+        if record is not None:
+            if record.get("etag"):
+                headers["If-None-Match"] = record["etag"]
+            if record.get("last_modified"):
+                headers["If-Modified-Since"] = record["last_modified"]
+
+        response = self.session.head(
+            link, allow_redirects=True, timeout=30, headers=headers
+        )
+        if response.status_code == 304:
+            return None
+        response.raise_for_status()
+
+        size = response.headers.get("Content-Length")
+        remote = {
+            "size": int(size) if size is not None else None,
+            "ranges": response.headers.get("Accept-Ranges") == "bytes",
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+        }
+
+        # servers ignoring conditional requests still let us compare validators
+        if (
+            record is not None
+            and remote["size"] == record["size"]
+            and (remote["etag"], remote["last_modified"])
+            == (record.get("etag"), record.get("last_modified"))
+            and (remote["etag"] or remote["last_modified"])
+        ):
+            return None
+        return remote
+
+    def completed(self, stage: str):
+        """
+        Get the output recorded for a stage, if the dump is unchanged since it ran
+
+        Args:
+            stage (str): name of the stage, e.g. "tokenized"
+
+        Returns:
+            the value recorded by `record` for the stage, or None
+        """
+
+        if not self.unchanged:
+            return None
+        return self.manifest.get(os.path.basename(self.filename)).get(stage)
+
+    def record(self, **stages):
+        """
+        Record the outputs of stages that ran on the downloaded dump
+
+        Args:
+            **stages: stage names and their outputs, e.g. tokenized="data/enwiki-tokenized.json"
+        """
+
+        if self.manifest is None or self.filename is None:
+            return
+        self.manifest.update(os.path.basename(self.filename), **stages)
+
+    def _download_stream(self, link: str, filename: str):
+        """
+        Download link in a single stream, for servers without range support
+
+        Args:
+            link (str): url to download from
+            filename (str): filename to save to
+        """
+
+        with self.session.get(link, stream=True, timeout=60) as response:
+            response.raise_for_status()
+            size = response.headers.get("Content-Length")
+            with open(filename, "wb") as f, tqdm(
+                total=int(size) if size else None,
+                unit="B",
+                unit_scale=True,
+                desc=os.path.basename(filename),
+            ) as progress:
+                for block in response.iter_content(CHUNK_SIZE):
+                    f.write(block)
+                    progress.update(len(block))
+
+    def _download_segments(
+        self,
+        link: str,
+        filename: str,
+        state_filename: str,
+        size: int,
+        etag: Optional[str],
+    ):
+        """
+        Download link in concurrent range segments, resuming from state_filename
+
+        Args:
+            link (str): url to download from
+            filename (str): preallocated filename to write the segments into
+            state_filename (str): sidecar file holding the segments progress
+            size (int): size of the remote file
+            etag (str, optional): ETag of the remote file
+        """
+
+        state = self._load_state(state_filename, link, size, etag)
+        if state is None or not os.path.exists(filename):
+            segment_size = max(-(-size // self.segments), 1)
+            state = {
+                "url": link,
+                "size": size,
+                "etag": etag,
+                # [first byte, last byte, bytes already on disk]
+                "segments": [
+                    [start, min(start + segment_size, size) - 1, 0]
+                    for start in range(0, size, segment_size)
+                ],
+            }
+            with open(filename, "wb") as f:
+                f.truncate(size)
+            self._save_state(state_filename, state)
+        else:
+            logging.info("Resuming download of %s", link)
+
+        pending = [
+            segment
+            for segment in state["segments"]
+            if segment[2] < segment[1] - segment[0] + 1
+        ]
+        done = sum(segment[2] for segment in state["segments"])
+        lock = threading.Lock()
+
+        with tqdm(
+            total=size,
+            initial=done,
+            unit="B",
+            unit_scale=True,
+            desc=os.path.basename(filename),
+        ) as progress, ThreadPoolExecutor(max_workers=max(len(pending), 1)) as pool:
+            futures = [
+                pool.submit(
+                    self._download_segment,
+                    link,
+                    filename,
+                    segment,
+                    state,
+                    state_filename,
+                    lock,
+                    progress,
+                )
+                for segment in pending
+            ]
+            for future in futures:
+                future.result()
+
+    def _download_segment(
+        self,
+        link: str,
+        filename: str,
+        segment: list,
+        state: dict,
+        state_filename: str,
+        lock: threading.Lock,
+        progress: tqdm,
+    ):
+        """
+        Download the missing bytes of one segment and record them in the state
+
+        The state is only advanced after the bytes are flushed to disk, so a
+        crash can make us fetch a few bytes twice but never skip any.
+        """
+
+        start, end, written = segment
+        headers = {"Range": f"bytes={start + written}-{end}"}
+
+        with self.session.get(
+            link, headers=headers, stream=True, timeout=60
+        ) as response:
+            response.raise_for_status()
+            if response.status_code != 206:
+                raise RuntimeError(f"Server ignored the range request for {link}")
+
+            with open(filename, "r+b") as f:
+                f.seek(start + written)
+                remaining = end - start - written + 1
+                unsaved = 0
+                for block in response.iter_content(CHUNK_SIZE):
+                    block = block[:remaining]
+                    f.write(block)
+                    remaining -= len(block)
+                    unsaved += len(block)
+                    progress.update(len(block))
+
+                    if unsaved >= STATE_FLUSH_BYTES or remaining == 0:
+                        self._flush_segment(
+                            f, segment, unsaved, state, state_filename, lock
+                        )
+                        unsaved = 0
+
+                    if remaining == 0:
+                        break
+
+                if unsaved:
+                    self._flush_segment(
+                        f, segment, unsaved, state, state_filename, lock
+                    )
+
+        if remaining:
+            raise RuntimeError(
+                f"Connection closed with {remaining} bytes missing from {link}"
+            )
+
+    def _flush_segment(
+        self,
+        f,
+        segment: list,
+        written: int,
+        state: dict,
+        state_filename: str,
+        lock: threading.Lock,
+    ):
+        """
+        Flush a segment's bytes to disk, then advance it in the saved state
+        """
+
+        f.flush()
+        os.fsync(f.fileno())
+        with lock:
+            segment[2] += written
+            self._save_state(state_filename, state)
+
+    @staticmethod
+    def _load_state(state_filename: str, link: str, size: int, etag: Optional[str]):
+        """
+        Load the download state if it still describes the same remote file
+        """
+
+        if not os.path.exists(state_filename):
+            return None
+
+        with open(state_filename, "r", encoding="utf-8") as f:
+            state = json.load(f)
+
+        if (state["url"], state["size"], state["etag"]) != (link, size, etag):
+            logging.info("Remote file changed since last attempt, restarting download")
+            return None
+        return state
+
+    @staticmethod
+    def _save_state(state_filename: str, state: dict):
+        """
+        Atomically write the download state
+        """
+
+        with open(state_filename + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.replace(state_filename + ".tmp", state_filename)
+
+    def fetch_checksums(self, listing: str):
+        """
+        Read a Wikimedia md5sums/sha1sums listing
+
+        Args:
+            listing (str): url or path of the listing, one "<digest>  <filename>" per line
+
+        Returns:
+            dict: mapping of filename to hex digest
+        """
+
+        if os.path.exists(listing):
+            with open(listing, "r", encoding="utf-8") as f:
+                content = f.read()
+        else:
+            response = self.session.get(listing, timeout=30)
+            response.raise_for_status()
+            content = response.text
+
+        checksums = {}
+        for line in content.splitlines():
+            parts = line.split()
+            if len(parts) == 2:
+                checksums[parts[1].lstrip("*")] = parts[0].lower()
+        return checksums
+
+    def verify_checksum(self, filename: str, listing: str, name: Optional[str] = None):
+        """
+        Verify a file against its entry in a md5sums/sha1sums listing
+
+        Args:
+            filename (str): file to verify
+            listing (str): url or path of the checksum listing
+            name (str, optional): name of the file in the listing. Defaults to
+                the basename of filename.
+
+        Returns:
+            str: the verified hex digest
+
+        Raises:
+            ValueError: if the file is not in the listing
+            RuntimeError: if the digest does not match
+        """
+
+        name = name or os.path.basename(filename)
+        expected = self._expected_checksum(listing, name)
+        algorithm = CHECKSUM_ALGORITHMS[len(expected)]
+        logging.info("Verifying %s checksum of %s", algorithm, filename)
+        digest = file_digest(filename, algorithm)
+        if digest != expected:
+            raise RuntimeError(
+                f"{algorithm} mismatch for {name}: expected {expected}, got {digest}"
+            )
+        return digest
+
+    def _expected_checksum(self, listing: str, name: str):
+        """
+        Get the digest of a file in a md5sums/sha1sums listing
+
+        Raises:
+            ValueError: if the file is not in the listing
+        """
+
+        expected = self.fetch_checksums(listing).get(name)
+        if expected is None or len(expected) not in CHECKSUM_ALGORITHMS:
+            raise ValueError(f"No checksum found for {name} in {listing}")
+        return expected
+
     def get_latest_dump(self, lang="en", subset="content"):
         """
         Get the latest dump link from Wikimedia
@@ -111,10 +712,10 @@ class CirrusDownloader:
 
         wikilang = lang + "wiki-"
 
-        response = requests.get(BASE_URL, timeout=5)
+        response = self.session.get(BASE_URL, timeout=5)
         content = response.text
 
-        soup = BeautifulSoup(content, "html.parser")
+        soup = bs4.BeautifulSoup(content, "html.parser")
         links = soup.find_all("a")
 
         for dump_link in links:
@@ -124,10 +725,17 @@ class CirrusDownloader:
 
         raise ValueError(f"No dump link found for {lang}-{subset}")
 
-    def download_latest_dump(self, output: Optional[str] = None):
+    def download_latest_dump(
+        self, output: Optional[str] = None, checksum: Optional[str] = None
+    ):
         """
         Download the latest dump
 
+        Args:
+            output (str, optional): output directory. Defaults to None.
+            checksum (str, optional): url or path of a md5sums/sha1sums listing
+                to verify the download against. Defaults to None.
+
         Returns:
             str: filename of the downloaded dump
         """
@@ -137,14 +745,134 @@ class CirrusDownloader:
                 os.makedirs(self.output)
 
         link = self.get_latest_dump(self.lang, self.subset)
-        return self.download_file(link, self.output)
+        return self.download_file(link, self.output, checksum=checksum)
+
+    def _read_blocks(self, source: str):
+        """
+        Read the raw blocks of a local file or of an url
+        """
+
+        if os.path.exists(source):
+            with open(source, "rb") as f:
+                yield from iter(lambda: f.read(CHUNK_SIZE), b"")
+            return
+
+        with self.session.get(source, stream=True, timeout=60) as response:
+            response.raise_for_status()
+            yield from response.iter_content(CHUNK_SIZE)
+
+    def stream_dump(self, source: str, checksum: Optional[str] = None):
+        """
+        Stream the lines of a dump without writing it to disk
+
+        Reading and decompressing happen in a background thread (both release
+        the GIL), so they overlap with whatever the consumer does with the lines.
+        With a checksum listing, the bytes read are hashed on the way, and
+        checked once the whole dump was read.
+
+        Args:
+            source (str): url or path of a .json.gz, .json.bz2 or .json dump
+            checksum (str, optional): url or path of a md5sums/sha1sums listing
+                to verify the dump against. Defaults to None.
+
+        Yields:
+            bytes: the lines of the decompressed dump, without line terminator
 
-    def decompress_wikidump(self, filename: Optional[str] = None):
+        Raises:
+            ValueError: if file extension is not supported, or the dump is not
+                in the checksum listing
+            RuntimeError: if download fails for any reason
+            RuntimeError: if the dump does not match its checksum, after its
+                last line
+        """
+
+        file_extension = source.split(".")[-1]
+        if file_extension not in ("gz", "bz2", "json"):
+            raise ValueError(f"Unknown file extension: {file_extension}")
+
+        name = source.split("/")[-1]
+        expected = digest = None
+        if checksum is not None:
+            expected = self._expected_checksum(checksum, name)
+            digest = hashlib.new(CHECKSUM_ALGORITHMS[len(expected)])
+
+        def read_blocks():
+            for block in self._read_blocks(source):
+                if digest is not None:
+                    digest.update(block)
+                yield block
+
+        blocks = queue.Queue(maxsize=STREAM_QUEUE_SIZE)
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    blocks.put(item, timeout=1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def produce():
+            try:
+                for block in decompress_blocks(read_blocks(), file_extension):
+                    if not put(block):
+                        return
+                if digest is not None and digest.hexdigest() != expected:
+                    put(
+                        RuntimeError(
+                            f"{digest.name} mismatch for {name}: expected "
+                            f"{expected}, got {digest.hexdigest()}"
+                        )
+                    )
+                    return
+                put(None)
+            except Exception as exc:  # handed over to the consumer
+                put(exc)
+
+        logging.info("Streaming %s", source)
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+
+        pending = []
+        try:
+            while True:
+                block = blocks.get()
+                if block is None:
+                    break
+                if isinstance(block, requests.RequestException):
+                    raise RuntimeError(f"Failed to download {source}") from block
+                if isinstance(block, Exception):
+                    raise block
+
+                newline = block.find(b"\n")
+                if newline == -1:
+                    pending.append(block)
+                    continue
+
+                pending.append(block[:newline])
+                yield b"".join(pending)
+                lines = block[newline + 1 :].split(b"\n")
+                pending = [lines.pop()]
+                yield from lines
+        finally:
+            stop.set()
+
+        if any(pending):
+            yield b"".join(pending)
+
+    def decompress_wikidump(self, filename: Optional[str] = None, workers: int = 1):
         """
         Decompress the wiki dump file
 
+        With several workers, gzip dumps are decompressed in parallel from the
+        checkpoints of a `GzipIndex` saved next to the dump, and the compressed
+        dump is kept so that later runs reuse the index.
+
         Args:
             filename (str): filename to decompress
+            workers (int, optional): number of decompression processes. Defaults to 1.
 
         Returns:
             str: decompressed filename
@@ -154,14 +882,24 @@ class CirrusDownloader:
             if filename is None:
                 raise ValueError("Filename not provided")
 
+        file_extension = filename.split(".")[-1]
+        decompressed = filename[: -len(file_extension) - 1]
+        if self.unchanged and self.completed("decompressed") == decompressed:
+            if os.path.exists(decompressed):
+                logging.info("%s is already decompressed", filename)
+                return decompressed
+
         logging.info("Extracting %s", filename)
 
-        file_extension = self.filename.split(".")[-1]
-        if file_extension == "bz2":
-            subprocess.check_call(["bzip2", "-d", filename])
+        if file_extension == "gz" and workers > 1:
+            GzipIndex.open(filename).decompress(decompressed, workers=workers)
+        elif file_extension == "bz2":
+            subprocess.check_call(["bzip2", "-d", "-f", filename])
         elif file_extension == "gz":
-            subprocess.check_call(["gunzip", "-d", filename])
+            subprocess.check_call(["gunzip", "-d", "-f", filename])
         else:
             raise ValueError(f"Unknown file extension: {file_extension}")
 
-        return filename[: -len(file_extension) - 1]
+        if filename == self.filename:
+            self.record(decompressed=decompressed)
+        return decompressed
@@ -1,12 +1,23 @@
 import argparse
+import json
 import logging
 import os
+import time
 
+from cirrus_cache import CleanCache
+from cirrus_chunking import CHUNK_STRATEGIES, MAX_LENGTH, Chunker
+from cirrus_clean import WikiCleaner
+from cirrus_dedup import DEDUP_MODES, ChunkDeduplicator
 from cirrus_download import CirrusDownloader
+from cirrus_filter import PageFilter
+from cirrus_imports import print_import_times
 from cirrus_indexer import CirrusElasticsearchIndexer
-from cirrus_preprocess import CirrusPreprocess
+from cirrus_preprocess import CHUNK_TEXTS, TEXT_SOURCES, CirrusPreprocess
+from cirrus_reader import JSON_BACKENDS
+from cirrus_sinks import OUTPUT_FORMATS
 
 if __name__ == "__main__":
+    start = time.perf_counter()
     argparser = argparse.ArgumentParser(description="Download Wikipedia dump")
 
     argparser.add_argument("--link", help="Download link")
@@ -19,10 +30,193 @@ if __name__ == "__main__":
         action=argparse.BooleanOptionalAction,
         help="Process the dump",
     )
+    argparser.add_argument(
+        "--segments",
+        type=int,
+        default=8,
+        help="Number of concurrent range requests used to download the dump",
+    )
+    argparser.add_argument(
+        "--checksum",
+        help="URL or path of a sha1sums/md5sums listing to verify the dump against",
+    )
+    argparser.add_argument(
+        "--decompress-workers",
+        type=int,
+        default=1,
+        help="Number of processes decompressing a gzip dump in parallel, using a seekable index saved next to it",
+    )
+    argparser.add_argument(
+        "--stream",
+        action=argparse.BooleanOptionalAction,
+        help="Stream the dump from --link (url or local file) into the preprocessor without writing it to disk",
+    )
+    argparser.add_argument(
+        "--skip-unchanged",
+        action=argparse.BooleanOptionalAction,
+        help="Also skip processing and indexing when the dump did not change since they last ran",
+    )
+    argparser.add_argument(
+        "--delta",
+        action=argparse.BooleanOptionalAction,
+        help="Only process and index the articles that changed since the previously processed dump",
+    )
+    argparser.add_argument(
+        "--disable-clean-stages",
+        default="",
+        help=f"Comma separated cleaning stages to skip, among {', '.join(WikiCleaner.STAGES)}",
+    )
+    argparser.add_argument(
+        "--page-filter",
+        help='Rules of the pages to skip before parsing them, as a JSON object or the path of a JSON file, e.g. {"namespaces": [0], "min_text_bytes": 500, "min_popularity_score": 1e-8, "exclude_title": "^List of ", "exclude_templates": ["Template:Disambiguation"]} (also max_text_bytes)',
+    )
+    argparser.add_argument(
+        "--text-source",
+        choices=TEXT_SOURCES,
+        default="source_text",
+        help="Field of the articles to tokenize: source_text cleaned from wikitext, text as rendered by MediaWiki, or hybrid (text, else cleaned source_text)",
+    )
+    argparser.add_argument(
+        "--compare-text-sources",
+        action=argparse.BooleanOptionalAction,
+        help="Report the throughput and differences of the text sources on the first articles of the dump, saved to <output>/<dump>-text-sources.json",
+    )
+    argparser.add_argument(
+        "--tokenize-batch-size",
+        type=int,
+        default=64,
+        help="Number of articles tokenized at once by the fast tokenizer",
+    )
+    argparser.add_argument(
+        "--tokenize-workers",
+        type=int,
+        default=1,
+        help="Number of processes tokenizing byte ranges of the decompressed dump (not with --stream or --delta)",
+    )
+    argparser.add_argument(
+        "--resume",
+        action=argparse.BooleanOptionalAction,
+        help="Resume an interrupted tokenization of the dump from its last checkpoint (not with --stream, --delta, --dedup or the parquet output format)",
+    )
+    argparser.add_argument(
+        "--chunk-text",
+        choices=CHUNK_TEXTS,
+        default="decode",
+        help="Content of the chunks: decoded from their tokens, or sliced from the article text with the offset mapping (faster, keeps case and spacing)",
+    )
+    argparser.add_argument(
+        "--chunking",
+        choices=CHUNK_STRATEGIES,
+        default="fixed",
+        help="Chunking strategy: fixed token windows, whole sentences, or whole sentences within the sections of the articles",
+    )
+    argparser.add_argument(
+        "--chunk-max-length",
+        type=int,
+        default=MAX_LENGTH,
+        help="Tokens per chunk",
+    )
+    argparser.add_argument(
+        "--chunk-stride",
+        type=int,
+        help="Tokens shared by consecutive chunks of an article (default: 64 with fixed windows, 0 otherwise)",
+    )
+    argparser.add_argument(
+        "--compare-chunking",
+        action=argparse.BooleanOptionalAction,
+        help="Report the number of chunks, tokens and bytes of each chunking strategy on the first articles of the dump, saved to <output>/<dump>-chunking.json",
+    )
+    argparser.add_argument(
+        "--dedup",
+        choices=DEDUP_MODES,
+        help="Detect the chunks that are near-duplicates of earlier ones (MinHash with LSH banding), and drop them or mark them with duplicate_of; approximate, as each LSH bucket keeps its last 8 chunks only; requires numpy",
+    )
+    argparser.add_argument(
+        "--dedup-threshold",
+        type=float,
+        default=0.9,
+        help="Estimated Jaccard similarity of the word shingles over which a chunk is a near-duplicate",
+    )
+    argparser.add_argument(
+        "--dedup-max-signatures",
+        type=int,
+        default=1_000_000,
+        help="Chunk signatures kept in memory (about 2 KB each), the oldest being forgotten past it",
+    )
+    argparser.add_argument(
+        "--json-backend",
+        choices=JSON_BACKENDS,
+        default="auto",
+        help="Parser of the dump lines: orjson, json, or auto for orjson when it is installed",
+    )
+    argparser.add_argument(
+        "--clean-budget",
+        type=float,
+        help="Seconds an article may take to clean, before falling back to a cheap cleaning logged in <output>/clean-quarantine.jsonl",
+    )
+    argparser.add_argument(
+        "--clean-max-chars",
+        type=int,
+        help="Length of the articles over which they get the cheap cleaning",
+    )
+    argparser.add_argument(
+        "--regex-backend",
+        choices=("re", "re2"),
+        default="re",
+        help="Regex engine of the patterns prone to backtracking; re2 requires google-re2",
+    )
+    argparser.add_argument(
+        "--clean-cache",
+        help="Path of a SQLite cache of the cleaned articles, reused by later runs",
+    )
+    argparser.add_argument(
+        "--clean-cache-size",
+        type=int,
+        default=10240,
+        help="Maximum size of the clean cache in MiB",
+    )
+    argparser.add_argument(
+        "--output-format",
+        choices=OUTPUT_FORMATS,
+        default="jsonl",
+        help="Format of the tokenized chunks: JSON lines, gzip or zstd compressed JSON lines (zstd requires zstandard), Parquet (requires pyarrow), or memory-mapped token ids for training (not indexable)",
+    )
     argparser.add_argument("--output", default="data", help="Output directory")
     argparser.add_argument(
         "--index", help="Index name to store the data in Elasticsearch"
     )
+    argparser.add_argument(
+        "--index-batch-size",
+        type=int,
+        default=20_000,
+        help="Maximum number of chunks per bulk request to Elasticsearch",
+    )
+    argparser.add_argument(
+        "--index-batch-mib",
+        type=int,
+        default=16,
+        help="Maximum size in MiB of a bulk request to Elasticsearch, which bounds the memory taken by the chunks in flight",
+    )
+    argparser.add_argument(
+        "--bulk-load",
+        action=argparse.BooleanOptionalAction,
+        help="Create the index with an explicit mapping, and turn off its refresh and replicas while indexing, restoring them afterwards",
+    )
+    argparser.add_argument(
+        "--force-merge-segments",
+        type=int,
+        help="Number of segments to force-merge the index into after a bulk load",
+    )
+    argparser.add_argument(
+        "--resume-index",
+        action=argparse.BooleanOptionalAction,
+        help="Resume an interrupted indexing of the tokenized chunks from its last checkpoint",
+    )
+    argparser.add_argument(
+        "--profile-imports",
+        action=argparse.BooleanOptionalAction,
+        help="Report the time taken to import the heavy dependencies of the stages that ran",
+    )
     argparser.add_argument(
         "--debug", action=argparse.BooleanOptionalAction, help="Debug output"
     )
@@ -47,29 +241,166 @@ if __name__ == "__main__":
     # Download the dump
     ########################################
 
-    downloader = CirrusDownloader(lang=args.lang)
+    downloader = CirrusDownloader(lang=args.lang, segments=args.segments)
 
-    if args.link:
-        downloader.download_file(args.link, args.output)
-    elif args.latest:
-        downloader.download_latest_dump(args.output)
-    elif args.link is None and args.latest is None:
+    if args.link is None and args.latest is None:
         raise ValueError("Please provide a link or set --latest to True")
 
-    filename = downloader.decompress_wikidump()
+    if args.stream and not args.process:
+        raise ValueError("--stream requires --process")
+
+    if args.resume and (args.stream or args.delta or args.dedup):
+        raise ValueError("--resume cannot be used with --stream, --delta or --dedup")
+
+    if args.index and args.output_format == "tokens":
+        raise ValueError("Token ids cannot be indexed, use another --output-format")
+
+    if args.stream:
+        filename = args.link or downloader.get_latest_dump(args.lang)
+    else:
+        if args.link:
+            downloader.download_file(args.link, args.output, checksum=args.checksum)
+        else:
+            downloader.download_latest_dump(args.output, checksum=args.checksum)
+        filename = downloader.decompress_wikidump(workers=args.decompress_workers)
 
     ########################################
     # Extract the dump
     ########################################
 
+    preprocessor = cache = None
     if args.process:
-        preprocessor = CirrusPreprocess(model_name="bert-base-uncased")
-        extractedfile_path = preprocessor.tokenize_dump(filename, args.output)
+        cleaner = WikiCleaner(
+            disable=[stage for stage in args.disable_clean_stages.split(",") if stage],
+            time_budget=args.clean_budget,
+            max_chars=args.clean_max_chars,
+            quarantine=os.path.join(args.output, "clean-quarantine.jsonl"),
+            regex_backend=args.regex_backend,
+            headings=args.chunking == "section",
+        )
+        if args.clean_cache:
+            cache = CleanCache(args.clean_cache, max_bytes=args.clean_cache_size << 20)
+        preprocessor = CirrusPreprocess(
+            model_name="bert-base-uncased",
+            cleaner=cleaner,
+            cache=cache,
+            text_source=args.text_source,
+            batch_size=args.tokenize_batch_size,
+            chunk_text=args.chunk_text,
+            output_format=args.output_format,
+            json_backend=args.json_backend,
+            chunker=Chunker(
+                args.chunking,
+                max_length=args.chunk_max_length,
+                stride=args.chunk_stride,
+            ),
+            deduplicator=ChunkDeduplicator(
+                threshold=args.dedup_threshold,
+                max_signatures=args.dedup_max_signatures,
+                mode=args.dedup,
+            )
+            if args.dedup
+            else None,
+            page_filter=PageFilter.from_json(args.page_filter)
+            if args.page_filter
+            else None,
+        )
+
+    skip_processing = skip_indexing = False
+    deletedfile_path = None
+    if args.skip_unchanged:
+        extractedfile_path = downloader.completed("tokenized")
+        deletedfile_path = downloader.completed("deleted")
+        skip_processing = extractedfile_path is not None and os.path.exists(
+            extractedfile_path
+        )
+        # an export made with other settings is processed again
+        if preprocessor is not None:
+            skip_processing = skip_processing and downloader.completed(
+                "settings"
+            ) == dict(preprocessor.settings(), delta=bool(args.delta))
+        skip_indexing = skip_processing and args.index in (
+            downloader.completed("indexed") or []
+        )
+
+    if args.process and skip_processing:
+        print("Dump unchanged since last run, skipping processing")
+    elif args.process:
+        deletedfile_path = None
+        if args.compare_text_sources:
+            report = preprocessor.compare_text_sources(
+                filename,
+                lines=downloader.stream_dump(filename) if args.stream else None,
+            )
+            report_path = os.path.join(
+                args.output,
+                filename.split("/")[-1].split(".")[0] + "-text-sources.json",
+            )
+            with open(report_path, "w", encoding="utf-8") as report_f:
+                json.dump(report, report_f, indent=2)
+        if args.compare_chunking:
+            report = preprocessor.compare_chunking(
+                filename,
+                lines=downloader.stream_dump(filename) if args.stream else None,
+            )
+            report_path = os.path.join(
+                args.output,
+                filename.split("/")[-1].split(".")[0] + "-chunking.json",
+            )
+            with open(report_path, "w", encoding="utf-8") as report_f:
+                json.dump(report, report_f, indent=2)
+        lines = (
+            downloader.stream_dump(filename, checksum=args.checksum)
+            if args.stream
+            else None
+        )
+        if args.delta:
+            # the new state of the pages is only persisted once indexed
+            extractedfile_path, deletedfile_path = preprocessor.tokenize_delta(
+                filename, args.output, lines=lines, commit=not args.index
+            )
+        else:
+            extractedfile_path = preprocessor.tokenize_dump(
+                filename,
+                args.output,
+                lines=lines,
+                workers=args.tokenize_workers,
+                resume=args.resume,
+            )
+        downloader.record(
+            tokenized=extractedfile_path,
+            deleted=deletedfile_path,
+            settings=dict(preprocessor.settings(), delta=bool(args.delta)),
+            indexed=[],
+        )
+    if cache is not None:
+        cache.close()
 
     ########################################
     # Index the dump
     ########################################
 
-    if args.index:
-        indexer = CirrusElasticsearchIndexer(index_name=args.index)
-        indexer.index_file(extractedfile_path)
+    if args.index and skip_indexing:
+        print(f"Dump unchanged since last run, skipping indexing into {args.index}")
+    elif args.index:
+        indexer = CirrusElasticsearchIndexer(
+            index_name=args.index,
+            batch_size=args.index_batch_size,
+            max_batch_bytes=args.index_batch_mib << 20,
+        )
+        if deletedfile_path is not None:
+            indexer.delete_file(deletedfile_path)
+        indexer.index_file(
+            extractedfile_path,
+            bulk_load=args.bulk_load,
+            max_num_segments=args.force_merge_segments,
+            resume=args.resume_index,
+        )
+        if args.delta:
+            CirrusPreprocess.commit_delta(filename, args.output)
+        downloader.record(
+            indexed=(downloader.completed("indexed") or []) + [args.index]
+        )
+
+    if args.profile_imports:
+        print_import_times(time.perf_counter() - start)
@@ -0,0 +1,223 @@
+"""
+Declarative pre-filter of the pages of a Cirrus dump, checked on the raw JSON
+lines so that rejected pages are never decoded nor cleaned.
+"""
+
+import json
+import os
+import re
+from typing import Optional
+
+# Rules of the pre-filter, in the order they are checked, cheapest first
+FILTER_RULES = (
+    "namespace",
+    "title",
+    "popularity_score",
+    "text_bytes",
+    "template",
+)
+
+# Raw values of the fields of a page. Cirrus pages start with their own namespace
+# and title, before the namespaces and titles of their redirects, so the first
+# match is the one of the page; a key inside a string value has escaped quotes
+# and never matches.
+RAW_NUMBER = {
+    name: re.compile(r'"%s"\s*:\s*(-?[0-9][0-9.eE+-]*)' % name)
+    for name in ("namespace", "popularity_score", "text_bytes")
+}
+RAW_TITLE = re.compile(r'"title"\s*:\s*"((?:[^"\\]|\\.)*)"')
+RAW_TEMPLATES = re.compile(r'"template"\s*:\s*\[([^\]]*)\]')
+
+# Same patterns for the undecoded lines of `CirrusDownloader.stream_dump`
+RAW_NUMBER_BYTES = {
+    name: re.compile(pattern.pattern.encode("utf-8"))
+    for name, pattern in RAW_NUMBER.items()
+}
+RAW_TITLE_BYTES = re.compile(RAW_TITLE.pattern.encode("utf-8"))
+RAW_TEMPLATES_BYTES = re.compile(RAW_TEMPLATES.pattern.encode("utf-8"))
+
+
+class PageFilter:
+    """
+    Filter of the pages of the dump, on their raw JSON line
+
+    The fields the rules look at are matched in the line with a regex, without
+    decoding it. A page missing a field passes the rules on that field. The
+    pages rejected by each rule (the first one they fail) are counted in
+    `stats`.
+
+    Args:
+        namespaces (list, optional): namespaces of the pages to keep, e.g. [0]
+            for articles. Defaults to None, for all of them.
+        min_text_bytes (int, optional): size of the text under which pages are
+            rejected, e.g. stubs. Defaults to None.
+        max_text_bytes (int, optional): size of the text over which pages are
+            rejected. Defaults to None.
+        min_popularity_score (float, optional): popularity score under which
+            pages are rejected. Defaults to None.
+        exclude_title (str, optional): regex of the titles of the pages to
+            reject, searched in the title. Defaults to None.
+        exclude_templates (list, optional): templates of the pages to reject,
+            e.g. ["Template:Disambiguation"]. Defaults to None.
+
+    Examples:
+        >>> page_filter = PageFilter(
+        ...     namespaces=[0],
+        ...     min_text_bytes=500,
+        ...     exclude_title=r"^List of |\\(disambiguation\\)$",
+        ...     exclude_templates=["Template:Disambiguation", "Template:Set index article"],
+        ... )
+        >>> reader = DumpReader(page_filter=page_filter)
+        >>> page_filter.stats
+        {'accepted': 5120, 'namespace': 0, 'title': 37, 'popularity_score': 0, 'text_bytes': 1290, 'template': 61}
+
+        >>> PageFilter.from_json('{"namespaces": [0], "min_text_bytes": 500}')
+    """
+
+    def __init__(
+        self,
+        namespaces: Optional[list] = None,
+        min_text_bytes: Optional[int] = None,
+        max_text_bytes: Optional[int] = None,
+        min_popularity_score: Optional[float] = None,
+        exclude_title: Optional[str] = None,
+        exclude_templates: Optional[list] = None,
+    ):
+        """
+        Initialize PageFilter
+        """
+
+        # arguments of the filter, e.g. to tell apart the outputs of two filters
+        self.spec = {
+            "namespaces": None if namespaces is None else sorted(namespaces),
+            "min_text_bytes": min_text_bytes,
+            "max_text_bytes": max_text_bytes,
+            "min_popularity_score": min_popularity_score,
+            "exclude_title": exclude_title,
+            "exclude_templates": None
+            if exclude_templates is None
+            else sorted(exclude_templates),
+        }
+        self.namespaces = None if namespaces is None else set(namespaces)
+        self.min_text_bytes = min_text_bytes
+        self.max_text_bytes = max_text_bytes
+        self.min_popularity_score = min_popularity_score
+        self.exclude_title = (
+            None if exclude_title is None else re.compile(exclude_title)
+        )
+        self.exclude_templates = (
+            None if exclude_templates is None else set(exclude_templates)
+        )
+        self.rules = [
+            rule
+            for rule, enabled in zip(
+                FILTER_RULES,
+                (
+                    self.namespaces is not None,
+                    self.exclude_title is not None,
+                    min_popularity_score is not None,
+                    min_text_bytes is not None or max_text_bytes is not None,
+                    self.exclude_templates,
+                ),
+            )
+            if enabled
+        ]
+        self.reset_stats()
+
+    @classmethod
+    def from_json(cls, spec: str):
+        """
+        Build a filter from its rules, as a JSON object or the path of a JSON file
+
+        Args:
+            spec (str): JSON object of the arguments of PageFilter, or path of
+                a file holding one
+
+        Returns:
+            PageFilter: the filter
+        """
+
+        if os.path.exists(spec):
+            with open(spec, "r", encoding="utf-8") as f:
+                return cls(**json.load(f))
+        return cls(**json.loads(spec))
+
+    def reset_stats(self):
+        """
+        Reset the counts of accepted pages and of the pages rejected by each rule
+        """
+
+        self.stats = dict.fromkeys(("accepted",) + FILTER_RULES, 0)
+
+    def rejects(self, line):
+        """
+        Check the rules on the raw line of a page
+
+        Args:
+            line (str or bytes): the line of the page
+
+        Returns:
+            str: the first rule rejecting the page, or None if it is accepted
+        """
+
+        for rule in self.rules:
+            if getattr(self, "_reject_" + rule)(line):
+                self.stats[rule] += 1
+                return rule
+        self.stats["accepted"] += 1
+        return None
+
+    @staticmethod
+    def _number(name: str, line):
+        """
+        Raw value of a number field of a page, or None if the page has none
+        """
+
+        patterns = RAW_NUMBER_BYTES if isinstance(line, bytes) else RAW_NUMBER
+        match = patterns[name].search(line)
+        return None if match is None else float(match.group(1))
+
+    def _reject_namespace(self, line):
+        namespace = self._number("namespace", line)
+        return namespace is not None and namespace not in self.namespaces
+
+    def _reject_title(self, line):
+        if isinstance(line, bytes):
+            match = RAW_TITLE_BYTES.search(line)
+        else:
+            match = RAW_TITLE.search(line)
+        if match is None:
+            return False
+        title = match.group(1)
+        if isinstance(title, bytes):
+            title = title.decode("utf-8")
+        if "\\" in title:
+            title = json.loads(f'"{title}"')
+        return self.exclude_title.search(title) is not None
+
+    def _reject_popularity_score(self, line):
+        popularity_score = self._number("popularity_score", line)
+        return (
+            popularity_score is not None
+            and popularity_score < self.min_popularity_score
+        )
+
+    def _reject_text_bytes(self, line):
+        text_bytes = self._number("text_bytes", line)
+        if text_bytes is None:
+            return False
+        if self.min_text_bytes is not None and text_bytes < self.min_text_bytes:
+            return True
+        return self.max_text_bytes is not None and text_bytes > self.max_text_bytes
+
+    def _reject_template(self, line):
+        if isinstance(line, bytes):
+            match = RAW_TEMPLATES_BYTES.search(line)
+        else:
+            match = RAW_TEMPLATES.search(line)
+        if match is None:
+            return False
+        templates = match.group(1)
+        if isinstance(templates, bytes):
+            templates = templates.decode("utf-8")
+        return not self.exclude_templates.isdisjoint(json.loads(f"[{templates}]"))
@@ -0,0 +1,512 @@
+"""
+Seekable index over gzip compressed Cirrus dumps, in the style of zlib's zran.c.
+
+A sequential pass over the dump records checkpoints at deflate block boundaries
+roughly every `span` uncompressed bytes. Each checkpoint stores the compressed
+offset, the bit offset inside that byte and the last 32KiB of uncompressed data
+(the inflate window), which is all inflate needs to resume there. The index is
+saved next to the dump, so decompression can later start at any checkpoint and
+independent workers can each handle their own part of the dump.
+
+Python's zlib module does not expose inflatePrime nor Z_BLOCK, so the system
+zlib library is used through ctypes.
+"""
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import struct
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+from typing import NamedTuple, Optional
+
+from tqdm.auto import tqdm
+
+WINDOW_SIZE = 32768
+CHUNK_SIZE = 1024 * 1024
+DEFAULT_SPAN = 32 * 1024 * 1024
+
+INDEX_SUFFIX = ".gzidx"
+INDEX_MAGIC = b"CWGZIDX1"
+# dump size, dump mtime, uncompressed size, span, number of checkpoints
+INDEX_HEADER = struct.Struct("<QdQQI")
+# uncompressed offset, compressed offset, bits, compressed window length
+INDEX_CHECKPOINT = struct.Struct("<QQBI")
+
+Z_OK = 0
+Z_STREAM_END = 1
+Z_BUF_ERROR = -5
+Z_NO_FLUSH = 0
+Z_BLOCK = 5
+# auto-detect gzip or zlib headers, and raw deflate with a 32KiB window
+GZIP_WBITS = 32 + 15
+RAW_WBITS = -15
+
+_libz = None
+
+
+class _ZStream(ctypes.Structure):
+    _fields_ = [
+        ("next_in", ctypes.c_void_p),
+        ("avail_in", ctypes.c_uint),
+        ("total_in", ctypes.c_ulong),
+        ("next_out", ctypes.c_void_p),
+        ("avail_out", ctypes.c_uint),
+        ("total_out", ctypes.c_ulong),
+        ("msg", ctypes.c_char_p),
+        ("state", ctypes.c_void_p),
+        ("zalloc", ctypes.c_void_p),
+        ("zfree", ctypes.c_void_p),
+        ("opaque", ctypes.c_void_p),
+        ("data_type", ctypes.c_int),
+        ("adler", ctypes.c_ulong),
+        ("reserved", ctypes.c_ulong),
+    ]
+
+
+def _load_libz():
+    """
+    Load the zlib shared library and declare the inflate functions we use
+    """
+
+    global _libz
+    if _libz is not None:
+        return _libz
+
+    path = ctypes.util.find_library("z")
+    if path is None:
+        raise RuntimeError("zlib shared library not found")
+
+    lib = ctypes.CDLL(path)
+    stream = ctypes.POINTER(_ZStream)
+    lib.zlibVersion.restype = ctypes.c_char_p
+    lib.inflateInit2_.argtypes = [stream, ctypes.c_int, ctypes.c_char_p, ctypes.c_int]
+    lib.inflate.argtypes = [stream, ctypes.c_int]
+    lib.inflateEnd.argtypes = [stream]
+    lib.inflateReset2.argtypes = [stream, ctypes.c_int]
+    lib.inflatePrime.argtypes = [stream, ctypes.c_int, ctypes.c_int]
+    lib.inflateSetDictionary.argtypes = [stream, ctypes.c_char_p, ctypes.c_uint]
+    _libz = lib
+    return lib
+
+
+class Checkpoint(NamedTuple):
+    """
+    Point of the dump where decompression can start
+
+    Args:
+        uncompressed (int): offset in the uncompressed dump
+        compressed (int): offset of the first full byte in the compressed dump
+        bits (int): number of bits of the previous byte that belong to this point
+        window (bytes): up to 32KiB of uncompressed data preceding the point
+    """
+
+    uncompressed: int
+    compressed: int
+    bits: int
+    window: bytes
+
+
+class _Inflater:
+    """
+    Minimal wrapper around a zlib inflate stream reading from a file
+    """
+
+    def __init__(self, f, wbits: int):
+        self.lib = _load_libz()
+        self.f = f
+        self.strm = _ZStream()
+        self.input = ctypes.create_string_buffer(CHUNK_SIZE)
+        self.output = ctypes.create_string_buffer(CHUNK_SIZE)
+        ret = self.lib.inflateInit2_(
+            ctypes.byref(self.strm),
+            wbits,
+            self.lib.zlibVersion(),
+            ctypes.sizeof(_ZStream),
+        )
+        if ret != Z_OK:
+            raise RuntimeError(f"inflateInit2 failed with {ret}")
+
+    def fill(self):
+        """
+        Read more compressed input, returns False at the end of the file
+        """
+
+        read = self.f.readinto(self.input)
+        self.strm.next_in = ctypes.addressof(self.input)
+        self.strm.avail_in = read
+        return read > 0
+
+    def skip(self, length: int):
+        """
+        Skip length bytes of compressed input, returns the number left to skip
+        """
+
+        skipped = min(length, self.strm.avail_in)
+        self.strm.next_in += skipped
+        self.strm.avail_in -= skipped
+        return length - skipped
+
+    def inflate(self, flush: int):
+        """
+        Inflate the available input, returns zlib's code and the produced bytes
+        """
+
+        self.strm.next_out = ctypes.addressof(self.output)
+        self.strm.avail_out = CHUNK_SIZE
+        ret = self.lib.inflate(ctypes.byref(self.strm), flush)
+        if ret not in (Z_OK, Z_STREAM_END, Z_BUF_ERROR):
+            message = self.strm.msg.decode() if self.strm.msg else ret
+            raise RuntimeError(f"Corrupted gzip data: {message}")
+        produced = CHUNK_SIZE - self.strm.avail_out
+        return ret, ctypes.string_at(self.output, produced)
+
+    def reset(self, wbits: int):
+        self.lib.inflateReset2(ctypes.byref(self.strm), wbits)
+
+    def close(self):
+        self.lib.inflateEnd(ctypes.byref(self.strm))
+
+
+def inflate_from(filename: str, checkpoint: Checkpoint):
+    """
+    Decompress a gzip file starting at a checkpoint
+
+    Args:
+        filename (str): gzip file
+        checkpoint (Checkpoint): where to start
+
+    Yields:
+        bytes: decompressed blocks, the first one starting at checkpoint.uncompressed
+    """
+
+    with open(filename, "rb") as f:
+        if checkpoint.uncompressed == 0:
+            inflater = _Inflater(f, GZIP_WBITS)
+            raw = False
+        else:
+            inflater = _Inflater(f, RAW_WBITS)
+            raw = True
+            f.seek(checkpoint.compressed - (1 if checkpoint.bits else 0))
+            if checkpoint.bits:
+                byte = f.read(1)[0]
+                inflater.lib.inflatePrime(
+                    ctypes.byref(inflater.strm),
+                    checkpoint.bits,
+                    byte >> (8 - checkpoint.bits),
+                )
+            inflater.lib.inflateSetDictionary(
+                ctypes.byref(inflater.strm), checkpoint.window, len(checkpoint.window)
+            )
+
+        try:
+            trailer = 0
+            while True:
+                if inflater.strm.avail_in == 0 and not inflater.fill():
+                    return
+                if trailer:
+                    # raw inflate stops before the gzip trailer of the member
+                    trailer = inflater.skip(trailer)
+                    if trailer or inflater.strm.avail_in == 0:
+                        continue
+
+                ret, block = inflater.inflate(Z_NO_FLUSH)
+                if block:
+                    yield block
+                if ret == Z_STREAM_END:
+                    # next gzip member, if any
+                    trailer = 8 if raw else 0
+                    inflater.reset(GZIP_WBITS)
+                    raw = False
+        finally:
+            inflater.close()
+
+
+def iter_lines(filename: str, checkpoint: Checkpoint, end: Optional[int] = None):
+    """
+    Iterate over the lines starting between a checkpoint and an uncompressed offset
+
+    A line belongs to the range that contains its first byte, so consecutive
+    ranges produce every line of the dump exactly once.
+
+    Args:
+        filename (str): gzip file
+        checkpoint (Checkpoint): start of the range
+        end (int, optional): end of the range in the uncompressed dump. Defaults
+            to the end of the dump.
+
+    Yields:
+        bytes: the lines, without line terminator
+    """
+
+    position = checkpoint.uncompressed
+    # the line at the checkpoint belongs to a previous range unless it starts there
+    skip = checkpoint.uncompressed != 0 and checkpoint.window[-1:] != b"\n"
+    pending = []
+
+    for block in inflate_from(filename, checkpoint):
+        start = 0
+        while True:
+            newline = block.find(b"\n", start)
+            if newline == -1:
+                pending.append(block[start:])
+                break
+
+            pending.append(block[start:newline])
+            if skip:
+                skip = False
+            else:
+                yield b"".join(pending)
+            pending = []
+            start = newline + 1
+
+            if end is not None and position + start >= end:
+                return
+        position += len(block)
+
+    if any(pending) and not skip:
+        yield b"".join(pending)
+
+
+def _decompress_range(filename: str, checkpoint: Checkpoint, end: int, output: str):
+    """
+    Decompress [checkpoint.uncompressed, end) into the same range of output
+    """
+
+    fd = os.open(output, os.O_WRONLY)
+    try:
+        position = checkpoint.uncompressed
+        for block in inflate_from(filename, checkpoint):
+            block = block[: end - position]
+            os.pwrite(fd, block, position)
+            position += len(block)
+            if position >= end:
+                break
+    finally:
+        os.close(fd)
+    return end - checkpoint.uncompressed
+
+
+class GzipIndex:
+    """
+    Checkpoint index over a gzip compressed dump
+
+    Args:
+        filename (str): gzip compressed dump
+        span (int, optional): uncompressed bytes between checkpoints. Defaults to 32MiB.
+        index_filename (str, optional): where to store the index. Defaults to
+            the dump filename followed by ".gzidx".
+
+    Examples:
+        >>> index = GzipIndex.open("enwiki-20230515-cirrussearch-content.json.gz")
+        >>> index.decompress("enwiki-20230515-cirrussearch-content.json", workers=8)
+
+        >>> for checkpoint, end in index.shards(8):
+        ...     for line in iter_lines(index.filename, checkpoint, end):
+        ...         ...
+    """
+
+    def __init__(
+        self,
+        filename: str,
+        span: int = DEFAULT_SPAN,
+        index_filename: Optional[str] = None,
+    ):
+        """
+        Initialize GzipIndex
+
+        Args:
+            filename (str): gzip compressed dump
+            span (int, optional): uncompressed bytes between checkpoints. Defaults to 32MiB.
+            index_filename (str, optional): where to store the index. Defaults to None.
+        """
+
+        self.filename = filename
+        self.span = span
+        self.index_filename = index_filename or filename + INDEX_SUFFIX
+        self.checkpoints = []
+        self.size = 0
+
+    @classmethod
+    def open(cls, filename: str, span: int = DEFAULT_SPAN):
+        """
+        Load the index saved next to the dump, building and saving it if needed
+
+        Args:
+            filename (str): gzip compressed dump
+            span (int, optional): uncompressed bytes between checkpoints. Defaults to 32MiB.
+
+        Returns:
+            GzipIndex: the index of the dump
+        """
+
+        index = cls(filename, span=span)
+        if not index.load():
+            index.build()
+            index.save()
+        return index
+
+    def build(self):
+        """
+        Build the index with a sequential pass over the dump
+        """
+
+        logging.info("Building gzip index of %s", self.filename)
+        self.checkpoints = [Checkpoint(0, 0, 0, b"")]
+        window = b""
+        compressed = uncompressed = last = 0
+
+        with open(self.filename, "rb") as f, tqdm(
+            total=os.path.getsize(self.filename),
+            unit="B",
+            unit_scale=True,
+            desc="Indexing",
+        ) as progress:
+            inflater = _Inflater(f, GZIP_WBITS)
+            try:
+                while True:
+                    if inflater.strm.avail_in == 0:
+                        if not inflater.fill():
+                            break
+                        progress.update(inflater.strm.avail_in)
+
+                    available = inflater.strm.avail_in
+                    ret, block = inflater.inflate(Z_BLOCK)
+                    compressed += available - inflater.strm.avail_in
+                    uncompressed += len(block)
+                    window = (window + block)[-WINDOW_SIZE:]
+
+                    if ret == Z_STREAM_END:
+                        inflater.reset(GZIP_WBITS)
+                        continue
+
+                    data_type = inflater.strm.data_type
+                    # at a block boundary that is not the end of the stream
+                    if (
+                        data_type & 128
+                        and not data_type & 64
+                        and uncompressed - last >= self.span
+                    ):
+                        self.checkpoints.append(
+                            Checkpoint(uncompressed, compressed, data_type & 7, window)
+                        )
+                        last = uncompressed
+            finally:
+                inflater.close()
+
+        self.size = uncompressed
+        logging.info("Indexed %s checkpoints", len(self.checkpoints))
+
+    def save(self):
+        """
+        Save the index next to the dump
+        """
+
+        stat = os.stat(self.filename)
+        with open(self.index_filename + ".tmp", "wb") as f:
+            f.write(INDEX_MAGIC)
+            f.write(
+                INDEX_HEADER.pack(
+                    stat.st_size,
+                    stat.st_mtime,
+                    self.size,
+                    self.span,
+                    len(self.checkpoints),
+                )
+            )
+            for checkpoint in self.checkpoints:
+                window = zlib.compress(checkpoint.window)
+                f.write(
+                    INDEX_CHECKPOINT.pack(
+                        checkpoint.uncompressed,
+                        checkpoint.compressed,
+                        checkpoint.bits,
+                        len(window),
+                    )
+                )
+                f.write(window)
+        os.replace(self.index_filename + ".tmp", self.index_filename)
+
+    def load(self):
+        """
+        Load the saved index if it was built for the current dump and span
+
+        Returns:
+            bool: whether the index was loaded
+        """
+
+        if not os.path.exists(self.index_filename):
+            return False
+
+        stat = os.stat(self.filename)
+        with open(self.index_filename, "rb") as f:
+            if f.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+                return False
+            size, mtime, uncompressed, span, count = INDEX_HEADER.unpack(
+                f.read(INDEX_HEADER.size)
+            )
+            if (size, mtime, span) != (stat.st_size, stat.st_mtime, self.span):
+                logging.info("Gzip index of %s is stale", self.filename)
+                return False
+
+            checkpoints = []
+            for _ in range(count):
+                offset, compressed, bits, length = INDEX_CHECKPOINT.unpack(
+                    f.read(INDEX_CHECKPOINT.size)
+                )
+                window = zlib.decompress(f.read(length))
+                checkpoints.append(Checkpoint(offset, compressed, bits, window))
+
+        self.checkpoints = checkpoints
+        self.size = uncompressed
+        return True
+
+    def shards(self, count: int):
+        """
+        Split the dump into ranges starting at checkpoints
+
+        Args:
+            count (int): number of shards wanted, fewer are returned if there
+                are not enough checkpoints
+
+        Returns:
+            list: (checkpoint, end) pairs covering the uncompressed dump
+        """
+
+        step = max(len(self.checkpoints) / max(count, 1), 1)
+        starts = sorted({int(i * step) for i in range(count)})
+        starts = [i for i in starts if i < len(self.checkpoints)]
+        ends = [self.checkpoints[i].uncompressed for i in starts[1:]] + [self.size]
+        return [(self.checkpoints[i], end) for i, end in zip(starts, ends)]
+
+    def decompress(self, output: str, workers: int = 1):
+        """
+        Decompress the dump into output, with workers decompressing shards in parallel
+
+        Args:
+            output (str): decompressed filename
+            workers (int, optional): number of worker processes. Defaults to 1.
+
+        Returns:
+            str: decompressed filename
+        """
+
+        with open(output, "wb") as f:
+            f.truncate(self.size)
+
+        # more shards than workers so that a slow shard does not hold up the others
+        shards = self.shards(workers * 4)
+        with ProcessPoolExecutor(max_workers=workers) as executor, tqdm(
+            total=self.size, unit="B", unit_scale=True, desc="Decompressing"
+        ) as progress:
+            futures = [
+                executor.submit(
+                    _decompress_range, self.filename, checkpoint, end, output
+                )
+                for checkpoint, end in shards
+            ]
+            for future in futures:
+                progress.update(future.result())
+
+        return output
@@ -0,0 +1,105 @@
+"""
+Lazy imports of the heavy dependencies, so that each stage only pays for the
+packages it uses.
+"""
+
+import importlib
+import sys
+import time
+
+# Seconds taken by the import of each lazy module, in import order
+import_times = {}
+
+# Lazy modules by name, imported or not
+lazy_modules = {}
+
+
+class LazyModule:
+    """
+    Module imported on the first access to one of its attributes
+
+    Args:
+        name (str): name of the module
+        optional (bool, optional): whether the module may be missing, in which
+            case the lazy module is false and its attributes raise ImportError.
+            Defaults to False.
+
+    Examples:
+        >>> transformers = LazyModule("transformers")
+        >>> transformers.AutoTokenizer.from_pretrained("bert-base-uncased")
+
+        >>> zstandard = LazyModule("zstandard", optional=True)
+        >>> if not zstandard:
+        ...     raise ImportError("zstd compressed output requires the zstandard package")
+    """
+
+    def __init__(self, name: str, optional: bool = False):
+        """
+        Initialize LazyModule
+        """
+
+        self._name = name
+        self._optional = optional
+        self._module = None
+        self._missing = False
+        lazy_modules.setdefault(name, self)
+
+    def _load(self):
+        """
+        Import the module once, timing the import
+
+        Returns:
+            module: the module, or None when an optional module is missing
+        """
+
+        if self._module is None and not self._missing:
+            start = time.perf_counter()
+            try:
+                self._module = importlib.import_module(self._name)
+            except ImportError:
+                if not self._optional:
+                    raise
+                self._missing = True
+                return None
+            if self._name not in import_times:
+                import_times[self._name] = time.perf_counter() - start
+        return self._module
+
+    def __getattr__(self, attribute: str):
+        if attribute.startswith("__") or attribute in ("_name", "_module"):
+            raise AttributeError(attribute)
+        module = self._load()
+        if module is None:
+            raise ImportError(f"No module named {self._name!r}")
+        return getattr(module, attribute)
+
+    def __bool__(self):
+        return self._load() is not None
+
+    def __reduce__(self):
+        return LazyModule, (self._name, self._optional)
+
+
+def print_import_times(seconds: float = None):
+    """
+    Print the time taken by each lazy import, and the lazy modules never imported
+
+    Args:
+        seconds (float, optional): duration of the whole run, to compare the
+            imports with. Defaults to None.
+    """
+
+    print("Lazy imports:")
+    for name, import_seconds in import_times.items():
+        print(f"    {name:<24} {import_seconds:8.3f}s")
+    total = sum(import_times.values())
+    print(f"    {'total':<24} {total:8.3f}s")
+    skipped = [
+        name
+        for name in lazy_modules
+        if name not in import_times and name not in sys.modules
+    ]
+    if skipped:
+        print(f"Not imported: {', '.join(skipped)}")
+    if seconds is not None:
+        print(f"Run took {seconds:.3f}s, {total / seconds:.0%} of it in lazy imports")
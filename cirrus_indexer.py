@@ -1,7 +1,47 @@
+import collections
+import itertools
 import json
+import os
+import time
 from typing import Optional
 
-from elasticsearch import Elasticsearch, helpers
+from cirrus_imports import LazyModule
+from cirrus_sinks import OUTPUT_FORMATS, path_format, read_chunks
+
+elasticsearch = LazyModule("elasticsearch")
+helpers = LazyModule("elasticsearch.helpers")
+
+# Explicit mapping of the chunks, instead of the text and keyword subfield
+# dynamic mapping gives every string
+MAPPINGS = {
+    "properties": {
+        "content": {"type": "text"},
+        "title": {
+            "type": "text",
+            "fields": {"keyword": {"type": "keyword", "ignore_above": 256}},
+        },
+        "popularity_score": {"type": "float"},
+        "name": {"type": "keyword"},
+        "page_id": {"type": "keyword"},
+    }
+}
+
+# Longest wait before sending again the documents Elasticsearch was too busy for
+MAX_BACKOFF = 600
+
+# Settings lifted while bulk loading, restored afterwards
+BULK_LOAD_SETTINGS = {"index.refresh_interval": "-1", "index.number_of_replicas": 0}
+
+
+def document_id(chunk: dict):
+    """
+    Id of the document of a chunk: its name, after the id of its page when
+    known, since the normalized titles of two pages can give the same name
+    (e.g. "Café" and "Cafe")
+    """
+
+    page_id = chunk.get("page_id")
+    return chunk["name"] if page_id is None else f"{page_id}/{chunk['name']}"
 
 
 class CirrusElasticsearchIndexer:
@@ -16,10 +56,32 @@ class CirrusElasticsearchIndexer:
         password (str, optional): password for Elasticsearch. Defaults to None.
         ca_certs (str, optional): path to CA certificates. Defaults to None.
         verify_certs (bool, optional): whether to verify certificates. Defaults to None.
+        batch_size (int, optional): maximum number of documents per bulk
+            request. Defaults to 20_000.
+        max_batch_bytes (int, optional): maximum size of a bulk request, which
+            bounds the memory taken by the documents in flight. Defaults to
+            16 MiB.
+        max_retries (int, optional): number of times a document rejected
+            because Elasticsearch is overloaded (429) is sent again, waiting
+            twice as long each time. Defaults to 3.
+        initial_backoff (float, optional): seconds to wait before the first
+            retry. Defaults to 2.
 
     Examples:
         >>> indexer = CirrusElasticsearchIndexer(index_name="wikicirrus")
         >>> indexer.index_file("wikicirrus/enwiki-20210501-cirrussearch-content.json")
+
+        >>> indexer.index_file(
+        ...     "wikicirrus/enwiki-20210501-cirrussearch-content.json",
+        ...     bulk_load=True,
+        ...     max_num_segments=1,
+        ... )
+
+        >>> indexer.index_file("wikicirrus/enwiki-20210501-cirrussearch-content.json", resume=True)
+        >>> indexer.index_file("wikicirrus/enwiki-20210501-cirrussearch-content-failed.json")
+
+        >>> indexer.delete_file("wikicirrus/enwiki-20210508-cirrussearch-content-deleted.json")
+        >>> indexer.index_file("wikicirrus/enwiki-20210508-cirrussearch-content-tokenized-delta.json")
     """
 
     def __init__(
@@ -30,6 +92,10 @@ class CirrusElasticsearchIndexer:
         password: Optional[str] = None,
         ca_certs: Optional[str] = None,
         verify_certs: Optional[bool] = None,
+        batch_size: int = 20_000,
+        max_batch_bytes: int = 16 << 20,
+        max_retries: int = 3,
+        initial_backoff: float = 2,
     ):
         """
         Initialize CirrusELasticsearchIndexer
@@ -39,11 +105,16 @@ class CirrusElasticsearchIndexer:
         """
 
         self.index_name = index_name
-        self.doc_store = doc_store or self._init_doc_store()
         self.username = username
         self.password = password
         self.ca_certs = ca_certs
         self.verify_certs = verify_certs
+        self.batch_size = batch_size
+        self.max_batch_bytes = max_batch_bytes
+        self.max_retries = max_retries
+        self.initial_backoff = initial_backoff
+        self.name_field = None
+        self.doc_store = doc_store or self._init_doc_store()
 
     def _init_doc_store(self):
         """
@@ -51,7 +122,7 @@ class CirrusElasticsearchIndexer:
         """
 
         if self.username and self.password:
-            doc_store = Elasticsearch(
+            doc_store = elasticsearch.Elasticsearch(
                 "https://localhost:9200",
                 http_auth=(self.username, self.password),
                 ca_certs=self.ca_certs,
@@ -59,7 +130,7 @@ class CirrusElasticsearchIndexer:
                 index=self.index_name,
             )
         else:
-            doc_store = Elasticsearch(
+            doc_store = elasticsearch.Elasticsearch(
                 "http://localhost:9200",
                 timeout=60,
                 max_retries=10,
@@ -67,48 +138,382 @@ class CirrusElasticsearchIndexer:
                 index=self.index_name,
             )
 
-        if not self.doc_store.ping():
+        if not doc_store.ping():
             raise RuntimeError("Elasticsearch is not running!")
 
         return doc_store
 
-    def index(self, data):
+    def index(
+        self,
+        data,
+        refresh: bool = True,
+        dead_letter_pathfile: Optional[str] = None,
+        on_checkpoint=None,
+    ):
         """
-        Index data into Elasticsearch
+        Index data into Elasticsearch, streaming it in bulk requests
+
+        The documents are pulled from data as the bulk requests are sent, so
+        that only the documents of the request being built are held in memory,
+        up to `batch_size` documents or `max_batch_bytes` bytes, along with
+        those waiting to be sent again. Each document gets an id made of its
+        page id and name (see `document_id`), so that indexing it again
+        replaces it rather than adding a copy.
+
+        Documents are sent `batch_size` at a time. Those rejected because
+        Elasticsearch is overloaded (429) are sent again with a backoff before
+        the next batch, and every document that still fails is reported, and
+        written to the dead-letter file to be indexed again later. A request
+        that fails altogether, e.g. when Elasticsearch is down, raises its
+        error, so that indexing can be resumed from the last checkpoint. The
+        index is refreshed once all the documents are sent.
 
         Args:
-            data (dict): data to be indexed
+            data (iterable): documents to be indexed, e.g. a generator
+            refresh (bool, optional): whether to refresh the index and print
+                its number of documents at the end. Defaults to True.
+            dead_letter_pathfile (str, optional): JSON lines file the failed
+                documents are appended to. Defaults to None.
+            on_checkpoint (callable, optional): called after every batch with
+                the number of leading documents of data done (indexed or
+                failed), and the numbers of indexed and of failed documents.
+                Defaults to None.
+
+        Returns:
+            tuple: number of indexed and of failed documents
         """
 
-        helpers.bulk(self.doc_store, data, index=self.index_name, batch_size=20_000)
+        indexed = failed = done = 0
+        dead_letter_f = None
+        documents = enumerate(data)
+        try:
+            while True:
+                batch = itertools.islice(documents, self.batch_size)
+                size = 0
+                for attempt in range(self.max_retries + 1):
+                    if attempt:
+                        time.sleep(
+                            min(MAX_BACKOFF, self.initial_backoff * 2 ** (attempt - 1))
+                        )
+                    retries = []
+                    for position, doc, ok, operation, result in self._send(batch):
+                        size += not attempt
+                        if ok:
+                            indexed += 1
+                        elif result.get("status") == 429 and attempt < self.max_retries:
+                            retries.append((position, doc))
+                        else:
+                            failed += 1
+                            error = result.get("error")
+                            if isinstance(error, dict):
+                                error = f"{error.get('type')}: {error.get('reason')}"
+                            print(
+                                f"Failed to {operation} document {result.get('_id')}: "
+                                f"status {result.get('status')}, {error}"
+                            )
+                            if dead_letter_pathfile is not None:
+                                if dead_letter_f is None:
+                                    dead_letter_f = open(
+                                        dead_letter_pathfile, "a", encoding="utf-8"
+                                    )
+                                dead_letter_f.write(json.dumps(doc) + "\n")
+                    if not retries:
+                        break
+                    batch = retries
+
+                if not size:
+                    break
+                done += size
+                if on_checkpoint is not None:
+                    if dead_letter_f is not None:
+                        dead_letter_f.flush()
+                        os.fsync(dead_letter_f.fileno())
+                    on_checkpoint(done, indexed, failed)
+        finally:
+            if dead_letter_f is not None:
+                dead_letter_f.close()
+
+        print(f"Indexed {indexed} docs with Elasticsearch, {failed} failed")
+        if failed and dead_letter_pathfile is not None:
+            print(f"Failed docs written to {dead_letter_pathfile}")
+        if refresh:
+            self.doc_store.indices.refresh(index=self.index_name)
+            stats = self.doc_store.indices.stats(index=self.index_name)
+            stats = stats["_all"]["primaries"]["docs"]["count"]
+            print(f"Total docs in index: {stats}")
+        return indexed, failed
+
+    def _send(self, documents):
+        """
+        Send documents in bulk requests, once
+
+        Args:
+            documents (iterable): (position, document) pairs
+
+        Yields:
+            tuple: position, document, whether it was indexed, operation and
+                result of each document, in the order they were sent
+        """
+
+        # without retries, results come back in the order of the documents,
+        # which tells them apart even when they share an id
+        sent = collections.deque()
+
+        def actions():
+            for position, doc in documents:
+                sent.append((position, doc))
+                yield dict(doc, _id=document_id(doc))
+
+        for ok, item in helpers.streaming_bulk(
+            self.doc_store,
+            actions(),
+            index=self.index_name,
+            chunk_size=self.batch_size,
+            max_chunk_bytes=self.max_batch_bytes,
+            raise_on_error=False,
+        ):
+            position, doc = sent.popleft()
+            operation, result = next(iter(item.items()))
+            yield position, doc, ok, operation, result
+
+    def create_index(self):
+        """
+        Create the index with the explicit mapping of the chunks, unless it
+        already exists
+
+        Returns:
+            bool: whether the index was created
+        """
+
+        if self.doc_store.indices.exists(index=self.index_name):
+            return False
+        self.doc_store.indices.create(
+            index=self.index_name, body={"mappings": MAPPINGS}
+        )
+        return True
+
+    def bulk_load(self, data, max_num_segments: Optional[int] = None, **kwargs):
+        """
+        Index data into Elasticsearch with the index tuned for ingest
+
+        The index is created with the explicit mapping of the chunks if needed,
+        and its refresh and replicas are turned off while the documents are
+        sent. Its settings are then restored, even if indexing fails, and it is
+        refreshed once, and optionally force-merged. The time spent in each
+        phase is printed.
+
+        Args:
+            data (iterable): documents to be indexed, e.g. a generator
+            max_num_segments (int, optional): number of segments to force-merge
+                the index into at the end. Defaults to None, for no merge.
+            **kwargs: arguments of `index`, e.g. the dead-letter file
+
+        Returns:
+            tuple: number of indexed and of failed documents
+        """
+
+        timings = {}
+        start = time.perf_counter()
+        created = self.create_index()
+        settings = self.doc_store.indices.get_settings(
+            index=self.index_name, flat_settings=True
+        )
+        # settings left to their default are reset to it by None
+        settings = next(iter(settings.values()))["settings"]
+        original = {name: settings.get(name) for name in BULK_LOAD_SETTINGS}
+        self.doc_store.indices.put_settings(
+            index=self.index_name, body=BULK_LOAD_SETTINGS
+        )
+        timings["setup"] = time.perf_counter() - start
+
+        try:
+            start = time.perf_counter()
+            result = self.index(data, refresh=False, **kwargs)
+            timings["index"] = time.perf_counter() - start
+        finally:
+            start = time.perf_counter()
+            self.doc_store.indices.put_settings(index=self.index_name, body=original)
+            timings["restore"] = time.perf_counter() - start
+
+        start = time.perf_counter()
         self.doc_store.indices.refresh(index=self.index_name)
+        timings["refresh"] = time.perf_counter() - start
+
+        if max_num_segments:
+            start = time.perf_counter()
+            self.doc_store.indices.forcemerge(
+                index=self.index_name, max_num_segments=max_num_segments
+            )
+            timings["force merge"] = time.perf_counter() - start
+
         stats = self.doc_store.indices.stats(index=self.index_name)
         stats = stats["_all"]["primaries"]["docs"]["count"]
-        print("Indexed %s docs with Elasticsearch", len(data))
-        print("Total docs in index: %s", stats)
+        print(f"Total docs in index: {stats}")
+        print(
+            f"Bulk load into {'new' if created else 'existing'} index "
+            f"{self.index_name}: "
+            + ", ".join(f"{phase} {seconds:.1f}s" for phase, seconds in timings.items())
+        )
+        return result
+
+    def index_file(
+        self,
+        filepath,
+        bulk_load: bool = False,
+        max_num_segments: Optional[int] = None,
+        resume: bool = False,
+    ):
+        """
+        Stream the contents of the file into Elasticsearch index
+
+        Every `batch_size` chunks, the number of leading chunks of the file
+        done is saved to `<filepath>.index-checkpoint`, which is removed once
+        the file is indexed. With resume, indexing goes on after the chunks of
+        the last checkpoint, if it was saved for the same file and index.
+        Chunks that fail are written to `<file>-failed.json`, which can be
+        indexed in turn.
+
+        Args:
+            filepath (str): file of tokenized chunks, in any of the output
+                formats of `cirrus_sinks`, told apart by its extension
+            bulk_load (bool, optional): whether to tune the index for ingest
+                while indexing, see `bulk_load`. Defaults to False.
+            max_num_segments (int, optional): number of segments to force-merge
+                the index into after a bulk load. Defaults to None.
+            resume (bool, optional): whether to resume from the last
+                checkpoint. Defaults to False.
+
+        Returns:
+            tuple: number of indexed and of failed documents, with those of
+                the resumed run
+        """
+
+        checkpoint_pathfile = filepath + ".index-checkpoint"
+        extension = OUTPUT_FORMATS[path_format(filepath)]
+        if filepath.endswith(extension):
+            dead_letter_pathfile = filepath[: -len(extension)] + "-failed.json"
+        else:
+            dead_letter_pathfile = filepath + "-failed.json"
+        stat = os.stat(filepath)
+        identity = {
+            "file": os.path.abspath(filepath),
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+            "index": self.index_name,
+        }
+
+        checkpoint = None
+        if resume and os.path.exists(checkpoint_pathfile):
+            with open(checkpoint_pathfile, "r", encoding="utf-8") as f:
+                checkpoint = json.load(f)
+            if any(checkpoint.get(name) != value for name, value in identity.items()):
+                checkpoint = None
+        if checkpoint is not None:
+            print(f"Resuming indexing of {filepath} after {checkpoint['done']} chunks")
+        else:
+            checkpoint = dict(identity, done=0, indexed=0, failed=0)
+            if os.path.exists(dead_letter_pathfile):
+                os.remove(dead_letter_pathfile)
+        start = dict(checkpoint)
+
+        def save_checkpoint(done: int, indexed: int, failed: int):
+            checkpoint.update(
+                done=start["done"] + done,
+                indexed=start["indexed"] + indexed,
+                failed=start["failed"] + failed,
+            )
+            with open(checkpoint_pathfile + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(checkpoint, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(checkpoint_pathfile + ".tmp", checkpoint_pathfile)
+
+        # records that failed to decode are not counted as done, so a few
+        # chunks may be indexed again on resume, replacing themselves
+        data = read_chunks(filepath, start=start["done"])
+        kwargs = dict(
+            dead_letter_pathfile=dead_letter_pathfile, on_checkpoint=save_checkpoint
+        )
+        if bulk_load:
+            indexed, failed = self.bulk_load(data, max_num_segments, **kwargs)
+        else:
+            indexed, failed = self.index(data, **kwargs)
+
+        if os.path.exists(checkpoint_pathfile):
+            os.remove(checkpoint_pathfile)
+        return start["indexed"] + indexed, start["failed"] + failed
+
+    def _name_of_chunks(self):
+        """
+        Field holding the exact names of the chunks: `name` with the explicit
+        mapping, or its keyword subfield in indices mapped dynamically
+        """
+
+        if self.name_field is None:
+            mappings = self.doc_store.indices.get_mapping(index=self.index_name)
+            mappings = next(iter(mappings.values()))["mappings"]
+            name = mappings.get("properties", {}).get("name", {})
+            self.name_field = (
+                "name" if name.get("type") == "keyword" else "name.keyword"
+            )
+        return self.name_field
+
+    def delete(self, ids):
+        """
+        Delete chunks from Elasticsearch by document id
+
+        Args:
+            ids (list): document ids of the chunks to delete, as given by
+                `document_id`
+        """
+
+        self._delete_by_query({"ids": {"values": ids}})
+
+    def delete_names(self, names):
+        """
+        Delete chunks from Elasticsearch by name, whatever their page
+
+        Args:
+            names (list): names of the chunks to delete
+        """
+
+        self._delete_by_query({"terms": {self._name_of_chunks(): names}})
 
-    def index_file(self, filepath):
+    def _delete_by_query(self, query: dict):
+        """
+        Delete the chunks matching a query from Elasticsearch
         """
-        Iterate over the file and index its contents into Elasticsearch index
+
+        response = self.doc_store.delete_by_query(
+            index=self.index_name, body={"query": query}, conflicts="proceed"
+        )
+        print(f"Deleted {response['deleted']} docs from Elasticsearch")
+
+    def delete_file(self, filepath):
+        """
+        Delete the chunks listed in a file from Elasticsearch index
+
+        Lines with a name only, as exported before chunks had page ids, delete
+        the chunks of that name.
 
         Args:
-            data (dict): data to be indexed
+            filepath (str): file with one {"_id": ...} object per line, as
+                exported by `CirrusPreprocess.tokenize_delta`
         """
 
         with open(filepath, "r", encoding="utf-8") as f:
-            articles = []
+            deletes = {"_id": self.delete, "name": self.delete_names}
+            batches = {field: [] for field in deletes}
 
             for line in f:
-                try:
-                    data = json.loads(line)
-                except json.decoder.JSONDecodeError:
-                    print("JSONDecodeError while reading line to index")
-                    continue
-
-                articles.append(data)
+                chunk = json.loads(line)
+                field = "_id" if "_id" in chunk else "name"
+                batches[field].append(chunk[field])
 
-                if len(articles) == 1_000_000:
-                    self.index(articles)
-                    articles = []
+                if len(batches[field]) == 10_000:
+                    deletes[field](batches[field])
+                    batches[field] = []
 
-            self.index(articles)
+            for field, values in batches.items():
+                if values:
+                    deletes[field](values)
@@ -1,9 +1,43 @@
+import concurrent.futures
 import json
+import multiprocessing
+import os
+import queue
+import time
+from typing import Optional
 
 from tqdm.auto import tqdm
-from transformers import AutoTokenizer
 
-from cirrus_clean import clean, normalize_title
+from cirrus_cache import CleanCache
+from cirrus_chunking import CHUNK_STRATEGIES, MAX_LENGTH, STRIDE, Chunker
+from cirrus_clean import WikiCleaner, normalize_title
+from cirrus_dedup import ChunkDeduplicator
+from cirrus_delta import PageState, chunk_names
+from cirrus_filter import PageFilter
+from cirrus_imports import LazyModule
+from cirrus_indexer import document_id
+from cirrus_reader import DumpReader
+from cirrus_sinks import (
+    OUTPUT_FORMATS,
+    concat_chunks,
+    open_writer,
+    output_files,
+    read_chunks,
+)
+
+transformers = LazyModule("transformers")
+
+# Fields the text of an article can be taken from
+TEXT_SOURCES = ("source_text", "text", "hybrid")
+
+# Ways to get the content of the chunks: decoding their tokens, or slicing the text
+CHUNK_TEXTS = ("decode", "offsets")
+
+# Byte ranges of the dump per worker, so that workers with short articles take more
+SHARDS_PER_WORKER = 4
+
+# Articles between two checkpoints of the tokenization of a dump file
+CHECKPOINT_EVERY = 10_000
 
 
 class CirrusPreprocess:
@@ -12,22 +46,165 @@ class CirrusPreprocess:
 
     Args:
         model_name (str): name of the model to use for tokenization
+        cleaner (WikiCleaner, optional): cleaner of the article wiki markup.
+            Defaults to a cleaner with all stages enabled, keeping the section
+            headings when chunking by section.
+        cache (CleanCache, optional): cache of the cleaned articles, checked
+            before cleaning. Defaults to None.
+        text_source (str, optional): "source_text" to clean the wikitext of
+            the articles, "text" to only normalize the plain text rendered by
+            MediaWiki, or "hybrid" to use the rendered text and clean the
+            wikitext of the articles without one. Defaults to "source_text".
+        batch_size (int, optional): number of articles tokenized at once.
+            Defaults to 64.
+        chunk_text (str, optional): "decode" to decode the tokens of the
+            chunks, or "offsets" to slice their text from the article, which
+            is faster but keeps the original case and spacing. Defaults to
+            "decode".
+        output_format (str, optional): format of the exported chunks, among
+            OUTPUT_FORMATS: "jsonl", "jsonl.gz", "jsonl.zst", "parquet", or
+            "tokens" for the token ids of the chunks instead of their content,
+            readable by `cirrus_sinks.TokenIdReader`. Defaults to "jsonl".
+        json_backend (str, optional): parser of the dump lines, "orjson",
+            "json", or "auto" for orjson when it is installed. Defaults to "auto".
+        chunker (Chunker, optional): splitter of the articles into chunks.
+            Defaults to fixed windows of MAX_LENGTH tokens overlapping by STRIDE.
+        deduplicator (ChunkDeduplicator, optional): detector of the chunks that
+            are near-duplicates of earlier ones, which are left out of the
+            export or marked. Defaults to None, for no detection.
+        page_filter (PageFilter, optional): filter of the pages, checked on
+            their raw line before they are parsed and cleaned. Defaults to
+            None, for all pages.
+
+    Raises:
+        ValueError: if an unknown text source, chunk text, output format or
+            JSON backend is given, if chunking along sentences without a
+            fast tokenizer, or if marking duplicates in a format other than
+            JSON lines
 
     Examples:
         >>> preprocess = CirrusPreprocess(model_name="bert-base-uncased")
         >>> preprocess.tokenize_content(article)
+
+        >>> preprocess = CirrusPreprocess(
+        ...     model_name="bert-base-multilingual-cased",
+        ...     cleaner=WikiCleaner(disable=("latinize",)),
+        ...     cache=CleanCache("data/clean-cache.sqlite"),
+        ... )
+
+        >>> preprocess = CirrusPreprocess(
+        ...     model_name="bert-base-uncased", chunker=Chunker("section", stride=32)
+        ... )
+        >>> preprocess.compare_chunking("data/enwiki-20230522-cirrussearch-content.json")
+
+        >>> preprocess = CirrusPreprocess(model_name="bert-base-uncased", text_source="text")
+        >>> preprocess.compare_text_sources("data/enwiki-20230522-cirrussearch-content.json")
+
+        >>> preprocess.tokenize_delta("data/enwiki-20230522-cirrussearch-content.json", "data")
+        ('data/enwiki-20230522-cirrussearch-content-tokenized-delta.json', 'data/enwiki-20230522-cirrussearch-content-deleted.json')
     """
 
-    def __init__(self, model_name: str):
+    def __init__(
+        self,
+        model_name: str,
+        cleaner: Optional[WikiCleaner] = None,
+        cache: Optional[CleanCache] = None,
+        text_source: str = "source_text",
+        batch_size: int = 64,
+        chunk_text: str = "decode",
+        output_format: str = "jsonl",
+        json_backend: str = "auto",
+        chunker: Optional[Chunker] = None,
+        deduplicator: Optional[ChunkDeduplicator] = None,
+        page_filter: Optional[PageFilter] = None,
+    ):
         """
         Initialize CirrusPreprocess
 
         Args:
             model_name (str): name of the model to use for tokenization
+            cleaner (WikiCleaner, optional): cleaner of the article wiki markup.
+                Defaults to None.
+            cache (CleanCache, optional): cache of the cleaned articles.
+                Defaults to None.
+            text_source (str, optional): field the text of the articles is
+                taken from. Defaults to "source_text".
+            batch_size (int, optional): number of articles tokenized at once.
+                Defaults to 64.
+            chunk_text (str, optional): how the content of the chunks is
+                obtained. Defaults to "decode".
+            output_format (str, optional): format of the exported chunks.
+                Defaults to "jsonl".
+            json_backend (str, optional): parser of the dump lines.
+                Defaults to "auto".
+            chunker (Chunker, optional): splitter of the articles into chunks.
+                Defaults to None.
+            deduplicator (ChunkDeduplicator, optional): detector of the
+                near-duplicate chunks. Defaults to None.
+            page_filter (PageFilter, optional): filter of the pages.
+                Defaults to None.
         """
 
+        if text_source not in TEXT_SOURCES:
+            raise ValueError(f"Unknown text source: {text_source}")
+        if chunk_text not in CHUNK_TEXTS:
+            raise ValueError(f"Unknown chunk text: {chunk_text}")
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(f"Unknown output format: {output_format}")
+        if (
+            deduplicator is not None
+            and deduplicator.mode == "mark"
+            and not output_format.startswith("jsonl")
+        ):
+            raise ValueError("Duplicates can only be marked in JSON lines")
+
         self.model_name = model_name
-        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.tokenizer = transformers.AutoTokenizer.from_pretrained(model_name)
+        self.chunker = chunker or Chunker()
+        if self.chunker.strategy != "fixed" and not self.tokenizer.is_fast:
+            raise ValueError("Chunking along sentences requires a fast tokenizer")
+        self.cleaner = cleaner or WikiCleaner(
+            headings=self.chunker.strategy == "section"
+        )
+        self.cache = cache
+        self.text_source = text_source
+        self.batch_size = batch_size
+        self.chunk_text = chunk_text
+        self.output_format = output_format
+        self.reader = DumpReader(backend=json_backend, page_filter=page_filter)
+        self.deduplicator = deduplicator
+
+    def settings(self):
+        """
+        Settings the exported chunks depend on, e.g. to tell whether an export
+        can be reused
+
+        Returns:
+            dict: the settings, as JSON values
+        """
+
+        deduplicator = self.deduplicator
+        return {
+            "model_name": self.model_name,
+            "cleaner": self.cleaner.version,
+            "text_source": self.text_source,
+            "chunk_text": self.chunk_text,
+            "output_format": self.output_format,
+            "chunking": [
+                self.chunker.strategy,
+                self.chunker.max_length,
+                self.chunker.stride,
+            ],
+            "dedup": deduplicator
+            and [
+                deduplicator.mode,
+                deduplicator.threshold,
+                deduplicator.num_perm,
+                deduplicator.shingle_size,
+                deduplicator.max_signatures,
+            ],
+            "page_filter": self.reader.page_filter and self.reader.page_filter.spec,
+        }
 
     def tokenize_content(self, article: dict):
         """
@@ -40,96 +217,1082 @@ class CirrusPreprocess:
             tokenized_article (list): list of tokenized article parts
         """
 
-        tokenized_article = []
+        return self.tokenize_batch([article])[0]
+
+    def tokenize_batch(self, articles: list):
+        """
+        Tokenize the content of several articles at once
+
+        With a fast tokenizer, all the articles go through a single call, which
+        the tokenizer spreads over its threads, longest articles first. Fixed
+        windows are cut by the tokenizer itself, while the other strategies of
+        the chunker split the whole tokens of each article along its sentences.
+        The chunk contents are then either decoded in one batch, giving the
+        same contents as decoding each chunk, or sliced from the article text
+        with the offset mapping when `chunk_text` is "offsets". With the
+        "tokens" output format, the chunks hold their "input_ids" instead of a
+        content.
+
+        Args:
+            articles (list): articles to tokenize
+
+        Returns:
+            list: the list of tokenized parts of each article (None for skipped
+                articles), in the order of articles
+        """
+
+        tokenized_articles = [None] * len(articles)
+        inputs = []
+        for index, article in enumerate(articles):
+            prepared = self._prepare(article)
+            if prepared is not None:
+                inputs.append((index, *prepared))
+        if not inputs:
+            return tokenized_articles
+
+        chunker = self.chunker
+        if not self.tokenizer.is_fast:
+            lengths = []
+            for index, title, text, popularity_score, _ in inputs:
+                inputs_ids = self.tokenizer.encode(
+                    text,
+                    max_length=chunker.max_length,
+                    stride=chunker.stride,
+                    truncation=True,
+                    add_special_tokens=False,
+                    return_overflowing_tokens=True,
+                )
+                lengths.extend(len(token_ids) for token_ids in inputs_ids)
+                if self.output_format != "tokens":
+                    inputs_ids = [
+                        self.tokenizer.decode(token_ids) for token_ids in inputs_ids
+                    ]
+                tokenized_articles[index] = self._chunks(
+                    title, popularity_score, inputs_ids, self._chunk_field
+                )
+            chunker.count(
+                len(inputs),
+                sum(lengths) - chunker.stride * (len(lengths) - len(inputs)),
+                lengths,
+            )
+            return tokenized_articles
+
+        # longest first, so that a long article is not left alone at the end
+        inputs.sort(key=lambda item: len(item[2]), reverse=True)
+        if chunker.strategy == "fixed":
+            encodings = self.tokenizer(
+                [text for _, _, text, _, _ in inputs],
+                max_length=chunker.max_length,
+                stride=chunker.stride,
+                truncation=True,
+                add_special_tokens=False,
+                return_overflowing_tokens=True,
+                return_offsets_mapping=self.chunk_text == "offsets",
+            )
+            samples, input_ids = (
+                encodings["overflow_to_sample_mapping"],
+                encodings["input_ids"],
+            )
+            offset_mapping = encodings.get("offset_mapping")
+            lengths = [len(token_ids) for token_ids in input_ids]
+            tokens = sum(lengths) - chunker.stride * (len(lengths) - len(inputs))
+        else:
+            samples, input_ids, offset_mapping, tokens = self._split_sentences(inputs)
+            lengths = [len(token_ids) for token_ids in input_ids]
+        chunker.count(len(inputs), tokens, lengths)
+
+        if self.output_format == "tokens":
+            contents = input_ids
+        elif self.chunk_text == "offsets":
+            contents = [
+                inputs[sample][2][offsets[0][0] : offsets[-1][1]] if offsets else ""
+                for sample, offsets in zip(samples, offset_mapping)
+            ]
+        elif not self.tokenizer.clean_up_tokenization_spaces:
+            # nothing to clean up after the Rust decoder, which decodes in parallel
+            contents = self.tokenizer.backend_tokenizer.decode_batch(
+                input_ids, skip_special_tokens=False
+            )
+        else:
+            contents = self.tokenizer.batch_decode(input_ids)
+
+        chunks = [[] for _ in inputs]
+        for sample, content in zip(samples, contents):
+            chunks[sample].append(content)
+        for (index, title, _, popularity_score, _), contents in zip(inputs, chunks):
+            tokenized_articles[index] = self._chunks(
+                title, popularity_score, contents, self._chunk_field
+            )
+        return tokenized_articles
 
-        title, text, popularity_score = (
+    def _split_sentences(self, inputs: list):
+        """
+        Tokenize whole articles and split their tokens with the chunker
+
+        Args:
+            inputs (list): (index, title, text, popularity_score, sections) of
+                the articles
+
+        Returns:
+            tuple: the article of each chunk, the token ids and offset mapping
+                of each chunk, and the number of tokens of the articles
+        """
+
+        encodings = self.tokenizer(
+            [text for _, _, text, _, _ in inputs],
+            add_special_tokens=False,
+            return_offsets_mapping=True,
+            verbose=False,
+        )
+        samples, input_ids, offset_mapping, tokens = [], [], [], 0
+        for sample, (item, token_ids, offsets) in enumerate(
+            zip(inputs, encodings["input_ids"], encodings["offset_mapping"])
+        ):
+            tokens += len(token_ids)
+            for start, end in self.chunker.ranges(item[2], offsets, item[4]):
+                samples.append(sample)
+                input_ids.append(token_ids[start:end])
+                offset_mapping.append(offsets[start:end])
+        return samples, input_ids, offset_mapping, tokens
+
+    @property
+    def _chunk_field(self):
+        """
+        Field of the chunks holding their tokens, as text or as ids
+        """
+
+        return "input_ids" if self.output_format == "tokens" else "content"
+
+    def _prepare(self, article: dict):
+        """
+        Get the normalized title, text to tokenize, popularity score and
+        sections of an article
+
+        Returns:
+            tuple: (title, text, popularity_score, sections), or None for
+                skipped articles
+        """
+
+        title, popularity_score = (
             article.get("title"),
-            article.get("source_text"),
             article.get("popularity_score", 0.0),
         )
 
         if title.lower().find("(disambiguation)") != -1:
             return None
 
-        if article.get("source_text") is None:
+        if not self._has_text(article):
             return None
 
         title = "unk-title" if title is None else title
         popularity_score = 0.0 if popularity_score is None else popularity_score
 
         title = normalize_title(title)
-        text = clean(text)
+        text = self.article_text(article, doc_id=title)
+        text, sections = self.chunker.sections(f"{title} \n {text}")
+        return title, text, popularity_score, sections
 
-        inputs_ids = self.tokenizer.encode(
-            f"{title} \n {text}",
-            max_length=256,
-            stride=64,
-            truncation=True,
-            add_special_tokens=False,
-            return_overflowing_tokens=True,
-        )
+    @staticmethod
+    def _chunks(
+        title: str, popularity_score: float, contents: list, field: str = "content"
+    ):
+        """
+        Build the tokenized article parts from the contents (or token ids) of the chunks
+        """
 
-        for split_id, token_ids in enumerate(inputs_ids):
-            tokenized_text = self.tokenizer.decode(token_ids)
-            title_id = "-".join(title.split(" "))
+        tokenized_article = []
+        title_id = "-".join(title.split(" "))
+        for split_id, tokenized_text in enumerate(contents):
             tokenized_rec = {
                 "name": f"{title_id}-part-{split_id}",
                 "title": title,
-                "content": tokenized_text,
+                field: tokenized_text,
                 "popularity_score": popularity_score,
             }
             tokenized_article.append(tokenized_rec)
 
         return tokenized_article
 
-    def tokenize_dump(self, filename: str, output_dir: str = None):
+    def article_text(self, article: dict, doc_id: str = None):
+        """
+        Get the plain text of the article, from the field set by the text source
+
+        Args:
+            article (dict): article of the dump
+            doc_id (str, optional): id of the article, logged by the cleaner.
+                Defaults to None.
+
+        Returns:
+            text (str): plain text of the article, or None when it has none
+        """
+
+        if self.text_source != "source_text" and article.get("text"):
+            return self.cleaner.normalize(article["text"])
+        if not self._has_text(article):
+            return None
+        if self.cache is not None:
+            return self.cache.clean(self.cleaner, article["source_text"], doc_id)
+        return self.cleaner.clean(article["source_text"], doc_id)
+
+    def _has_text(self, article: dict):
+        """
+        Whether the article has the field its text is taken from
+        """
+
+        if self.text_source != "source_text" and article.get("text"):
+            return True
+        return self.text_source != "text" and article.get("source_text") is not None
+
+    def compare_text_sources(self, filename: str, lines=None, limit: int = 1000):
+        """
+        Compare the throughput and output of the text sources on a sample of the dump
+
+        Every text source tokenizes the same first `limit` articles. The text of
+        the articles is compared to the cleaned `source_text`, by the Jaccard
+        similarity of their sets of words. The clean cache is not used.
+
+        Args:
+            filename (str): name of the dump file
+            lines (iterable, optional): lines of the dump. Defaults to reading filename.
+            limit (int, optional): number of articles to compare on. Defaults to 1000.
+
+        Returns:
+            report (dict): for each text source, the number of tokenized articles
+                and chunks, the seconds taken, the articles per second, and the
+                mean similarity and number of identical texts
+        """
+
+        if lines is None:
+            lines = self._read_lines(filename)
+
+        articles = []
+        for _, doc in DumpReader(backend=self.reader.backend).articles(lines):
+            if doc.get("source_text") is None:
+                continue
+            articles.append(doc)
+            if len(articles) >= limit:
+                break
+
+        text_source, cache = self.text_source, self.cache
+        self.cache = None
+        report, texts = {}, {}
+        try:
+            for source in TEXT_SOURCES:
+                self.text_source = source
+                start = time.perf_counter()
+                chunks = self.tokenize_batch(articles)
+                seconds = time.perf_counter() - start
+                texts[source] = [self.article_text(article) for article in articles]
+                report[source] = {
+                    "articles": sum(chunk is not None for chunk in chunks),
+                    "chunks": sum(len(chunk or []) for chunk in chunks),
+                    "seconds": round(seconds, 3),
+                    "articles_per_second": round(len(articles) / seconds, 1)
+                    if seconds
+                    else None,
+                }
+        finally:
+            self.text_source, self.cache = text_source, cache
+
+        for source in TEXT_SOURCES:
+            similarities = []
+            for text, reference in zip(texts[source], texts["source_text"]):
+                words, reference_words = set((text or "").split()), set(
+                    reference.split()
+                )
+                union = words | reference_words
+                similarities.append(
+                    len(words & reference_words) / len(union) if union else 1.0
+                )
+            report[source]["similarity"] = (
+                round(sum(similarities) / len(similarities), 3)
+                if similarities
+                else None
+            )
+            report[source]["identical"] = sum(
+                text == reference
+                for text, reference in zip(texts[source], texts["source_text"])
+            )
+
+        for source, stats in report.items():
+            print(
+                "{source}: {articles} articles, {chunks} chunks in {seconds}s "
+                "({articles_per_second} articles/s), similarity {similarity}, "
+                "{identical} identical".format(source=source, **stats)
+            )
+        return report
+
+    def compare_chunking(self, filename: str, lines=None, limit: int = 1000):
+        """
+        Compare the size of the chunks of each chunking strategy on a sample of the dump
+
+        Every strategy chunks the same first `limit` articles, with the
+        max_length of the chunker and the default stride of the strategy, the
+        section strategy cleaning the articles with their headings. The size of
+        the index is estimated by the JSON lines of the chunks, as sent to
+        Elasticsearch. The clean cache is not used.
+
+        Args:
+            filename (str): name of the dump file
+            lines (iterable, optional): lines of the dump. Defaults to reading filename.
+            limit (int, optional): number of articles to compare on. Defaults to 1000.
+
+        Returns:
+            report (dict): for each chunking strategy, the number of chunks, of
+                tokens and of tokens repeated from the previous chunk, the
+                mean tokens per chunk, the bytes of the chunks and the seconds
+                taken
+        """
+
+        if lines is None:
+            lines = self._read_lines(filename)
+
+        articles = []
+        for _, doc in DumpReader(backend=self.reader.backend).articles(lines):
+            if not self._has_text(doc):
+                continue
+            articles.append(doc)
+            if len(articles) >= limit:
+                break
+
+        chunker, headings, cache = self.chunker, self.cleaner.headings, self.cache
+        self.cache = None
+        report = {}
+        try:
+            for strategy in CHUNK_STRATEGIES:
+                self.chunker = Chunker(strategy, max_length=chunker.max_length)
+                self.cleaner.headings = strategy == "section"
+                start = time.perf_counter()
+                chunks = self.tokenize_batch(articles)
+                seconds = time.perf_counter() - start
+                stats = self.chunker.stats
+                report[strategy] = {
+                    "chunks": stats["chunks"],
+                    "tokens": stats["tokens"],
+                    "overlap": stats["overlap"],
+                    "tokens_per_chunk": round(stats["tokens"] / stats["chunks"], 1)
+                    if stats["chunks"]
+                    else None,
+                    "bytes": sum(
+                        len(json.dumps(chunk)) + 1
+                        for article_chunks in chunks
+                        for chunk in article_chunks or []
+                    ),
+                    "seconds": round(seconds, 3),
+                }
+        finally:
+            self.chunker, self.cleaner.headings, self.cache = chunker, headings, cache
+
+        for strategy, stats in report.items():
+            print(
+                "{strategy}: {chunks} chunks of {tokens_per_chunk} tokens, "
+                "{overlap} of {tokens} tokens repeated, {bytes} bytes in "
+                "{seconds}s".format(strategy=strategy, **stats)
+            )
+        return report
+
+    def tokenize_dump(
+        self,
+        filename: str,
+        output_dir: str = None,
+        lines=None,
+        workers: int = 1,
+        resume: bool = False,
+    ):
         """
         Tokenize the Cirrus wiki dump
 
+        With several workers, the decompressed dump is split into byte ranges
+        starting at an action line, each tokenized by a worker process into a
+        file of its own. The files are then concatenated into the export file
+        in order, which gives the same output as a single process. The
+        near-duplicate chunks are detected while concatenating, so that they
+        are detected across the ranges.
+
+        When the dump file is read, a checkpoint is saved next to the export
+        file (or to the file of each worker) every CHECKPOINT_EVERY articles,
+        with the offsets reached in the dump and in the synced output. With
+        `resume`, the output is truncated to the last checkpoint and the
+        tokenization goes on from there, giving the same output as a run that
+        was never interrupted.
+
         Args:
             filename (str): name of the file to tokenize
+            output_dir (str): directory to export the tokenized articles to
+            lines (iterable, optional): lines of the dump, e.g. streamed by
+                `CirrusDownloader.stream_dump`. Defaults to reading filename.
+            workers (int, optional): number of processes tokenizing the dump
+                file, when lines are not given. Defaults to 1.
+            resume (bool, optional): whether to resume from the last checkpoint
+                of a previous run. Defaults to False.
 
         Returns:
-            tokenized_all_docs (list): list of tokenized articles
+            export_pathfile (str): path of the exported tokenized articles
+
+        Raises:
+            ValueError: if resuming without reading the dump file, with the
+                Parquet output format or with near-duplicate detection
         """
-        doc_tracker, tokenized_doc_tracker = 0, 0
+
+        if resume and lines is not None:
+            raise ValueError("Only the tokenization of a dump file can be resumed")
+        if resume and self.output_format == "parquet":
+            raise ValueError("The Parquet output format cannot be resumed")
+        if resume and self.deduplicator is not None:
+            raise ValueError("Near-duplicate detection cannot be resumed")
 
         output_dir = output_dir + "/" if output_dir[-1] != "/" else output_dir
         export_pathfile = (
-            output_dir + filename.split("/")[-1].split(".")[0] + "-tokenized.json"
+            output_dir
+            + filename.split("/")[-1].split(".")[0]
+            + "-tokenized"
+            + OUTPUT_FORMATS[self.output_format]
         )
+
         print(f"Exporting tokenized articles to {export_pathfile}")
-        with open(filename, "r", encoding="utf-8") as dump_f:
-            for line in tqdm(dump_f, desc="Tokenizing articles"):
-                try:
-                    doc = json.loads(line)
-                    doc = dict(doc)
-                except json.decoder.JSONDecodeError:
-                    print("JSONDecodeError, skipping line")
-                    continue
+        self.reader.reset_stats()
+        self.chunker.reset_stats()
+        if self.deduplicator is not None:
+            self.deduplicator.reset()
+        if workers > 1 and lines is None:
+            doc_tracker, tokenized_doc_tracker = self._tokenize_shards(
+                filename, export_pathfile, workers, resume=resume
+            )
+        elif lines is None:
+            doc_tracker, tokenized_doc_tracker = self._tokenize_file(
+                filename, export_pathfile, resume=resume
+            )
+            if os.path.exists(export_pathfile + ".checkpoint"):
+                os.remove(export_pathfile + ".checkpoint")
+        else:
+            doc_tracker, tokenized_doc_tracker = self._tokenize_lines(
+                lines, export_pathfile
+            )
 
-                if doc.get("source_text") is None:
-                    continue
+        print(
+            f"Processed {doc_tracker} articles, which generated {tokenized_doc_tracker} tokenized articles"
+        )
+        self._print_stats(export_pathfile)
+        return export_pathfile
 
-                tokenized_article = self.tokenize_content(doc)
+    def tokenize_delta(
+        self,
+        filename: str,
+        output_dir: str = None,
+        lines=None,
+        commit: bool = True,
+    ):
+        """
+        Tokenize only the articles that are new or changed since the previous dump
 
-                doc_tracker += 1
-                if tokenized_article is None:
-                    continue
+        The page id and version of every article are kept in
+        `<output_dir>/<wiki>-pages.sqlite`. Articles whose version did not change
+        are skipped. The document ids of the chunks to remove from the index are
+        exported separately: the previous chunks of changed articles that are
+        not exported again (e.g. past the new number of chunks, or all of them
+        for a renamed article), and all the chunks of the articles missing from
+        the new dump. Without a previous state, every article is tokenized.
 
-                tokenized_doc_tracker += len(tokenized_article)
+        Without commit, the new state is kept pending until `commit_delta` is
+        called, e.g. once the delta is indexed, so that a run whose indexing
+        failed gives the same delta again rather than an empty one.
 
-                for article in tokenized_article:
-                    try:
-                        with open(export_pathfile, "a", encoding="utf-8") as export_f:
-                            export_f.write(json.dumps(article) + "\n")
-                    except Exception as e:
-                        raise (f"Error while writing to {export_pathfile}: {e}")
+        Args:
+            filename (str): name of the file to tokenize
+            output_dir (str): directory to export the tokenized articles to
+            lines (iterable, optional): lines of the dump. Defaults to reading filename.
+            commit (bool, optional): whether to persist the new state of the
+                pages right away. Defaults to True.
+
+        Returns:
+            tuple: path of the tokenized new and changed articles, and path of
+                the document ids of the chunks to delete
+        """
 
-                if doc_tracker % 1_000_000 == 0:
-                    print(f"Tokenized {doc_tracker} articles")
+        output_dir = output_dir + "/" if output_dir[-1] != "/" else output_dir
+        basename = filename.split("/")[-1].split(".")[0]
+        export_pathfile = (
+            output_dir
+            + basename
+            + "-tokenized-delta"
+            + OUTPUT_FORMATS[self.output_format]
+        )
+        deleted_pathfile = output_dir + basename + "-deleted.json"
+        if lines is None:
+            lines = self._read_lines(filename)
+
+        for pathfile in (export_pathfile, deleted_pathfile):
+            if os.path.exists(pathfile):
+                os.remove(pathfile)
+
+        state = PageState(
+            self._state_pathfile(filename, output_dir), pending=not commit
+        )
+        print(f"Exporting tokenized new and changed articles to {export_pathfile}")
+        self.reader.reset_stats()
+        self.chunker.reset_stats()
+        if self.deduplicator is not None:
+            self.deduplicator.reset()
+        with open(deleted_pathfile, "w", encoding="utf-8") as deleted_f:
+            doc_tracker, tokenized_doc_tracker = self._tokenize_lines(
+                lines, export_pathfile, state=state, deleted_f=deleted_f
+            )
+            for page_id, title_id, chunks in state.removed():
+                for name in chunk_names(title_id, chunks):
+                    chunk = {"name": name, "page_id": page_id}
+                    deleted_f.write(json.dumps({"_id": document_id(chunk)}) + "\n")
+        state.commit()
+        state.close()
 
         print(
             f"Processed {doc_tracker} articles, which generated {tokenized_doc_tracker} tokenized articles"
         )
-        return export_pathfile
+        self._print_stats(export_pathfile)
+        print(
+            "{new} new, {changed} changed, {unchanged} unchanged and {removed} removed articles".format(
+                **state.stats
+            )
+        )
+        return export_pathfile, deleted_pathfile
+
+    @staticmethod
+    def _state_pathfile(filename: str, output_dir: str):
+        """
+        Path of the state of the pages of the wiki of a dump
+        """
+
+        output_dir = output_dir + "/" if output_dir[-1] != "/" else output_dir
+        basename = filename.split("/")[-1].split(".")[0]
+        return output_dir + basename.split("-")[0] + "-pages.sqlite"
+
+    @classmethod
+    def commit_delta(cls, filename: str, output_dir: str):
+        """
+        Persist the state of the pages kept pending by `tokenize_delta`
+
+        Args:
+            filename (str): name of the file of the delta
+            output_dir (str): directory the delta was exported to
+
+        Returns:
+            bool: whether a pending state was persisted
+        """
+
+        return PageState.promote(cls._state_pathfile(filename, output_dir))
+
+    def _tokenize_shards(
+        self, filename: str, export_pathfile: str, workers: int, resume: bool = False
+    ):
+        """
+        Tokenize the dump file over worker processes and merge their output
+
+        Args:
+            filename (str): name of the file to tokenize
+            export_pathfile (str): path to export the tokenized articles to
+            workers (int): number of worker processes
+            resume (bool, optional): whether to resume every byte range from its
+                last checkpoint. Defaults to False.
+
+        Returns:
+            tuple: number of processed articles and of tokenized articles
+        """
+
+        offsets = self._shard_offsets(filename, workers * SHARDS_PER_WORKER)
+        shards = [
+            (filename, start, end, f"{export_pathfile}.shard-{index}", resume)
+            for index, (start, end) in enumerate(zip(offsets, offsets[1:]))
+        ]
+
+        progress = multiprocessing.Queue()
+        with concurrent.futures.ProcessPoolExecutor(
+            workers, initializer=_init_shard_worker, initargs=(self, progress)
+        ) as executor:
+            futures = [executor.submit(_tokenize_shard, *shard) for shard in shards]
+            with tqdm(
+                total=offsets[-1], unit="B", unit_scale=True, desc="Tokenizing articles"
+            ) as progress_bar:
+                while not all(future.done() for future in futures):
+                    try:
+                        progress_bar.update(progress.get(timeout=0.5))
+                    except queue.Empty:
+                        pass
+                results = [future.result() for future in futures]
+                while not progress.empty():
+                    progress_bar.update(progress.get())
+
+        doc_tracker, tokenized_doc_tracker = 0, 0
+        for docs, tokenized_docs, fallbacks, cache_stats, stats in results:
+            doc_tracker += docs
+            tokenized_doc_tracker += tokenized_docs
+            self.cleaner.fallbacks += fallbacks
+            if self.cache is not None:
+                self.cache.add_stats(cache_stats)
+            parse_stats, chunk_stats, filter_stats = stats
+            for name, count in parse_stats.items():
+                self.reader.stats[name] += count
+            for name, count in chunk_stats.items():
+                self.chunker.stats[name] += count
+            for name, count in filter_stats.items():
+                self.reader.page_filter.stats[name] += count
+
+        shard_pathfiles = [shard[3] for shard in shards]
+        if self.deduplicator is None:
+            concat_chunks(shard_pathfiles, export_pathfile, self.output_format)
+        else:
+            # in order, so that the same chunks are kept as by a single process
+            with open_writer(
+                export_pathfile, self.output_format, vocab_size=len(self.tokenizer)
+            ) as export_f:
+                for shard_pathfile in shard_pathfiles:
+                    if not os.path.exists(shard_pathfile):
+                        continue
+                    chunks = read_chunks(shard_pathfile, self.output_format)
+                    for chunk in self.deduplicator.filter(chunks):
+                        export_f.write(chunk)
+        for shard_pathfile in shard_pathfiles:
+            for pathfile in output_files(shard_pathfile, self.output_format) + [
+                shard_pathfile + ".checkpoint"
+            ]:
+                if os.path.exists(pathfile):
+                    os.remove(pathfile)
+
+        return doc_tracker, tokenized_doc_tracker
+
+    @staticmethod
+    def _shard_offsets(filename: str, shards: int):
+        """
+        Split the dump file into byte ranges starting at an action line
+
+        Returns:
+            list: the offsets of the ranges, followed by the size of the file
+        """
+
+        size = os.path.getsize(filename)
+        offsets = [0]
+        with open(filename, "rb") as dump_f:
+            for index in range(1, shards):
+                dump_f.seek(max(size * index // shards, offsets[-1]))
+                dump_f.readline()
+                offset = dump_f.tell()
+                # start at the action line of the article, when the dump has them
+                line = dump_f.readline()
+                if line and not line.startswith(b'{"index"'):
+                    if dump_f.readline().startswith(b'{"index"'):
+                        offset += len(line)
+                offsets.append(min(offset, size))
+        offsets.append(size)
+        return offsets
+
+    def _tokenize_file(
+        self,
+        filename: str,
+        export_pathfile: str,
+        start: int = 0,
+        end: int = None,
+        resume: bool = False,
+        progress=None,
+    ):
+        """
+        Tokenize the articles of a byte range of the dump file, with checkpoints
+
+        The checkpoints are saved to `<export_pathfile>.checkpoint`, which is
+        kept after the last articles so that a finished range is not redone.
+
+        Args:
+            filename (str): name of the file to tokenize
+            export_pathfile (str): path to export the tokenized articles to
+            start (int, optional): offset of the range. Defaults to 0.
+            end (int, optional): end of the range. Defaults to the end of the file.
+            resume (bool, optional): whether to resume from the last checkpoint.
+                Defaults to False.
+            progress (Queue, optional): queue to report the bytes read to,
+                instead of showing a progress bar. Defaults to None.
+
+        Returns:
+            tuple: number of processed articles and of tokenized articles
+        """
+
+        checkpoint_pathfile = export_pathfile + ".checkpoint"
+        identity = {
+            "filename": os.path.abspath(filename),
+            "size": os.path.getsize(filename),
+            "start": start,
+            "end": end,
+            "batch_size": self.batch_size,
+            **self.settings(),
+        }
+        checkpoint = None
+        if resume and os.path.exists(export_pathfile):
+            checkpoint = self._load_checkpoint(checkpoint_pathfile, identity)
+        if checkpoint is not None:
+            print(
+                f"Resuming {export_pathfile} after {checkpoint['docs']} articles, at byte {checkpoint['input']}"
+            )
+            self.cleaner.fallbacks += checkpoint["fallbacks"]
+            if progress is not None:
+                progress.put(checkpoint["input"] - start)
+
+        position = {"offset": checkpoint["input"] if checkpoint else start}
+        fallbacks = self.cleaner.fallbacks - (checkpoint or {}).get("fallbacks", 0)
+
+        def save_checkpoint(output: dict, docs: int, chunks: int):
+            self._save_checkpoint(
+                checkpoint_pathfile,
+                dict(
+                    identity,
+                    input=position["offset"],
+                    output=output,
+                    docs=docs,
+                    chunks=chunks,
+                    fallbacks=self.cleaner.fallbacks - fallbacks,
+                ),
+            )
+
+        return self._tokenize_lines(
+            _read_range(filename, position["offset"], end, progress, position),
+            export_pathfile,
+            progress=progress is None,
+            resume=checkpoint,
+            on_checkpoint=None if self.output_format == "parquet" else save_checkpoint,
+        )
+
+    @staticmethod
+    def _load_checkpoint(checkpoint_pathfile: str, identity: dict):
+        """
+        Load the last checkpoint if it was saved by the same tokenization
+        """
+
+        if not os.path.exists(checkpoint_pathfile):
+            return None
+
+        with open(checkpoint_pathfile, "r", encoding="utf-8") as f:
+            checkpoint = json.load(f)
+
+        if any(checkpoint.get(name) != value for name, value in identity.items()):
+            return None
+        return checkpoint
+
+    @staticmethod
+    def _save_checkpoint(checkpoint_pathfile: str, checkpoint: dict):
+        """
+        Atomically write a checkpoint
+        """
+
+        with open(checkpoint_pathfile + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(checkpoint, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(checkpoint_pathfile + ".tmp", checkpoint_pathfile)
+
+    def _print_stats(self, export_pathfile: str):
+        """
+        Print the parsing time, the pages rejected by each rule of the page
+        filter, the chunking statistics and size of the export file, the
+        near-duplicate ratio, the number of articles cleaned by the fallback
+        and the clean cache statistics
+        """
+
+        print(
+            "Parsed {articles} articles and {actions} action lines in {parse_seconds:.2f}s".format(
+                **self.reader.stats
+            )
+            + f" with {self.reader.backend}"
+        )
+        if self.reader.page_filter is not None:
+            rejects = ", ".join(
+                f"{count} by {rule}"
+                for rule, count in self.reader.page_filter.stats.items()
+                if rule != "accepted" and rule in self.reader.page_filter.rules
+            )
+            print(
+                f"Page filter rejected {self.reader.stats['filtered']} pages before parsing"
+                + (f": {rejects}" if rejects else "")
+            )
+        size = sum(
+            os.path.getsize(pathfile)
+            for pathfile in output_files(export_pathfile, self.output_format)
+        )
+        print(
+            "Chunked into {chunks} chunks of {tokens} tokens, {overlap} of them repeated".format(
+                **self.chunker.stats
+            )
+            + f" with the {self.chunker.strategy} strategy, exported in {size} bytes"
+        )
+        if self.deduplicator is not None:
+            stats = self.deduplicator.stats
+            print(
+                f"{stats['duplicates']} of {stats['chunks']} chunks were near-duplicates "
+                f"({stats['duplicates'] / (stats['chunks'] or 1):.1%}), "
+                + ("dropped" if self.deduplicator.mode == "drop" else "marked")
+                + f", {stats['forgotten']} chunks were forgotten"
+            )
+        if self.cleaner.fallbacks:
+            print(
+                f"{self.cleaner.fallbacks} articles over the cleaning budget were cleaned by the fallback"
+            )
+        if self.cache is not None:
+            print(
+                "Clean cache: {hits} hits, {misses} misses, {evictions} evictions, {bytes} bytes".format(
+                    **self.cache.stats
+                )
+            )
+
+    def _tokenize_lines(
+        self,
+        lines,
+        export_pathfile: str,
+        state: PageState = None,
+        deleted_f=None,
+        progress: bool = True,
+        resume: dict = None,
+        on_checkpoint=None,
+    ):
+        """
+        Tokenize the articles of the dump lines and export them
+
+        The export file is overwritten, and written through a single buffered
+        writer of the output format.
+
+        Args:
+            lines (iterable): lines of the dump
+            export_pathfile (str): path to export the tokenized articles to
+            state (PageState, optional): state of the previous dump, to skip
+                unchanged articles. Defaults to None.
+            deleted_f (file, optional): file to write the document ids of the
+                chunks to delete to. Defaults to None.
+            progress (bool, optional): whether to show a progress bar. Defaults to True.
+            resume (dict, optional): checkpoint to resume the export file and
+                the counters from, the lines following it. Defaults to None.
+            on_checkpoint (callable, optional): called with the checkpoint of
+                the export file and the counters every CHECKPOINT_EVERY articles
+                and after the last one. Defaults to None.
+
+        Returns:
+            tuple: number of processed articles and of tokenized articles
+        """
+
+        doc_tracker, tokenized_doc_tracker = 0, 0
+        if resume is not None:
+            doc_tracker, tokenized_doc_tracker = resume["docs"], resume["chunks"]
+        checkpoint_tracker = doc_tracker
+
+        with open_writer(
+            export_pathfile,
+            self.output_format,
+            vocab_size=len(self.tokenizer),
+            resume=resume and resume["output"],
+        ) as export_f:
+            for batch in self._batches(lines, state, progress):
+                tokenized_articles = self.tokenize_batch([doc for doc, _, _ in batch])
+                for (doc, page_id, previous), tokenized_article in zip(
+                    batch, tokenized_articles
+                ):
+                    doc_tracker += 1
+                    names, exported = [], []
+                    if tokenized_article is not None:
+                        tokenized_doc_tracker += len(tokenized_article)
+                        names = [article["name"] for article in tokenized_article]
+                        if page_id is not None:
+                            # tells apart pages whose normalized titles are the same
+                            for article in tokenized_article:
+                                article["page_id"] = str(page_id)
+
+                        if self.deduplicator is not None:
+                            tokenized_article = self.deduplicator.filter(
+                                tokenized_article
+                            )
+                        for article in tokenized_article:
+                            export_f.write(article)
+                            exported.append(article["name"])
+
+                    if state is not None:
+                        self._record_page(
+                            state, deleted_f, doc, page_id, previous, names, exported
+                        )
+
+                    if doc_tracker % 1_000_000 == 0:
+                        print(f"Tokenized {doc_tracker} articles")
+
+                if (
+                    on_checkpoint is not None
+                    and doc_tracker - checkpoint_tracker >= CHECKPOINT_EVERY
+                ):
+                    on_checkpoint(
+                        export_f.checkpoint(), doc_tracker, tokenized_doc_tracker
+                    )
+                    checkpoint_tracker = doc_tracker
+
+            if on_checkpoint is not None:
+                on_checkpoint(export_f.checkpoint(), doc_tracker, tokenized_doc_tracker)
+
+        if self.cache is not None:
+            self.cache.commit()
+
+        return doc_tracker, tokenized_doc_tracker
+
+    @staticmethod
+    def _record_page(
+        state: PageState,
+        deleted_f,
+        doc: dict,
+        page_id: str,
+        previous: Optional[tuple],
+        names: list,
+        exported: list,
+    ):
+        """
+        Record the new version and chunks of a new or changed page, and write
+        the ids of its previous chunks that are not exported again: the others
+        are replaced when the new chunks are indexed
+        """
+
+        if previous is not None:
+            exported = set(exported)
+            for name in chunk_names(previous[1], previous[2]):
+                if name not in exported:
+                    chunk = {"name": name, "page_id": str(page_id)}
+                    deleted_f.write(json.dumps({"_id": document_id(chunk)}) + "\n")
+        state.put(
+            page_id,
+            doc.get("version"),
+            names[0].rsplit("-part-", 1)[0] if names else "",
+            len(names),
+            new=previous is None,
+        )
+
+    def _batches(self, lines, state: PageState = None, progress: bool = True):
+        """
+        Group the articles of the dump lines to tokenize into batches
+
+        Articles without text are skipped, and so are unchanged articles when a
+        state is given, after marking them as seen.
+
+        Args:
+            lines (iterable): lines of the dump
+            state (PageState, optional): state of the previous dump. Defaults to None.
+            progress (bool, optional): whether to show a progress bar. Defaults to True.
+
+        Yields:
+            list: (article, page_id, previous) of up to `batch_size` articles,
+                with previous the state of the page in the previous dump
+        """
+
+        batch = []
+        lines = tqdm(lines, desc="Tokenizing articles", disable=not progress)
+        for page_id, doc in self.reader.articles(lines):
+            if not self._has_text(doc):
+                continue
+
+            previous = None
+            if state is not None:
+                page_id = page_id or doc.get("title")
+                previous = state.get(page_id)
+                if previous is not None and previous[0] == doc.get("version"):
+                    state.touch(page_id)
+                    continue
+
+            batch.append((doc, page_id, previous))
+            if len(batch) >= self.batch_size:
+                yield batch
+                batch = []
+
+        if batch:
+            yield batch
+
+    @staticmethod
+    def _read_lines(filename: str):
+        """
+        Read the lines of a decompressed dump file
+        """
+
+        with open(filename, "r", encoding="utf-8") as dump_f:
+            yield from dump_f
+
+
+_shard_preprocess = None
+_shard_progress = None
+
+
+def _init_shard_worker(preprocess: CirrusPreprocess, progress):
+    global _shard_preprocess, _shard_progress
+    # near-duplicates are detected across the ranges, when merging them
+    preprocess.deduplicator = None
+    _shard_preprocess = preprocess
+    _shard_progress = progress
+
+
+def _tokenize_shard(
+    filename: str, start: int, end: int, export_pathfile: str, resume: bool
+):
+    """
+    Tokenize the articles of a byte range of the dump file, in a worker process
+
+    Returns:
+        tuple: number of processed and tokenized articles, number of articles
+            cleaned by the fallback, clean cache statistics, and parsing,
+            chunking and page filter statistics of the range
+    """
+
+    preprocess = _shard_preprocess
+    fallbacks = preprocess.cleaner.fallbacks
+    cache_stats = dict(preprocess.cache.stats) if preprocess.cache else None
+    parse_stats = dict(preprocess.reader.stats)
+    chunk_stats = dict(preprocess.chunker.stats)
+    page_filter = preprocess.reader.page_filter
+    filter_stats = dict(page_filter.stats) if page_filter else {}
+
+    doc_tracker, tokenized_doc_tracker = preprocess._tokenize_file(
+        filename, export_pathfile, start, end, resume=resume, progress=_shard_progress
+    )
+
+    if cache_stats is not None:
+        cache_stats = {
+            name: preprocess.cache.stats[name] - count
+            for name, count in cache_stats.items()
+        }
+    return (
+        doc_tracker,
+        tokenized_doc_tracker,
+        preprocess.cleaner.fallbacks - fallbacks,
+        cache_stats,
+        (
+            {
+                name: preprocess.reader.stats[name] - count
+                for name, count in parse_stats.items()
+            },
+            {
+                name: preprocess.chunker.stats[name] - count
+                for name, count in chunk_stats.items()
+            },
+            {
+                name: page_filter.stats[name] - count
+                for name, count in filter_stats.items()
+            },
+        ),
+    )
+
+
+def _read_range(
+    filename: str, start: int, end: int = None, progress=None, position: dict = None
+):
+    """
+    Read the lines of a byte range of a decompressed dump file, reporting the
+    bytes read to the progress queue, and the offset following the last line
+    read as the "offset" of position
+    """
+
+    with open(filename, "rb") as dump_f:
+        dump_f.seek(start)
+        offset = reported = start
+        for line in dump_f:
+            if end is not None and offset >= end:
+                break
+            offset += len(line)
+            if position is not None:
+                position["offset"] = offset
+            yield line.decode("utf-8")
+            if progress is not None and offset - reported >= 1 << 20:
+                progress.put(offset - reported)
+                reported = offset
+    if progress is not None:
+        progress.put(offset - reported)
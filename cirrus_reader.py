@@ -0,0 +1,203 @@
+"""
+Reader of the lines of a Cirrus dump, skipping the bulk action lines without
+parsing them and keeping only the fields of the articles that are used.
+"""
+
+import json
+import re
+import time
+from typing import Optional
+
+from cirrus_filter import PageFilter
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# JSON parsers of the articles: the fastest available, orjson, or the standard library
+JSON_BACKENDS = ("auto", "orjson", "json")
+
+# Fields of the articles used by the preprocessing
+DOC_FIELDS = ("title", "source_text", "text", "popularity_score", "version")
+
+# Bulk action line preceding each article, e.g. {"index":{"_type":"page","_id":"12"}}
+ACTION_LINE = re.compile(r'\s*\{\s*"index"\s*:')
+ACTION_ID = re.compile(r'"_id"\s*:\s*(?:"([^"\\]*)"|(-?\d+)\s*[,}])')
+
+# Same patterns for the undecoded lines of `CirrusDownloader.stream_dump`
+ACTION_LINE_BYTES = re.compile(ACTION_LINE.pattern.encode("utf-8"))
+ACTION_ID_BYTES = re.compile(ACTION_ID.pattern.encode("utf-8"))
+
+
+class DumpReader:
+    """
+    Parser of the lines of a Cirrus dump
+
+    Action lines are told apart by their first key, and only their page id is
+    extracted, without parsing them. Articles are parsed in a single pass of
+    orjson (or of the C decoder of the standard library), which is faster
+    than skipping the unused values from Python, and only the given fields
+    are kept. With a page filter, the pages it rejects on their raw line are
+    skipped before being parsed. The time spent parsing is kept in `stats`.
+
+    Args:
+        fields (tuple, optional): fields of the articles to decode, or None for
+            all of them. Defaults to DOC_FIELDS.
+        backend (str, optional): "orjson", "json", or "auto" for orjson when it
+            is installed. Defaults to "auto".
+        page_filter (PageFilter, optional): filter of the pages, checked on
+            their raw line. Defaults to None.
+
+    Raises:
+        ValueError: if the backend is unknown
+        ImportError: if the orjson backend is missing
+
+    Examples:
+        >>> reader = DumpReader()
+        >>> for page_id, article in reader.articles(open("enwiki-cirrussearch-content.json")):
+        ...     print(page_id, article["title"])
+        >>> reader.stats
+        {'lines': 2, 'actions': 1, 'articles': 1, 'filtered': 0, 'errors': 0, 'parse_seconds': 0.0004}
+    """
+
+    def __init__(
+        self,
+        fields: tuple = DOC_FIELDS,
+        backend: str = "auto",
+        page_filter: Optional[PageFilter] = None,
+    ):
+        """
+        Initialize DumpReader
+        """
+
+        if backend not in JSON_BACKENDS:
+            raise ValueError(f"Unknown JSON backend: {backend}")
+        if backend == "orjson" and orjson is None:
+            raise ImportError("The orjson backend requires the orjson package")
+        if backend == "auto":
+            backend = "json" if orjson is None else "orjson"
+
+        self.fields = None if fields is None else frozenset(fields)
+        self.backend = backend
+        self.page_filter = page_filter
+        self.reset_stats()
+
+    def reset_stats(self):
+        """
+        Reset the counts of lines and the parsing time
+        """
+
+        self.stats = {
+            "lines": 0,
+            "actions": 0,
+            "articles": 0,
+            "filtered": 0,
+            "errors": 0,
+            "parse_seconds": 0.0,
+        }
+        if self.page_filter is not None:
+            self.page_filter.reset_stats()
+
+    def articles(self, lines):
+        """
+        Parse the articles of the dump lines
+
+        Lines that are not valid JSON objects are skipped, with a message, and
+        so are the pages rejected by the page filter.
+
+        Args:
+            lines (iterable): lines of the dump, as str or as bytes
+
+        Yields:
+            tuple: (page_id, article) with page_id taken from the preceding
+                action line (None without one), and article a dict of the
+                decoded fields
+        """
+
+        page_id = None
+        stats = self.stats
+        for line in lines:
+            start = time.perf_counter()
+            try:
+                action_line = (
+                    ACTION_LINE_BYTES if isinstance(line, bytes) else ACTION_LINE
+                )
+                if action_line.match(line):
+                    page_id = self.action_id(line)
+                    stats["actions"] += 1
+                    continue
+                if self.page_filter is not None and self.page_filter.rejects(line):
+                    stats["filtered"] += 1
+                    continue
+                article = self.loads(line)
+                if not isinstance(article, dict):
+                    raise json.decoder.JSONDecodeError("Not an object", "", 0)
+                stats["articles"] += 1
+            except json.decoder.JSONDecodeError:
+                stats["errors"] += 1
+                print("JSONDecodeError, skipping line")
+                continue
+            finally:
+                stats["lines"] += 1
+                stats["parse_seconds"] += time.perf_counter() - start
+
+            yield page_id, article
+            page_id = None
+
+    @staticmethod
+    def action_id(line):
+        """
+        Get the page id of an action line, without parsing it
+
+        Args:
+            line (str or bytes): the action line
+
+        Returns:
+            str: the page id, or None when the action line has none
+        """
+
+        if isinstance(line, bytes):
+            match = ACTION_ID_BYTES.search(line)
+            has_id = b'"_id"' in line
+        else:
+            match = ACTION_ID.search(line)
+            has_id = '"_id"' in line
+        if match is None:
+            if has_id:
+                return json.loads(line)["index"].get("_id")
+            return None
+        if match.group(1) is None:
+            return int(match.group(2))
+        page_id = match.group(1)
+        return page_id.decode("utf-8") if isinstance(page_id, bytes) else page_id
+
+    def loads(self, line):
+        """
+        Decode the fields of an article line
+
+        Returns:
+            dict: the decoded fields of the article
+
+        Raises:
+            json.decoder.JSONDecodeError: if the line is not valid JSON
+        """
+
+        article = loads(line) if self.backend == "orjson" else json.loads(line)
+        if self.fields is None or not isinstance(article, dict):
+            return article
+        return {key: value for key, value in article.items() if key in self.fields}
+
+
+def loads(line):
+    """
+    Decode a JSON line, with orjson when it is installed
+    """
+
+    if orjson is None:
+        return json.loads(line)
+    try:
+        return orjson.loads(line)
+    except orjson.JSONDecodeError:
+        # e.g. lone surrogates, which the standard library accepts
+        return json.loads(line)
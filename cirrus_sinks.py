@@ -0,0 +1,699 @@
+"""
+Writers and readers of the tokenized chunks, as JSON lines (optionally gzip or zstd
+compressed), as Parquet, or as memory-mapped token ids.
+"""
+
+import gzip
+import io
+import itertools
+import json
+import os
+import shutil
+
+from cirrus_imports import LazyModule
+from cirrus_reader import loads
+
+zstandard = LazyModule("zstandard", optional=True)
+numpy = LazyModule("numpy", optional=True)
+pyarrow = LazyModule("pyarrow", optional=True)
+parquet = LazyModule("pyarrow.parquet", optional=True)
+
+# Extension of the files of each output format
+OUTPUT_FORMATS = {
+    "jsonl": ".json",
+    "jsonl.gz": ".json.gz",
+    "jsonl.zst": ".json.zst",
+    "parquet": ".parquet",
+    "tokens": ".tokens",
+}
+
+# Files of the token ids output, next to its header: token ids, token offset of
+# every chunk, metadata of every chunk, and the names and titles it points to
+TOKEN_FILES = (".bin", ".idx", ".meta", ".strings")
+
+# Metadata of a chunk in the token ids output: byte offsets of its name and title
+# in the strings file (the title ends where the name of the next chunk starts)
+# and popularity score
+META_FIELDS = [
+    ("name", "<u8"),
+    ("title", "<u8"),
+    ("popularity_score", "<f8"),
+]
+
+# Bytes of JSON lines buffered between two writes
+BUFFER_SIZE = 1 << 22
+
+# Rows of each Parquet row group
+ROW_GROUP_SIZE = 100_000
+
+
+def path_format(path: str):
+    """
+    Get the output format of a file from its extension
+
+    Args:
+        path (str): path of the file
+
+    Returns:
+        str: the output format, "jsonl" for unknown extensions
+    """
+
+    for name, extension in sorted(
+        OUTPUT_FORMATS.items(), key=lambda item: -len(item[1])
+    ):
+        if path.endswith(extension):
+            return name
+    return "jsonl"
+
+
+class JsonlWriter:
+    """
+    Writer of records as JSON lines, through a large buffer
+
+    The file is opened once, and the lines are written by blocks of about
+    `buffer_size` bytes, compressed with gzip or zstd for the "jsonl.gz" and
+    "jsonl.zst" formats. At every checkpoint, the gzip member or zstd frame
+    is ended and the file synced to disk, so that a writer resumed from the
+    checkpoint writes the same bytes as one that was never interrupted.
+
+    Args:
+        path (str): path of the file
+        output_format (str, optional): "jsonl", "jsonl.gz" or "jsonl.zst".
+            Defaults to "jsonl".
+        mode (str, optional): "wb" to overwrite the file, or "ab" to append
+            to it. Defaults to "wb".
+        buffer_size (int, optional): bytes buffered between two writes.
+            Defaults to BUFFER_SIZE.
+        resume (dict, optional): checkpoint returned by `checkpoint`, the file
+            being truncated to it and appended to. Defaults to None.
+
+    Raises:
+        ImportError: if the zstandard package is missing for "jsonl.zst"
+
+    Examples:
+        >>> with JsonlWriter("data/enwiki-tokenized.json.gz", "jsonl.gz") as writer:
+        ...     writer.write({"name": "Anarchism-part-0", "content": "..."})
+    """
+
+    def __init__(
+        self,
+        path: str,
+        output_format: str = "jsonl",
+        mode: str = "wb",
+        buffer_size: int = BUFFER_SIZE,
+        resume: dict = None,
+    ):
+        """
+        Initialize JsonlWriter
+        """
+
+        self.path = path
+        self.output_format = output_format
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.buffered = 0
+        if resume is None:
+            self.raw = open(path, mode)
+        else:
+            self.raw = open(path, "r+b")
+            self.raw.truncate(resume["offset"])
+            self.raw.seek(resume["offset"])
+        self.stream = self._open_stream()
+
+    def _open_stream(self):
+        """
+        Open the (compressed) stream the lines are written to
+        """
+
+        if self.output_format == "jsonl.gz":
+            # no name nor time in the header, so that the output is reproducible
+            return gzip.GzipFile(
+                filename="", fileobj=self.raw, mode="wb", compresslevel=6, mtime=0
+            )
+        if self.output_format == "jsonl.zst":
+            if not zstandard:
+                raise ImportError(
+                    "zstd compressed output requires the zstandard package"
+                )
+            return zstandard.ZstdCompressor(level=3).stream_writer(
+                self.raw, closefd=False
+            )
+        return self.raw
+
+    def write(self, record: dict):
+        """
+        Write a record as a JSON line
+        """
+
+        line = json.dumps(record) + "\n"
+        self.buffer.append(line)
+        self.buffered += len(line)
+        if self.buffered >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the buffered lines to the stream
+        """
+
+        if self.buffer:
+            self.stream.write("".join(self.buffer).encode("utf-8"))
+            self.buffer = []
+            self.buffered = 0
+
+    def checkpoint(self):
+        """
+        Write and sync everything written so far, ending the compressed stream
+
+        Returns:
+            dict: the checkpoint, to resume writing from
+        """
+
+        self.flush()
+        if self.output_format == "jsonl.gz":
+            self.stream.close()
+        elif self.output_format == "jsonl.zst":
+            self.stream.flush(zstandard.FLUSH_FRAME)
+        self.raw.flush()
+        os.fsync(self.raw.fileno())
+        offset = self.raw.tell()
+        if self.output_format == "jsonl.gz":
+            # the header of the next member is written by the resumed writer too
+            self.stream = self._open_stream()
+        return {"offset": offset}
+
+    def close(self):
+        self.flush()
+        if self.stream is not self.raw:
+            self.stream.close()
+        self.raw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ParquetWriter:
+    """
+    Writer of records as Parquet row groups
+
+    Records are gathered into columns, written every `row_group_size` records.
+    The schema is the one of the tokenized chunks.
+
+    Args:
+        path (str): path of the file
+        compression (str, optional): Parquet compression codec, e.g. "zstd",
+            "snappy" or "none". Defaults to "zstd".
+        row_group_size (int, optional): records per row group. Defaults to ROW_GROUP_SIZE.
+
+    Raises:
+        ImportError: if the pyarrow package is missing
+    """
+
+    def __init__(
+        self,
+        path: str,
+        compression: str = "zstd",
+        row_group_size: int = ROW_GROUP_SIZE,
+    ):
+        """
+        Initialize ParquetWriter
+        """
+
+        if not parquet:
+            raise ImportError("Parquet output requires the pyarrow package")
+
+        self.path = path
+        self.row_group_size = row_group_size
+        self.schema = pyarrow.schema(
+            [
+                ("name", pyarrow.string()),
+                ("title", pyarrow.string()),
+                ("content", pyarrow.string()),
+                ("popularity_score", pyarrow.float64()),
+                ("page_id", pyarrow.string()),
+            ]
+        )
+        self.columns = {name: [] for name in self.schema.names}
+        self.writer = parquet.ParquetWriter(path, self.schema, compression=compression)
+
+    def write(self, record: dict):
+        """
+        Write a record
+        """
+
+        for name, column in self.columns.items():
+            column.append(record.get(name))
+        if len(self.columns["name"]) >= self.row_group_size:
+            self.flush()
+
+    def write_table(self, table):
+        """
+        Write a table of records, e.g. read from another Parquet file
+        """
+
+        self.flush()
+        self.writer.write_table(table.cast(self.schema))
+
+    def flush(self):
+        """
+        Write the gathered records as a row group
+        """
+
+        if self.columns["name"]:
+            self.writer.write_table(
+                pyarrow.Table.from_pydict(self.columns, schema=self.schema)
+            )
+            self.columns = {name: [] for name in self.schema.names}
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class TokenIdWriter:
+    """
+    Writer of the token ids of the chunks, for training consumers
+
+    The ids of all the chunks are written one after the other to `<path>.bin`,
+    as uint16 when the vocabulary fits, else as uint32. `<path>.idx` holds the
+    token offset of every chunk (and the total number of tokens) as uint64,
+    and `<path>.meta` a table of their name, title and popularity score, whose
+    strings are stored in `<path>.strings`. The header at `path` describes
+    the files, which `TokenIdReader` maps into memory.
+
+    Records must carry the token ids of the chunk as "input_ids".
+
+    Args:
+        path (str): path of the header, the other files being named after it
+        vocab_size (int): size of the vocabulary of the tokenizer
+        buffer_size (int, optional): tokens buffered between two writes.
+            Defaults to BUFFER_SIZE.
+        resume (dict, optional): checkpoint returned by `checkpoint`, the files
+            being truncated to it and appended to. Defaults to None.
+
+    Raises:
+        ImportError: if the numpy package is missing
+
+    Examples:
+        >>> with TokenIdWriter("data/enwiki-tokenized.tokens", 30522) as writer:
+        ...     writer.write({"name": "Anarchism-part-0", "input_ids": [101, 2023]})
+    """
+
+    def __init__(
+        self,
+        path: str,
+        vocab_size: int,
+        buffer_size: int = BUFFER_SIZE,
+        resume: dict = None,
+    ):
+        """
+        Initialize TokenIdWriter
+        """
+
+        if not numpy:
+            raise ImportError("Token ids output requires the numpy package")
+
+        self.path = path
+        self.vocab_size = vocab_size
+        self.dtype = numpy.uint16 if vocab_size <= 1 << 16 else numpy.uint32
+        self.buffer_size = buffer_size
+        self._reset()
+        if resume is not None:
+            self.files = {}
+            for extension in TOKEN_FILES:
+                self.files[extension] = open(path + extension, "r+b")
+                self.files[extension].truncate(resume["offsets"][extension])
+                self.files[extension].seek(resume["offsets"][extension])
+            self.chunks = resume["chunks"]
+            self.tokens = resume["tokens"]
+            self.strings = resume["strings"]
+            return
+
+        self.files = {
+            extension: open(path + extension, "wb") for extension in TOKEN_FILES
+        }
+        self.chunks = 0
+        self.tokens = 0
+        self.strings = 0
+        self.files[".idx"].write(numpy.zeros(1, dtype="<u8").tobytes())
+        self._write_header()
+
+    def _reset(self):
+        self.ids = []
+        self.offsets = []
+        self.meta = []
+        self.names = []
+        self.buffered = 0
+
+    def write(self, record: dict):
+        """
+        Write the token ids and metadata of a chunk
+        """
+
+        name = record["name"].encode("utf-8")
+        title = (record.get("title") or "").encode("utf-8")
+        self.meta.append(
+            (
+                self.strings,
+                self.strings + len(name),
+                record.get("popularity_score") or 0.0,
+            )
+        )
+        self.names.append(name + title)
+        self.strings += len(name) + len(title)
+
+        self.ids.append(record["input_ids"])
+        self.tokens += len(record["input_ids"])
+        self.offsets.append(self.tokens)
+        self.chunks += 1
+        self.buffered += len(record["input_ids"])
+        if self.buffered >= self.buffer_size:
+            self.flush()
+
+    def write_reader(self, reader):
+        """
+        Write all the chunks of another token ids output, e.g. of a worker
+        """
+
+        self.flush()
+        if reader.dtype != self.dtype:
+            raise ValueError(f"Token ids of {reader.path} are not {self.dtype}")
+        meta = numpy.array(reader.meta)
+        meta["name"] += self.strings
+        meta["title"] += self.strings
+        self.files[".bin"].write(reader.ids.tobytes())
+        self.files[".idx"].write((reader.offsets[1:] + self.tokens).tobytes())
+        self.files[".meta"].write(meta.tobytes())
+        self.files[".strings"].write(reader.strings.tobytes())
+        self.chunks += len(reader)
+        self.tokens += len(reader.ids)
+        self.strings += len(reader.strings)
+
+    def flush(self):
+        """
+        Write the buffered chunks to the files
+        """
+
+        if not self.offsets:
+            return
+        ids = numpy.fromiter(
+            itertools.chain.from_iterable(self.ids), self.dtype, self.buffered
+        )
+        self.files[".bin"].write(ids.tobytes())
+        self.files[".idx"].write(numpy.array(self.offsets, dtype="<u8").tobytes())
+        self.files[".meta"].write(numpy.array(self.meta, dtype=META_FIELDS).tobytes())
+        self.files[".strings"].write(b"".join(self.names))
+        self._reset()
+
+    def checkpoint(self):
+        """
+        Write and sync everything written so far
+
+        Returns:
+            dict: the checkpoint, to resume writing from
+        """
+
+        self.flush()
+        offsets = {}
+        for extension, f in self.files.items():
+            f.flush()
+            os.fsync(f.fileno())
+            offsets[extension] = f.tell()
+        return {
+            "offsets": offsets,
+            "chunks": self.chunks,
+            "tokens": self.tokens,
+            "strings": self.strings,
+        }
+
+    def close(self):
+        self.flush()
+        for f in self.files.values():
+            f.close()
+        self._write_header()
+
+    def _write_header(self):
+        with open(self.path, "w", encoding="utf-8") as header_f:
+            json.dump(
+                {
+                    "dtype": numpy.dtype(self.dtype).name,
+                    "vocab_size": self.vocab_size,
+                    "chunks": self.chunks,
+                    "tokens": self.tokens,
+                },
+                header_f,
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class TokenIdReader:
+    """
+    Random access to the chunks of a token ids output, mapped into memory
+
+    Args:
+        path (str): path of the header written by `TokenIdWriter`
+
+    Raises:
+        ImportError: if the numpy package is missing
+
+    Examples:
+        >>> reader = TokenIdReader("data/enwiki-tokenized.tokens")
+        >>> len(reader)
+        1834
+        >>> reader[0]
+        memmap([ 2019, 29348,  ...], dtype=uint16)
+        >>> reader.name(0), reader.title(0), reader.popularity_score(0)
+        ('Anarchism-part-0', 'Anarchism', 0.0001)
+    """
+
+    def __init__(self, path: str):
+        """
+        Initialize TokenIdReader
+        """
+
+        if not numpy:
+            raise ImportError("Token ids input requires the numpy package")
+
+        self.path = path
+        with open(path, "r", encoding="utf-8") as header_f:
+            self.header = json.load(header_f)
+        self.dtype = numpy.dtype(self.header["dtype"])
+        self.ids = self._map(".bin", self.dtype)
+        self.offsets = self._map(".idx", numpy.dtype("<u8"))
+        self.meta = self._map(".meta", numpy.dtype(META_FIELDS))
+        self.strings = self._map(".strings", numpy.dtype(numpy.uint8))
+
+    def _map(self, extension: str, dtype):
+        """
+        Map a file into memory, empty files having no mapping
+        """
+
+        if os.path.getsize(self.path + extension) == 0:
+            return numpy.zeros(0, dtype=dtype)
+        return numpy.memmap(self.path + extension, dtype=dtype, mode="r")
+
+    def __len__(self):
+        return len(self.meta)
+
+    def __getitem__(self, index: int):
+        """
+        Token ids of a chunk, as a view of the mapped file
+        """
+
+        return self.ids[self.offsets[index] : self.offsets[index + 1]]
+
+    def _string(self, start: int, end: int):
+        return self.strings[start:end].tobytes().decode("utf-8")
+
+    def name(self, index: int):
+        meta = self.meta[index]
+        return self._string(meta["name"], meta["title"])
+
+    def title(self, index: int):
+        if index + 1 < len(self):
+            end = self.meta[index + 1]["name"]
+        else:
+            end = len(self.strings)
+        return self._string(self.meta[index]["title"], end)
+
+    def popularity_score(self, index: int):
+        return float(self.meta[index]["popularity_score"])
+
+    def record(self, index: int):
+        """
+        Chunk as a record, with its token ids as a list
+        """
+
+        return {
+            "name": self.name(index),
+            "title": self.title(index),
+            "input_ids": self[index].tolist(),
+            "popularity_score": self.popularity_score(index),
+        }
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self.record(index)
+
+
+def open_writer(
+    path: str,
+    output_format: str = None,
+    mode: str = "wb",
+    vocab_size: int = None,
+    resume: dict = None,
+):
+    """
+    Open a writer of tokenized chunks
+
+    Args:
+        path (str): path of the file
+        output_format (str, optional): one of OUTPUT_FORMATS. Defaults to the
+            format of the extension of path.
+        mode (str, optional): "wb" to overwrite the file, or "ab" to append
+            to it, for JSON lines. Defaults to "wb".
+        vocab_size (int, optional): size of the vocabulary of the tokenizer,
+            required for token ids. Defaults to None.
+        resume (dict, optional): checkpoint of a previous writer of the file to
+            resume from, for JSON lines and token ids. Defaults to None.
+
+    Returns:
+        JsonlWriter, ParquetWriter or TokenIdWriter: the writer
+    """
+
+    output_format = output_format or path_format(path)
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format: {output_format}")
+    if output_format in ("parquet", "tokens") and mode != "wb":
+        raise ValueError(f"{output_format} files can only be written from scratch")
+    if output_format == "parquet":
+        if resume is not None:
+            raise ValueError("Parquet files cannot be resumed")
+        return ParquetWriter(path)
+    if output_format == "tokens":
+        if vocab_size is None:
+            raise ValueError("Token ids output requires the vocabulary size")
+        return TokenIdWriter(path, vocab_size, resume=resume)
+    return JsonlWriter(path, output_format, mode, resume=resume)
+
+
+def output_files(path: str, output_format: str = None):
+    """
+    Files written for an output path, e.g. to remove them
+
+    Args:
+        path (str): path of the output
+        output_format (str, optional): one of OUTPUT_FORMATS. Defaults to the
+            format of the extension of path.
+
+    Returns:
+        list: path, followed by the files next to it for token ids
+    """
+
+    output_format = output_format or path_format(path)
+    if output_format == "tokens":
+        return [path] + [path + extension for extension in TOKEN_FILES]
+    return [path]
+
+
+def read_chunks(path: str, output_format: str = None, start: int = 0):
+    """
+    Read back the tokenized chunks of a file, in any output format
+
+    Args:
+        path (str): path of the file
+        output_format (str, optional): one of OUTPUT_FORMATS. Defaults to the
+            format of the extension of path.
+        start (int, optional): number of records (lines of JSON, rows) to skip
+            without decoding them, e.g. to resume. Defaults to 0.
+
+    Yields:
+        dict: the chunks
+    """
+
+    output_format = output_format or path_format(path)
+    if output_format == "parquet":
+        if not parquet:
+            raise ImportError("Parquet input requires the pyarrow package")
+        for batch in parquet.ParquetFile(path).iter_batches():
+            if start >= batch.num_rows:
+                start -= batch.num_rows
+                continue
+            yield from batch.slice(start).to_pylist()
+            start = 0
+        return
+    if output_format == "tokens":
+        reader = TokenIdReader(path)
+        for index in range(start, len(reader)):
+            yield reader.record(index)
+        return
+
+    if output_format == "jsonl.gz":
+        binary_f = gzip.open(path, "rb")
+    elif output_format == "jsonl.zst":
+        if not zstandard:
+            raise ImportError("zstd compressed input requires the zstandard package")
+        binary_f = zstandard.ZstdDecompressor().stream_reader(
+            open(path, "rb"), read_across_frames=True, closefd=True
+        )
+    else:
+        binary_f = open(path, "rb")
+
+    with io.TextIOWrapper(io.BufferedReader(binary_f), encoding="utf-8") as f:
+        for line in itertools.islice(f, start, None):
+            try:
+                yield loads(line)
+            except json.decoder.JSONDecodeError:
+                print("JSONDecodeError while reading line to index")
+
+
+def concat_chunks(paths: list, path: str, output_format: str = None):
+    """
+    Concatenate files of tokenized chunks into one, in order
+
+    Compressed JSON lines are concatenated as they are, as gzip members or zstd
+    frames; Parquet files are rewritten one row group at a time, and token ids
+    with their offsets shifted.
+
+    Args:
+        paths (list): paths of the files to concatenate, missing ones are skipped
+        path (str): path of the concatenated file
+        output_format (str, optional): one of OUTPUT_FORMATS. Defaults to the
+            format of the extension of path.
+    """
+
+    output_format = output_format or path_format(path)
+    paths = [part for part in paths if os.path.exists(part)]
+    if output_format == "parquet":
+        with ParquetWriter(path) as writer:
+            for part in paths:
+                part_file = parquet.ParquetFile(part)
+                for index in range(part_file.num_row_groups):
+                    writer.write_table(part_file.read_row_group(index))
+        return
+    if output_format == "tokens":
+        readers = [TokenIdReader(part) for part in paths]
+        vocab_size = max([reader.header["vocab_size"] for reader in readers], default=0)
+        with TokenIdWriter(path, vocab_size) as writer:
+            for reader in readers:
+                writer.write_reader(reader)
+        return
+
+    with open(path, "wb") as f:
+        for part in paths:
+            with open(part, "rb") as part_f:
+                shutil.copyfileobj(part_f, f, BUFFER_SIZE)
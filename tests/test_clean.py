@@ -0,0 +1,30 @@
+import json
+import os
+
+import pytest
+
+from cirrus_clean import WikiCleaner, clean
+
+# Wiki markup and its cleaned text, as given by the cleaner before it was
+# optimized and made configurable
+GOLDEN = os.path.join(os.path.dirname(__file__), "data", "clean_golden.jsonl")
+
+
+def golden():
+    with open(GOLDEN, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+@pytest.mark.parametrize("regex_backend", ["re", "re2"])
+def test_clean_golden(regex_backend):
+    if regex_backend == "re2":
+        pytest.importorskip("re2")
+    cleaner = WikiCleaner(regex_backend=regex_backend)
+
+    for i, case in enumerate(golden()):
+        assert cleaner.clean(case["text"]) == case["clean"], f"line {i + 1}"
+
+
+def test_clean_function_golden():
+    for i, case in enumerate(golden()):
+        assert clean(case["text"]) == case["clean"], f"line {i + 1}"
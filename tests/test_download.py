@@ -0,0 +1,175 @@
+import hashlib
+import json
+import os
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import cirrus_download
+from cirrus_download import CirrusDownloader
+
+DUMP = "enwiki-20230101-cirrussearch-content.json.gz"
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """
+    Serve the files of the server, with Range support, recording the requests
+    """
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.send(head=True)
+
+    def do_GET(self):
+        self.send()
+
+    def send(self, head=False):
+        server = self.server
+        data = server.files[self.path.lstrip("/")]
+        server.requests.append((self.command, self.headers.get("Range")))
+
+        if self.headers.get("Range"):
+            first, last = self.headers["Range"].split("=")[1].split("-")
+            first, last = int(first), int(last) if last else len(data) - 1
+            body = data[first : last + 1]
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {first}-{last}/{len(data)}")
+        else:
+            body = data
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", server.etag)
+        self.end_headers()
+        if head:
+            return
+
+        if server.cut is not None and self.headers.get("Range", "").startswith(
+            f"bytes={server.cut}-"
+        ):
+            # the connection drops halfway through the segment
+            body = body[: len(body) // 2]
+            server.cut = None
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), RangeHandler)
+    server.files, server.requests, server.etag, server.cut = {}, [], '"v1"', None
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    server.url = f"http://127.0.0.1:{server.server_port}/"
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def write_listing(path, files):
+    with open(path, "w", encoding="utf-8") as f:
+        for name, data in files.items():
+            f.write(f"{hashlib.sha1(data).hexdigest()}  {name}\n")
+    return str(path)
+
+
+def ranges(server):
+    return sorted(
+        (rng for command, rng in server.requests if command == "GET" and rng),
+        key=lambda rng: int(rng.split("=")[1].split("-")[0]),
+    )
+
+
+def test_download_segments(tmp_path, server):
+    data = random.Random(1).randbytes(100_000)
+    server.files[DUMP] = data
+    listing = write_listing(tmp_path / "sha1sums.txt", server.files)
+    output = str(tmp_path / "out")
+
+    filename = CirrusDownloader(output=output, segments=4).download_file(
+        server.url + DUMP, output, checksum=listing
+    )
+
+    with open(filename, "rb") as f:
+        assert f.read() == data
+    assert ranges(server) == [
+        "bytes=0-24999",
+        "bytes=25000-49999",
+        "bytes=50000-74999",
+        "bytes=75000-99999",
+    ]
+    assert sorted(os.listdir(output)) == [DUMP, "manifest.json"]
+    with open(os.path.join(output, "manifest.json"), encoding="utf-8") as f:
+        record = json.load(f)[DUMP]
+    assert record["size"] == len(data)
+    assert record["checksum"] == "sha1:" + hashlib.sha1(data).hexdigest()
+
+
+def test_download_resumes_from_state(tmp_path, server, monkeypatch):
+    monkeypatch.setattr(cirrus_download, "CHUNK_SIZE", 1000)
+    monkeypatch.setattr(cirrus_download, "STATE_FLUSH_BYTES", 1000)
+    data = random.Random(2).randbytes(100_000)
+    server.files[DUMP] = data
+    server.cut = 50_000
+    output = str(tmp_path / "out")
+
+    with pytest.raises(RuntimeError):
+        CirrusDownloader(output=output, segments=4).download_file(
+            server.url + DUMP, output
+        )
+    with open(os.path.join(output, DUMP + ".state"), encoding="utf-8") as f:
+        written = [segment[2] for segment in json.load(f)["segments"]]
+    assert written[2] == 12_500
+    assert written[:2] + written[3:] == [25_000, 25_000, 25_000]
+
+    server.requests.clear()
+    filename = CirrusDownloader(output=output, segments=4).download_file(
+        server.url + DUMP, output
+    )
+
+    with open(filename, "rb") as f:
+        assert f.read() == data
+    assert ranges(server) == ["bytes=62500-74999"]
+    assert sorted(os.listdir(output)) == [DUMP, "manifest.json"]
+
+
+def test_download_checksum_mismatch(tmp_path, server):
+    data = random.Random(3).randbytes(100_000)
+    server.files[DUMP] = data[:5000] + b"x" + data[5001:]
+    listing = write_listing(tmp_path / "sha1sums.txt", {DUMP: data})
+    output = str(tmp_path / "out")
+
+    with pytest.raises(RuntimeError, match="sha1 mismatch"):
+        CirrusDownloader(output=output, segments=4).download_file(
+            server.url + DUMP, output, checksum=listing
+        )
+    assert os.listdir(output) == []
+
+    server.files[DUMP] = data
+    server.requests.clear()
+    filename = CirrusDownloader(output=output, segments=4).download_file(
+        server.url + DUMP, output, checksum=listing
+    )
+
+    with open(filename, "rb") as f:
+        assert f.read() == data
+    assert len(ranges(server)) == 4
+
+
+@pytest.mark.parametrize("data", [b"", b"tiny"])
+def test_download_small_file_in_one_stream(tmp_path, server, data):
+    server.files[DUMP] = data
+    listing = write_listing(tmp_path / "sha1sums.txt", server.files)
+    output = str(tmp_path / "out")
+
+    filename = CirrusDownloader(output=output, segments=8).download_file(
+        server.url + DUMP, output, checksum=listing
+    )
+
+    with open(filename, "rb") as f:
+        assert f.read() == data
+    assert server.requests == [("HEAD", None), ("GET", None)]
+    assert sorted(os.listdir(output)) == [DUMP, "manifest.json"]
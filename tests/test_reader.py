@@ -0,0 +1,78 @@
+import gzip
+import json
+
+from cirrus_download import CirrusDownloader
+from cirrus_filter import PageFilter
+from cirrus_reader import DumpReader
+
+PAGES = [
+    (
+        {"index": {"_type": "page", "_id": "12"}},
+        {"title": "Café", "namespace": 0, "text_bytes": 900, "text": "Un café."},
+    ),
+    (
+        {"index": {"_type": "page", "_id": 13}},
+        {"title": "Stub", "namespace": 0, "text_bytes": 10, "text": "Short."},
+    ),
+    (
+        {"index": {"_id": "14"}},
+        {"title": "Talk:Café", "namespace": 1, "text_bytes": 900, "text": "Talk."},
+    ),
+    (
+        {"index": {"_id": "15"}},
+        {
+            "title": "Liste",
+            "namespace": 0,
+            "text_bytes": 900,
+            "template": ["Template:Liste"],
+            "text": "A list.",
+        },
+    ),
+]
+
+
+def write_dump(path):
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        for action, page in PAGES:
+            f.write(
+                json.dumps(action) + "\n" + json.dumps(page, ensure_ascii=False) + "\n"
+            )
+
+
+def test_stream_dump_lines(tmp_path):
+    path = str(tmp_path / "dump.json.gz")
+    write_dump(path)
+
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        expected = list(DumpReader().articles(f))
+    streamed = list(
+        DumpReader().articles(CirrusDownloader(output=str(tmp_path)).stream_dump(path))
+    )
+
+    assert streamed == expected
+    assert [page_id for page_id, _ in streamed] == ["12", 13, "14", "15"]
+    assert streamed[0][1]["title"] == "Café"
+
+
+def test_stream_dump_lines_page_filter(tmp_path):
+    path = str(tmp_path / "dump.json.gz")
+    write_dump(path)
+    spec = dict(
+        namespaces=[0],
+        min_text_bytes=100,
+        exclude_title="^Caf",
+        exclude_templates=["Template:Liste"],
+    )
+
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        expected_reader = DumpReader(page_filter=PageFilter(**spec))
+        expected = list(expected_reader.articles(f))
+    reader = DumpReader(page_filter=PageFilter(**spec))
+    streamed = list(
+        reader.articles(CirrusDownloader(output=str(tmp_path)).stream_dump(path))
+    )
+
+    assert streamed == expected == []
+    assert reader.stats["filtered"] == 4
+    assert reader.page_filter.stats == expected_reader.page_filter.stats
+    assert reader.page_filter.stats["title"] == 1